@@ -0,0 +1,92 @@
+"""
+Local stand-in for najdi.si, answering login and send requests of
+:py:class:`pysms.providers.NajdiSiSms` without network.
+"""
+
+import os
+import time
+import json
+import threading
+import BaseHTTPServer, SocketServer
+
+fixtures = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "pysms", "tests")
+
+def _fixture(name):
+    with open(os.path.join(fixtures, name)) as f:
+        return f.read()
+
+class NajdiSiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Response is written at once, small writes would stall on delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    pages = {
+        "/logout": "",
+        "/login": _fixture("najdisi_login.html"),
+        "/session": _fixture("najdisi_loggedin.html")
+    }
+
+    def _reply(self, body, content_type = "text/html"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path in self.pages:
+            return self._reply(self.pages[self.path])
+
+        # Everything else is a send
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.sent += 1
+        self._reply(json.dumps({"msg_left": "1000", "msg_cnt": "0"}),
+                    "text/json")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        self._reply("")
+
+    def log_message(self, *args):
+        pass
+
+class NajdiSiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded http server with keep-alive connections
+
+    :param delay: Seconds to wait before answering each send
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay = 0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", 0), NajdiSiHandler)
+
+        self.delay = delay
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.url = "http://localhost:%d" %self.server_address[1]
+
+        self._thread = threading.Thread(target = self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def configure(self, provider):
+        """Points provider's urls to this server"""
+
+        provider.logout_url = self.url + "/logout"
+        provider.login_url = self.url + "/login"
+        provider.session_url = self.url + "/session"
+        provider.home_url = self.url + "/"
+        provider.send_url = self.url + "/{session}/{prefix}/{number}/{data}"
+
+        return provider
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,320 @@
+"""
+Throughput and latency benchmarks of pysms providers
+
+Runs :py:class:`pysms.providers.NajdiSiSms` against a local http server and
+:py:class:`pysms.providers.GsmModemSms` against simulated modems on pseudo
+terminals, so no network or hardware is needed.
+
+Every provider is run in three modes:
+
+- single: :py:meth:`send` called in a loop
+- bulk: :py:meth:`send_many` with all messages
+- concurrent: :py:meth:`send_many` of a pool of accounts or modems
+
+For each run messages per second, p50 and p99 latency of a single send and
+gc-tracked objects allocated per message are reported. Python 2 has no
+tracemalloc, so allocations are counted as net growth of gc-tracked objects,
+with gc disabled for the duration of the run.
+
+Validation of messages is measured too, with a schema constructed for every
+message and with a compiled schema and number cache, and import time of
+providers, eager and lazy, in a fresh interpreter.
+
+Usage::
+
+    python benchmarks/run.py --messages 1000 --output results.json
+    python benchmarks/run.py --compare results.json
+"""
+
+import os
+import sys
+import gc
+import time
+import json
+import timeit
+import logging
+import resource
+import platform
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from pysms import compile_schema, number_cache
+from pysms.providers import NajdiSiSms, NajdiSiPool, GsmModemSms, GsmModemPool
+from pysms.tests.fake_modem import FakeModem
+
+from najdisi_server import NajdiSiServer
+
+def percentile(values, p):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[int(round(p / 100. * (len(values) - 1)))]
+
+def timed(func, latencies):
+    """Wraps function, so duration of every call is recorded"""
+
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - start)
+
+    return wrapper
+
+def measure(name, mode, provider, messages, concurrency = None):
+    """
+    Sends messages with provider and collects statistics
+
+    :param mode: One of `single`, `bulk` or `concurrent`
+    :param provider: Provider, already logged in or set up
+    :param messages: List of `(number, text)` tuples
+    :param concurrency: Concurrency passed to send_many
+    """
+
+    latencies = []
+    errors = 0
+
+    if mode != "single":
+        # Send many dispatches to these, so they time a single send
+        attr = "_send_batched" if hasattr(provider, "_send_batched") else "_send"
+        setattr(provider, attr, timed(getattr(provider, attr), latencies))
+
+    gc.collect()
+    gc.disable()
+    objects = len(gc.get_objects())
+    start = time.time()
+    try:
+        if mode == "single":
+            send = timed(provider.send, latencies)
+            for number, text in messages:
+                try:
+                    send(number, text)
+                except Exception:
+                    errors += 1
+        else:
+            args = (concurrency,) if concurrency else ()
+            for result in provider.send_many(messages, *args):
+                errors += not result.ok
+        elapsed = time.time() - start
+        objects = len(gc.get_objects()) - objects
+    finally:
+        gc.enable()
+
+    result = {
+        "provider": name,
+        "mode": mode,
+        "messages": len(messages),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "msgs_per_sec": round(len(messages) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "objects_per_message": round(float(objects) / len(messages), 2)
+    }
+
+    print >>sys.stderr, "%(provider)-8s %(mode)-10s %(msgs_per_sec)10.1f msg/s " \
+                        "p50 %(p50_ms)8.3fms p99 %(p99_ms)8.3fms " \
+                        "%(objects_per_message)6.2f obj/msg " \
+                        "%(errors)d errors" %result
+    return result
+
+def messages(count):
+    return [("+3864192%04d" %(i % 10000), u"Benchmark message %d" %i)
+            for i in range(count)]
+
+def najdisi(args):
+    server = NajdiSiServer(delay = args.http_delay)
+    try:
+        def provider(username):
+            sms = server.configure(NajdiSiSms(username, "test"))
+            sms._login()
+            return sms
+
+        results = [measure("najdisi", "single", provider("single"),
+                           messages(args.messages)),
+                   measure("najdisi", "bulk", provider("bulk"),
+                           messages(args.messages))]
+
+        accounts = [provider("pool%d" %x) for x in range(args.concurrency)]
+        results.append(measure("najdisi", "concurrent", NajdiSiPool(accounts),
+                               messages(args.messages), args.concurrency))
+    finally:
+        server.stop()
+
+    return results
+
+def gsm_modem(args):
+    modems = [FakeModem(delay = args.modem_delay,
+                        submit_delay = args.submit_delay)
+              for x in range(args.concurrency)]
+    try:
+        def provider(modem):
+            return GsmModemSms(sp_name = modem.port, retries = 0)
+
+        results = [measure("gsm", "single", provider(modems[0]),
+                           messages(args.messages)),
+                   measure("gsm", "bulk", provider(modems[0]),
+                           messages(args.messages))]
+
+        pool = GsmModemPool([provider(modem) for modem in modems], retries = 0)
+        try:
+            results.append(measure("gsm", "concurrent", pool,
+                                   messages(args.messages)))
+        finally:
+            pool.close()
+    finally:
+        for modem in modems:
+            modem.stop()
+
+    return results
+
+def validation(args):
+    # Numbers repeat, as they do in bulk sends to a list of recipients
+    data = [{"number": "0419284%02d" %(x % 50), "text": "test"}
+            for x in range(args.messages)]
+
+    def uncompiled():
+        for d in data:
+            number_cache.clear()
+            NajdiSiSms.SendSchema().deserialize(d)
+
+    def compiled():
+        number_cache.clear()
+        schema = compile_schema(NajdiSiSms.SendSchema)
+        for d in data:
+            schema.deserialize(d)
+
+    results = []
+    for mode, func in (("uncompiled", uncompiled), ("compiled", compiled)):
+        elapsed = min(timeit.repeat(func, number = 1, repeat = 3))
+        result = {
+            "provider": "schema",
+            "mode": mode,
+            "messages": len(data),
+            "seconds": round(elapsed, 4),
+            "msgs_per_sec": round(len(data) / elapsed, 1)
+        }
+
+        print >>sys.stderr, "%(provider)-8s %(mode)-10s %(msgs_per_sec)10.1f msg/s" \
+                            %result
+        results.append(result)
+
+    return results
+
+def import_time(statement):
+    # Best of a few runs in a fresh interpreter
+    return min(float(subprocess.check_output(
+                   [sys.executable, "-c", "import time; start = time.time(); "
+                    "%s; print time.time() - start" %statement], cwd = root))
+               for x in range(3))
+
+def imports(args):
+    results = []
+    for mode, statement in (
+            ("eager", "from pysms.providers import NajdiSiSms, GsmModemSms"),
+            ("lazy", "import pysms.providers")):
+        result = {
+            "provider": "import",
+            "mode": mode,
+            "seconds": round(import_time(statement), 4)
+        }
+
+        print >>sys.stderr, "%-8s %-10s %8.1fms" %(result["provider"],
+                                                   result["mode"],
+                                                   result["seconds"] * 1000)
+        results.append(result)
+
+    return results
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = root,
+                                       stderr = open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """Prints change of throughput and p99 latency against previous run"""
+
+    old = dict(((r["provider"], r["mode"]), r) for r in previous["results"])
+    print >>sys.stderr, "\nCompared to %s:" %previous["meta"].get("revision")
+    for result in results:
+        before = old.get((result["provider"], result["mode"]))
+        if not before:
+            continue
+
+        if "msgs_per_sec" in result:
+            changes = ["throughput %+7.1f%%" %(100. * result["msgs_per_sec"]
+                                               / before["msgs_per_sec"] - 100)]
+        else:
+            changes = ["time %+7.1f%%"
+                       %(100. * result["seconds"] / before["seconds"] - 100)]
+        if "p99_ms" in result:
+            changes.append("p99 %+7.1f%%"
+                           %(100. * result["p99_ms"] / (before["p99_ms"] or 1) - 100))
+
+        print >>sys.stderr, "%-8s %-10s %s" %(result["provider"], result["mode"],
+                                              " ".join(changes))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type = int, default = 500,
+                        help = "Messages sent in each run")
+    parser.add_argument("--concurrency", type = int, default = 4,
+                        help = "Accounts or modems in concurrent runs")
+    parser.add_argument("--http-delay", type = float, default = 0.001,
+                        help = "Seconds najdi.si server takes to answer send")
+    parser.add_argument("--modem-delay", type = float, default = 0.001,
+                        help = "Seconds modem takes to answer command")
+    parser.add_argument("--submit-delay", type = float, default = 0.005,
+                        help = "Seconds modem takes to submit pdu")
+    parser.add_argument("--provider", choices = ["najdisi", "gsm", "schema",
+                                               "import"],
+                        action = "append",
+                        help = "Provider, schema validation or import to "
+                               "run, all by default")
+    parser.add_argument("--output", help = "File to save results to as json")
+    parser.add_argument("--compare", help = "Json results of previous run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.ERROR)
+
+    results = []
+    if not args.provider or "najdisi" in args.provider:
+        results.extend(najdisi(args))
+    if not args.provider or "gsm" in args.provider:
+        results.extend(gsm_modem(args))
+    if not args.provider or "schema" in args.provider:
+        results.extend(validation(args))
+    if not args.provider or "import" in args.provider:
+        results.extend(imports(args))
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "args": vars(args)
+        },
+        "results": results
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+    else:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+    main()
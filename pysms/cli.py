@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: cli.py
+   :platform: Unix, Windows
+   :synopsis: pysms-send command sending sms-es from csv or jsonl records
+
+Records are read from a file or stdin and sent in chunks, so only a few
+chunks are in memory however long the input is. Every record gets a result
+written to stdout as a json line, in order of completion, while progress and
+throughput go to stderr.
+
+Jsonl records are objects with arguments of send, like
+`{"number": "+38641928491", "text": "Hello"}`, or `[number, text]` arrays.
+Csv files start with a header naming the arguments of columns.
+
+Provider is read from a json config file, as its name and constructor
+options, or a list of them to send over a :py:class:`pysms.router.Router`::
+
+    {"provider": "NajdiSiSms",
+     "options": {"username": "user", "password": "secret"}}
+
+With `--processes` sending is fanned out to worker processes, each with its
+own provider. Providers from the config are split between processes, and
+reused if there are fewer of them than processes.
+
+Usage::
+
+    pysms-send --config najdisi.json --concurrency 4 messages.csv > results.jsonl
+"""
+
+import sys
+import csv
+import Queue
+import json
+import math
+import time
+import argparse
+import threading
+import multiprocessing
+
+from itertools import islice
+
+from pysms import InputException
+from pysms.router import Router
+from pysms.providers import get_provider
+
+class WorkerException(Exception):
+    """
+    Raised when worker process failed or could not create its provider
+    """
+
+def _records(f, format = "jsonl", encoding = "utf-8"):
+    """
+    Reads records lazily from file
+
+    Csv header is read right away, so a missing column is reported before
+    anything is sent.
+
+    :param f: File to read from
+    :param format: Either `csv` or `jsonl`
+    :param encoding: Encoding of csv files
+
+    :returns: Generator of `(index, message)`, where message is
+              :py:exc:`pysms.sms.InputException` if record is invalid
+    :raises: :py:exc:`ValueError` if csv header lacks number or text
+    """
+
+    lines = iter(f.readline, "")
+
+    if format == "csv":
+        reader = csv.reader(lines)
+        header = [name.decode(encoding).strip() for name in next(reader, [])]
+        if "number" not in header or "text" not in header:
+            raise ValueError("Csv header must name number and text columns")
+
+        def rows():
+            for index, row in enumerate(reader):
+                if len(row) != len(header):
+                    yield index, InputException(
+                        "Expected %d columns, got %d" %(len(header), len(row)))
+                    continue
+
+                try:
+                    yield index, dict(zip(header, (value.decode(encoding)
+                                                   for value in row)))
+                except UnicodeDecodeError as e:
+                    yield index, InputException("Invalid encoding %s" %e)
+
+        return rows()
+
+    def objects():
+        index = 0
+        for line in lines:
+            if not line.strip():
+                continue
+
+            try:
+                message = json.loads(line)
+                if isinstance(message, list):
+                    message = dict(zip(("number", "text"), message))
+                elif not isinstance(message, dict):
+                    raise ValueError("Record is not an object")
+            except ValueError as e:
+                message = InputException("Invalid record %s" %e)
+
+            yield index, message
+            index += 1
+
+    return objects()
+
+def _chunks(records, size):
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+def load_config(path):
+    """
+    Loads provider entries from json config file
+
+    :param path: Path of config file
+    :type path: str
+
+    :returns: List of `{"provider": name, "options": {...}}` dicts
+    :raises: :py:exc:`ValueError` if config is invalid
+    """
+
+    with open(path) as f:
+        config = json.load(f)
+
+    entries = config if isinstance(config, list) else [config]
+    if not entries:
+        raise ValueError("No provider in config")
+
+    for entry in entries:
+        if not isinstance(entry, dict) or "provider" not in entry:
+            raise ValueError("Config entry %r names no provider" %(entry,))
+        try:
+            get_provider(entry["provider"])
+        except KeyError as e:
+            raise ValueError(e.args[0])
+
+    return entries
+
+def build(entries):
+    """
+    Creates provider from config entries
+
+    :param entries: Entries as returned by :py:func:`load_config`
+    :type entries: list
+
+    :returns: Provider, or :py:class:`pysms.router.Router` of providers if
+              there are many entries
+    """
+
+    providers = [get_provider(entry["provider"])(**entry.get("options", {}))
+                 for entry in entries]
+
+    return providers[0] if len(providers) == 1 else Router(providers)
+
+def _close(sms):
+    for provider in [route.sms for route in getattr(sms, "routes", [])] + [sms]:
+        if hasattr(provider, "close"):
+            provider.close()
+
+def _result(index, message, value = None, exception = None):
+    result = {"index": index,
+              "number": message.get("number")
+                        if isinstance(message, dict) else None,
+              "ok": exception is None}
+    if exception is None:
+        # Json lines must stay valid json, which has no infinity or nan
+        if isinstance(value, float) and (math.isinf(value) or
+                                         math.isnan(value)):
+            value = None
+        result["value"] = value
+    else:
+        result["error"] = type(exception).__name__
+        result["message"] = str(exception)
+
+    return result
+
+def _send_chunk(sms, chunk, concurrency = 1):
+    """
+    Sends chunk of records
+
+    :param sms: Provider
+    :param chunk: List of `(index, message)`, as read by :py:func:`_records`
+    :param concurrency: Maximal number of sends in flight
+
+    :returns: Generator of result dicts in order of completion
+    """
+
+    messages = []
+    for index, message in chunk:
+        if isinstance(message, InputException):
+            yield _result(index, None, exception = message)
+        else:
+            messages.append((index, message))
+
+    for result in sms.send_many([message for index, message in messages],
+                                concurrency):
+        index, message = messages[result.index]
+        yield _result(index, message, result.value, result.exception)
+
+def _worker(entries, tasks, results, concurrency):
+    """
+    Sends chunks from tasks queue in a worker process
+
+    Puts lists of results to results queue and `None` once done, or error
+    message if provider could not be created or sending failed.
+    """
+
+    try:
+        sms = build(entries)
+    except Exception as e:
+        results.put("%s: %s" %(type(e).__name__, e))
+        return
+
+    try:
+        for chunk in iter(tasks.get, None):
+            results.put(list(_send_chunk(sms, chunk, concurrency)))
+    except Exception as e:
+        results.put("%s: %s" %(type(e).__name__, e))
+    finally:
+        _close(sms)
+        results.put(None)
+
+def _fan_out(entries, chunks, processes, concurrency):
+    """
+    Sends chunks over worker processes
+
+    Chunks are queued to a bounded queue, so input is read only as fast
+    as workers send it.
+
+    :returns: Generator of result dicts
+    :raises: :py:exc:`WorkerException` if a worker failed or exited
+    """
+
+    tasks = multiprocessing.Queue(processes * 2)
+    results = multiprocessing.Queue()
+
+    workers = [multiprocessing.Process(
+                   target = _worker,
+                   args = (entries[i::processes] or [entries[i % len(entries)]],
+                           tasks, results, concurrency))
+               for i in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    failed = []
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                tasks.put(item, timeout = 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def feed():
+        try:
+            for chunk in chunks:
+                put(chunk)
+        except Exception as e:
+            failed.append(e)
+        finally:
+            for worker in workers:
+                put(None)
+
+    feeder = threading.Thread(target = feed)
+    feeder.daemon = True
+    feeder.start()
+
+    try:
+        running = processes
+        while running:
+            try:
+                res = results.get(timeout = 0.1)
+            except Queue.Empty:
+                # Worker killed without saying it is done
+                if not any(worker.is_alive() for worker in workers):
+                    raise WorkerException("Workers exited")
+                continue
+
+            if res is None:
+                running -= 1
+            elif isinstance(res, list):
+                for result in res:
+                    yield result
+            else:
+                raise WorkerException(res)
+
+        # Workers are done, so feeder must not wait for them to take more
+        stopped.set()
+        feeder.join()
+        if failed:
+            raise failed[0]
+    finally:
+        stopped.set()
+        feeder.join()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+        # Chunks nobody took are read back, so queue is not collected while
+        # its thread still writes them to the pipe
+        try:
+            while True:
+                tasks.get(timeout = 0.1)
+        except Queue.Empty:
+            pass
+
+class Progress(object):
+    """
+    Counts results and reports progress and throughput
+    """
+
+    def __init__(self, stream, interval = 1):
+        """
+        Constructor
+
+        :param stream: Stream progress is written to
+        :param interval: Seconds between progress reports, 0 to report only
+                         once done
+        :type interval: float
+        """
+
+        self.stream = stream
+        self.interval = interval
+
+        self.sent = 0
+        self.failed = 0
+        self.start = self._last = time.time()
+
+    def __call__(self, result):
+        if result["ok"]:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+        if self.interval and time.time() - self._last >= self.interval:
+            self._last = time.time()
+            self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        print >>self.stream, "%d sent, %d failed in %.1fs, %.1f msg/s" %(
+            self.sent, self.failed, elapsed,
+            (self.sent + self.failed) / elapsed if elapsed else 0)
+        self.stream.flush()
+
+def main(args = None, stdin = None, stdout = None, stderr = None):
+    """
+    Runs pysms-send command
+
+    :param args: Command line arguments, `sys.argv` by default
+    :type args: list
+
+    :returns: Exit status, 1 if any sms failed
+    :rtype: int
+    """
+
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    parser = argparse.ArgumentParser(
+        prog = "pysms-send", description = __doc__.split("\n\n")[1])
+    parser.add_argument("input", nargs = "?", default = "-",
+                        help = "Csv or jsonl file with sms-es, stdin by default")
+    parser.add_argument("--config", required = True,
+                        help = "Json file with provider and its options")
+    parser.add_argument("--format", choices = ["csv", "jsonl"],
+                        help = "Format of input, by default csv for .csv "
+                               "files and jsonl otherwise")
+    parser.add_argument("--encoding", default = "utf-8",
+                        help = "Encoding of csv input")
+    parser.add_argument("--concurrency", type = int, default = 1,
+                        help = "Sends in flight in each process")
+    parser.add_argument("--processes", type = int, default = 0,
+                        help = "Worker processes to fan out to, none by default")
+    parser.add_argument("--chunk-size", type = int, default = 1000,
+                        help = "Records handed out to senders at once")
+    parser.add_argument("--progress", type = float, default = 1,
+                        help = "Seconds between progress reports, 0 to disable")
+    args = parser.parse_args(args)
+
+    try:
+        entries = load_config(args.config)
+    except (IOError, ValueError) as e:
+        parser.error("Invalid config %s" %e)
+
+    format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+    f = stdin if args.input == "-" else open(args.input, "rb")
+    try:
+        try:
+            records = _records(f, format, args.encoding)
+        except ValueError as e:
+            parser.error(str(e))
+        chunks = _chunks(records, args.chunk_size)
+
+        if args.processes > 0:
+            results = _fan_out(entries, chunks, args.processes,
+                               args.concurrency)
+            sms = None
+        else:
+            sms = build(entries)
+            results = (result for chunk in chunks
+                       for result in _send_chunk(sms, chunk, args.concurrency))
+
+        progress = Progress(stderr, args.progress)
+        try:
+            for result in results:
+                stdout.write(json.dumps(result, sort_keys = True,
+                                        allow_nan = False) + "\n")
+                progress(result)
+        except WorkerException as e:
+            print >>stderr, "Worker failed %s" %e
+            return 2
+        finally:
+            stdout.flush()
+            progress.report()
+            if sms is not None:
+                _close(sms)
+    finally:
+        if f is not stdin:
+            f.close()
+
+    return 1 if progress.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
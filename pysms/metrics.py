@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: metrics.py
+   :platform: Unix, Windows
+   :synopsis: Timing and counter events of sms sending stages
+
+Providers emit events for stages of sending, like validation, login, http
+requests or serial port writes. Events are passed to callbacks registered
+with :py:func:`subscribe`, and while there are none, emitting an event costs
+a single check.
+
+Events emitted:
+
+=========================  =======  ========================================
+Name                       Kind     Stage
+=========================  =======  ========================================
+validate                   timing   Schema validation of a message
+retry                      counter  Send attempt repeated
+login                      timing   Login to najdi.si
+session_reuse              counter  Session reused instead of logging in
+refresh                    timing   Reload of najdi.si session page
+http                       timing   Http request sending sms to najdi.si
+segments                   counter  Sms segments submitted to modem
+serial_write               timing   Write to serial port
+serial_wait                timing   Waiting for modem's response
+serial_bytes_out           counter  Bytes written to serial port
+serial_bytes_in            counter  Bytes read from serial port
+delivery_reports           counter  Delivery reports matched to sent sms-es
+received                   counter  Sms-es received by modem
+=========================  =======  ========================================
+
+Every event has a `provider` label with provider class name.
+"""
+
+import time
+import threading
+
+TIMING = "timing"
+"""Event value is duration in seconds"""
+COUNTER = "counter"
+"""Event value is increment of a counter"""
+
+_callbacks = []
+
+def subscribe(callback):
+    """
+    Registers callback receiving events
+
+    Callback is called as `callback(kind, name, value, labels)` in the
+    thread that emitted the event, so it should be quick and thread safe.
+
+    :param callback: Callable receiving events
+    """
+
+    _callbacks.append(callback)
+
+def unsubscribe(callback):
+    """
+    Removes callback registered with :py:func:`subscribe`
+    """
+
+    _callbacks.remove(callback)
+
+def emit(kind, name, value, labels):
+    for callback in list(_callbacks):
+        callback(kind, name, value, labels)
+
+def count(name, value = 1, **labels):
+    """
+    Emits counter event
+    """
+
+    if _callbacks:
+        emit(COUNTER, name, value, labels)
+
+def timing(name, seconds, **labels):
+    """
+    Emits timing event for a duration measured by caller
+
+    Useful where a stage can not be wrapped with :py:class:`timed`, like
+    across callbacks.
+    """
+
+    if _callbacks:
+        emit(TIMING, name, seconds, labels)
+
+class timed(object):
+    """
+    Context manager emitting timing event for its body
+
+    Timing is emitted even if body raises.
+    """
+
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if _callbacks:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None and _callbacks:
+            emit(TIMING, self.name, time.time() - self.start, self.labels)
+
+class PrometheusCollector(object):
+    """
+    Collects events and renders them in Prometheus text format
+
+    Counters become `pysms_<name>_total` counters and timings become
+    `pysms_<name>_seconds` histograms.
+
+    Example::
+
+        collector = PrometheusCollector()
+        metrics.subscribe(collector)
+        ...
+        print collector.render()
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float("inf"))
+    """Upper bounds of histogram buckets in seconds"""
+
+    def __init__(self, prefix = "pysms"):
+        """
+        Constructor
+
+        :param prefix: Prefix of metric names
+        :type prefix: str
+        """
+
+        self.prefix = prefix
+
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            if kind == COUNTER:
+                self._counters[key] = self._counters.get(key, 0) + value
+                return
+
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0]
+
+            counts = histogram[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra = ()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+
+        return "{%s}" %",".join('%s="%s"' %(name, str(value).replace('"', '\\"'))
+                                for name, value in labels)
+
+    @staticmethod
+    def _bound(bound):
+        return "+Inf" if bound == float("inf") else repr(bound)
+
+    def render(self):
+        """
+        Renders collected metrics
+
+        :returns: Metrics in Prometheus text exposition format
+        :rtype: str
+        """
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2]))
+                                for key, h in self._histograms.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = "%s_%s_total" %(self.prefix, name)
+            if metric not in typed:
+                lines.append("# TYPE %s counter" %metric)
+                typed.add(metric)
+            lines.append("%s%s %s" %(metric, self._labels(labels), value))
+
+        for (name, labels), (counts, total, observations) in histograms:
+            metric = "%s_%s_seconds" %(self.prefix, name)
+            if metric not in typed:
+                lines.append("# TYPE %s histogram" %metric)
+                typed.add(metric)
+
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append("%s_bucket%s %d" %(
+                    metric, self._labels(labels, [("le", self._bound(bound))]),
+                    cumulative))
+            lines.append("%s_sum%s %r" %(metric, self._labels(labels), total))
+            lines.append("%s_count%s %d" %(metric, self._labels(labels),
+                                           observations))
+
+        return "\n".join(lines) + "\n"
@@ -3,10 +3,87 @@
 .. module:: __init__.py
    :platform: Unix, Windows
    :synopsis: pysms.providers module
+
+Providers are imported on first access, so using one provider does not
+pull in dependencies of the others, like :py:mod:`mechanize` or
+:py:mod:`serial`.
 """
 
-from najdisi import NajdiSiSms
-from gsm_modem import GsmModemSms
+import sys
+import importlib
+
+from types import ModuleType
+
+# Provider classes by name and module they are defined in
+_registry = {
+    "NajdiSiSms": "najdisi",
+    "NajdiSiPool": "najdisi",
+    "AsyncNajdiSiSms": "najdisi",
+    "GsmModemSms": "gsm_modem",
+    "GsmModemPool": "gsm_modem",
+    "PreparedMessage": "gsm_modem",
+    "DeliveryReport": "gsm_modem",
+    "InboundMessage": "gsm_modem",
+    "MemorySms": "memory"
+}
+
+# Names of all providers
+provider_names = ["NajdiSiSms", "GsmModemSms"]
+
+# Names of all non-blocking providers
+async_provider_names = ["AsyncNajdiSiSms"]
+
+def get_provider(name):
+    """
+    Returns provider class, importing its module if needed
+
+    :param name: Name of provider class ( ex. NajdiSiSms )
+    :type name: str
+
+    :raises: :py:exc:`KeyError` if there is no such provider
+    """
+
+    if name not in _registry:
+        raise KeyError("Unknown provider %s" %name)
+
+    return getattr(sys.modules[__name__], name)
+
+class _LazyModule(ModuleType):
+    """
+    Module importing providers on attribute access
+    """
+
+    def __init__(self, module):
+        ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # Python 2 clears globals of a module once it is collected
+        self._module = module
+
+    def __getattr__(self, name):
+        try:
+            module = _registry[name]
+        except KeyError:
+            raise AttributeError("module %r has no attribute %r"
+                                 %(self.__name__, name))
+
+        value = getattr(importlib.import_module("%s.%s" %(self.__name__, module)),
+                        name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_registry))
+
+    @property
+    def providers(self):
+        """List of all providers"""
+
+        return [get_provider(name) for name in provider_names]
+
+    @property
+    def async_providers(self):
+        """List of all non-blocking providers"""
+
+        return [get_provider(name) for name in async_provider_names]
 
-# List of all providers
-providers = [NajdiSiSms, GsmModemSms]
+sys.modules[__name__] = _LazyModule(sys.modules[__name__])
@@ -5,22 +5,282 @@
    :synopsis: Sends sms-es using http://www.najdi.si/> service
 """
 
+import re
+import sys
 import time
 import colander
 import logging
+import random
+import datetime
+import threading
+import itertools
+import Queue
+import six
 
-from smspdu import SMS_SUBMIT
+from collections import deque, OrderedDict
+
+from smspdu import SMS_SUBMIT, SMS_DELIVER
+from smspdu.pdu import pack7bit, unpack_date, PDUData, SMS_GENERIC
 from serial import Serial
-from serial import SerialException, SerialTimeoutException
+from serial import SerialException
 from colander import SchemaNode
 from colander import String, Float, Bool
 
-from pysms import Sms
-from pysms import InputException, AuthException, SendException, CommunicationException
+from pysms import Sms, NumberCache, RetryPolicy
+from pysms import metrics
+from pysms.sms import _dispatch, split_text, ENCODING_GSM7
+from pysms import SmsException, InputException, SendException, \
+                  CommunicationException
+
+_final_re = re.compile(r'(?:^|\r\n)(OK|ERROR|\+CM[SE] ERROR:[^\r\n]*)\r\n')
+_prompt_re = re.compile(r'(?:^|\n)> ')
+_cms_error_re = re.compile(r'\+CMS ERROR:\s*(\d+)')
+_cmgs_re = re.compile(r'\+CMGS:\s*(\d+)')
+_cmgr_re = re.compile(r'\+CMGR:[^\r\n]*\r\n([0-9A-Fa-f]+)\r\n')
+_cmgl_re = re.compile(r'\+CMGL: *(\d+),[^\r\n]*\r\n([0-9A-Fa-f]+)\r\n')
+# Result codes modem sends on its own, with pdu or with storage index
+_unsolicited_re = re.compile(r'(?:^|\r\n)\+(CDS|CMT): *[^\r\n]*\r\n([0-9A-Fa-f]+)\r\n'
+                             r'|(?:^|\r\n)\+(CDSI|CMTI): *"\w+",(\d+)\r\n')
+_partial_unsolicited_re = re.compile(r'(?:^|\r\n)\+C(?:DS|MT)I?:[^\r\n]*'
+                                     r'(?:\r\n[0-9A-Fa-f]*\r?)?\r?\Z')
+
+# Parts of long sms-es kept while waiting for the rest of them
+_max_parts = 256
+_part_timeout = 3600
+
+def _with_code(exception, response):
+    """
+    Sets `+CMS ERROR` code from modem's response on exception
+    """
+
+    match = _cms_error_re.search(response)
+    if match:
+        exception.code = int(match.group(1))
+
+    return exception
+
+def _decode_date(octets):
+    # Time zone is dropped, service centers report their local time
+    return datetime.datetime.strptime(unpack_date(octets)[:12], "%y%m%d%H%M%S")
+
+def _tpdu(pdu):
+    # Modem puts service center address in front of pdu
+    return pdu[2 + 2 * int(pdu[:2], 16):]
+
+def _decode_status_report(pdu):
+    """
+    Decodes SMS-STATUS-REPORT pdu, with service center address in front as
+    modem passes it
+
+    :param pdu: Pdu in hex format
+    :type pdu: str
+
+    :returns: Message reference, recipient, time service center got sms,
+              time of status and status
+    :rtype: tuple
+    :raises: :py:exc:`ValueError` if pdu is not a valid status report
+    """
+
+    tpdu = PDUData(_tpdu(pdu))
+
+    first = tpdu.int()
+    if first & 0x03 != 2:
+        raise ValueError("Pdu is not a status report")
+
+    reference = tpdu.int()
+    tp_al, tp_toa, number = SMS_GENERIC.parseAddress(tpdu)
+    if tp_toa & 0x70 == 0x10:
+        number = "+" + number
+    accepted = _decode_date(tpdu.octets(7))
+    done = _decode_date(tpdu.octets(7))
+
+    return reference, number, accepted, done, tpdu.int()
+
+class DeliveryReport(object):
+    """
+    Status of sent sms reported back by service center
+    """
+
+    def __init__(self, reference, number, status, accepted = None,
+                 done = None, key = None, account = None):
+        """
+        Constructor
+
+        :param reference: Message reference returned by send
+        :type reference: int
+        :param number: Recipient number
+        :type number: str
+        :param status: Status as reported by service center (TP-ST)
+        :type status: int
+        :param accepted: Time service center got sms
+        :type accepted: :py:class:`datetime.datetime`
+        :param done: Time of status
+        :type done: :py:class:`datetime.datetime`
+        :param key: Idempotency key sms was sent with
+        :type key: str
+        :param account: Serial port sms was sent over
+        :type account: str
+        """
+
+        self.reference = reference
+        self.number = number
+        self.status = status
+        self.accepted = accepted
+        self.done = done
+        self.key = key
+        self.account = account
+
+    @property
+    def delivered(self):
+        """True if sms was delivered"""
+
+        return self.status < 0x20
+
+    @property
+    def final(self):
+        """True if service center will not report sms again"""
+
+        return not 0x20 <= self.status < 0x40
+
+    def __repr__(self):
+        return "<DeliveryReport %s %s 0x%02X>" %(self.reference, self.number,
+                                                  self.status)
+
+class InboundMessage(object):
+    """
+    Sms received by modem
+    """
+
+    def __init__(self, number, text, sent = None, account = None,
+                 complete = True):
+        """
+        Constructor
+
+        :param number: Sender number
+        :type number: str
+        :param text: Text of sms, joined from all parts of a long sms
+        :type text: unicode
+        :param sent: Time service center got sms
+        :type sent: :py:class:`datetime.datetime`
+        :param account: Serial port sms was received on
+        :type account: str
+        :param complete: False if some parts of a long sms never arrived
+        :type complete: bool
+        """
+
+        self.number = number
+        self.text = text
+        self.sent = sent
+        self.account = account
+        self.complete = complete
+
+    def __repr__(self):
+        return "<InboundMessage %s %r>" %(self.number, self.text)
+
+class _Request(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+class _Pending(object):
+    def __init__(self, reference, params, segments):
+        self.reference = reference
+        self.params = params
+        self.waiting = set(segments)
+        self.failed = None
+
+class PreparedMessage(object):
+    """
+    Sms text encoded once, for sending to many recipients
+
+    Encoding user data (GSM-7 packing or UCS-2) is the expensive part of
+    creating a pdu, while only destination address and a few flags differ
+    between recipients, so those are spliced around already encoded data.
+    Text too long for a single sms is split into segments, which are sent
+    with concatenation headers.
+    """
+
+    def __init__(self, text):
+        """
+        Constructor
+
+        :param text: Text of the sms
+        :type text: unicode
+        """
+
+        encoding, segments = split_text(text)
+        concatenated = len(segments) > 1
+        # Room for concatenation header, gsm-7 data starts on septet boundary
+        header = 6 if concatenated else 0
+
+        self.text = text
+        self.tp_udhi = concatenated
+        self.user_data = []
+        if encoding == ENCODING_GSM7:
+            self.tp_dcs = 0
+            for segment in segments:
+                packed = pack7bit(segment, header)[1]
+                self.user_data.append(
+                    (len(segment) + (7 if header else 0),
+                     packed.encode("hex").upper()))
+        else:
+            self.tp_dcs = 8
+            for segment in segments:
+                self.user_data.append((len(segment) + header,
+                                       segment.encode("hex").upper()))
+
+    def pdus(self, number, silent = False, delivery_report = False,
+             reference = 0):
+        """
+        Creates pdus of all segments for a single recipient
+
+        Length to be used with `AT+CMGS` is half of pdu length.
+
+        :param number: Recipient number without leading `+`
+        :type number: str
+        :param silent: Should silent sms be sent
+        :type silent: bool
+        :param delivery_report: Should delivery report be requested
+        :type delivery_report: bool
+        :param reference: Concatenated sms reference, should differ between
+                          consecutive long sms-es to the same recipient
+        :type reference: int
+
+        :returns: Pdus in hex format
+        :rtype: list
+        """
+
+        first = 0x01
+        if delivery_report:
+            first |= 0x20
+        if self.tp_udhi:
+            first |= 0x40
+
+        tp_al, tp_toa, packed = SMS_SUBMIT.determineAddress(number)
+        head = "%02X00%02X%02X%s%02X%02X" %(first, tp_al, tp_toa,
+                                            packed.encode("hex").upper(),
+                                            64 if silent else 0, self.tp_dcs)
+
+        if not self.tp_udhi:
+            tp_udl, tp_ud = self.user_data[0]
+            return ["%s%02X%s" %(head, tp_udl, tp_ud)]
+
+        total = len(self.user_data)
+        return ["%s%02X050003%02X%02X%02X%s" %(head, tp_udl, reference % 256,
+                                              total, seq, tp_ud)
+                for seq, (tp_udl, tp_ud) in enumerate(self.user_data, 1)]
 
 class GsmModemSms(Sms):
     """
     Send sms-es using gsm modem
+
+    A single instance can be used from many threads. Their commands are
+    queued and written by a single writer thread, one command and response
+    at a time, while a reader thread, if delivery reports or received
+    sms-es are collected, hands over responses and passes on the rest.
     """
 
     logger = logging.getLogger(__name__)
@@ -29,22 +289,71 @@ class GsmModemSms(Sms):
         sp_name = SchemaNode(String())
         timeout = SchemaNode(Float(),
                              validator = colander.Range(0, float('inf')))
+        response_timeout = SchemaNode(Float(),
+                                      validator = colander.Range(0, float('inf')))
+        probe_interval = SchemaNode(Float(),
+                                    validator = colander.Range(0, float('inf')))
+        smsc = SchemaNode(String(), missing = None)
+        storage = SchemaNode(String(), missing = None)
+        delivery_reports = SchemaNode(Bool())
+        receive_messages = SchemaNode(Bool())
 
     class SendSchema(Sms.SendSchema):
-        source_number = SchemaNode(String())
+        source_number = SchemaNode(String(), missing = '')
         silent = SchemaNode(Bool())
         delivery_report = SchemaNode(Bool())
 
-    def __init__(self, retries = 2, sp_name = "/dev/ttyUSB0", timeout = 0.2):
+    def __init__(self, retries = 2, sp_name = "/dev/ttyUSB0", timeout = 0.2,
+                 response_timeout = 30, probe_interval = 60,
+                 smsc = None, storage = None, retry_policy = None,
+                 delivery_reports = False, on_report = None,
+                 receive_messages = False, on_message = None):
         """
         Constructor
 
+        With `delivery_reports` set, modem is told to pass status reports
+        on as they arrive, and a background thread reads serial port,
+        matching them to sent sms-es. Matched reports are passed to
+        `on_report` or, if it is not set, queued for :py:meth:`reports`.
+
+        With `receive_messages` set, modem is told to announce received
+        sms-es, which are then read from modem storage, put together and
+        passed to `on_message` or, if it is not set, queued for
+        :py:meth:`received`.
+
         :param sp_name: Name of serial port ( ex. /dev/ttyUSB0 )
         :type sp_name: str
-        :param retries: Number of retries
+        :param retries: Number of retries of every sms segment
         :type retries: int
-        :param timeout: Serial port timeout
-        :type timeout: int
+        :param timeout: Serial port read timeout, only bounds single read,
+                        reads return as soon as data arrives
+        :type timeout: float
+        :param response_timeout: Maximal time to wait for response to a
+                                 command
+        :type response_timeout: float
+        :param probe_interval: Seconds modem is trusted to be alive after
+                               last successful command
+        :type probe_interval: float
+        :param smsc: Service center number set on modem, modem default if
+                     not set
+        :type smsc: str
+        :param storage: Preferred message storage ( ex. SM or ME )
+        :type storage: str
+        :param retry_policy: Policy of retrying sms segments, overrides
+                             `retries`
+        :type retry_policy: :py:class:`pysms.sms.RetryPolicy`
+        :param delivery_reports: Should delivery reports be collected
+        :type delivery_reports: bool
+        :param on_report: Function called with every
+                          :py:class:`DeliveryReport`, from reporting
+                          thread
+        :type on_report: callable
+        :param receive_messages: Should received sms-es be collected
+        :type receive_messages: bool
+        :param on_message: Function called with every
+                           :py:class:`InboundMessage`, from reporting
+                           thread
+        :type on_message: callable
 
         :raises: :py:exc:`pysms.sms.InputException`
         """
@@ -53,40 +362,575 @@ class GsmModemSms(Sms):
             self.__dict__.update(self.InitSchema().deserialize(locals()))
         except colander.Invalid, e:
             raise InputException("Problems with input data %s" %e)
+        self.retry_policy = retry_policy or RetryPolicy(self.retries)
+        self.on_report = on_report
+        self.on_message = on_message
+
+        self.sp = None
+        self._buffer = bytearray()
+        self._messages = NumberCache(maxsize = 256)
+        self._references = itertools.count(random.randint(0, 255))
+        self._reset_state()
+
+        # Only writer thread talks to modem, so commands of different
+        # threads are never interleaved
+        self._requests = Queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # Guards buffer, once reader thread fills it
+        self._cond = threading.Condition()
+        self._reader = None
+        self._read_error = None
+        self._unsolicited = Queue.Queue()
+        self._reporter = None
+        self._closing = threading.Event()
+        self._reports = Queue.Queue(maxsize = 10000)
+        # Sms-es waiting for reports and reports that came first, by message
+        # reference
+        self._pending = {}
+        self._unmatched = {}
+        self._pending_lock = threading.Lock()
+        # Received sms-es, queue blocks reading modem storage while full
+        self._inbox = Queue.Queue(maxsize = 1000)
+        self._parts = OrderedDict()
+        self._list_queued = False
+
+    @property
+    def account(self):
+        return self.sp_name
+
+    def _reset_state(self):
+        """
+        Forgets modem state, so it is set up again before next sms
+        """
+
+        self._verified = False
+        self._pdu_mode = False
+        self._configured = False
+        self._last_ok = 0
+
+    def close(self):
+        """
+        Stops background threads and closes serial port
+        """
+
+        # Reporter goes first, while it can still talk to modem, and gives
+        # up waiting for space in a full inbox
+        self._closing.set()
+        reporter, self._reporter = self._reporter, None
+        if reporter:
+            self._unsolicited.put(None)
+            reporter.join()
+
+        self._call(self._close)
+        writer, self._writer = self._writer, None
+        self._requests.put(None)
+        writer.join()
+        self._closing.clear()
+
+    def _call(self, func, *args):
+        """
+        Calls `func` on writer thread, waiting for its result
+
+        :returns: Value returned by `func`
+        :raises: Exception raised by `func`
+        """
+
+        if threading.current_thread() is self._writer:
+            return func(*args)
+
+        with self._writer_lock:
+            if not self._writer:
+                self._writer = threading.Thread(target = self._write_loop)
+                self._writer.daemon = True
+                self._writer.start()
+
+        request = _Request(func, args)
+        self._requests.put(request)
+        request.done.wait()
+
+        if request.exc_info:
+            six.reraise(*request.exc_info)
+        return request.value
+
+    def _write_loop(self):
+        """
+        Runs queued requests one after another
+        """
+
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            try:
+                request.value = request.func(*request.args)
+            except Exception:
+                request.exc_info = sys.exc_info()
+            request.done.set()
+
+    def _close(self):
+        self._stop_reader()
+
+        if self.sp:
+            try:
+                self.sp.close()
+            except SerialException:
+                pass
 
         self.sp = None
+        self._reset_state()
+
+    def _read_response(self, prompt = False, timeout = None):
+        """
+        Reads until final result code, or `> ` prompt if `prompt` is set
+
+        :returns: Response up to and including final result code
+        :rtype: str
+        :raises: :py:exc:`pysms.sms.CommunicationException`
+        """
+
+        deadline = time.time() + (timeout or self.response_timeout)
+        buf = self._buffer
+
+        while True:
+            with self._cond:
+                self._take_unsolicited()
+                match = _final_re.search(buf) or (prompt and _prompt_re.search(buf))
+                if match:
+                    response = str(buf[:match.end()])
+                    del buf[:match.end()]
+                    return response
+
+                if time.time() > deadline:
+                    raise CommunicationException("Timeout waiting for response, "
+                                                 "got %r" %str(buf))
+
+                # Reader thread fills buffer, if it runs
+                error = self._read_error
+                if self._reader and error is None:
+                    self._cond.wait(max(deadline - time.time(), 0))
+                    continue
+
+            try:
+                if error is not None:
+                    raise error
+                buf.extend(self.sp.read(self.sp.inWaiting() or 1))
+            except SerialException as e:
+                self._close()
+                raise CommunicationException("Problem reading from serial port %s" %e)
+
+    def _take_unsolicited(self):
+        """
+        Moves unsolicited result codes from buffer to reporting thread
+        """
+
+        buf = self._buffer
+        match = _unsolicited_re.search(buf)
+        while match:
+            code, value = match.group(1, 2) if match.group(1) else match.group(3, 4)
+            if code == "CMTI" and self._list_queued:
+                # Listing already waiting reads this sms too
+                pass
+            elif self._reporter:
+                self._list_queued = code == "CMTI" or self._list_queued
+                self._unsolicited.put((str(code), str(value)))
+            else:
+                self.logger.debug("Ignoring unsolicited %s", code)
+
+            del buf[match.start():match.end()]
+            match = _unsolicited_re.search(buf)
+
+    def _unsolicited_start(self):
+        """
+        Returns where unsolicited result code, still arriving, starts in
+        buffer, or end of buffer if there is none
+        """
+
+        buf = self._buffer
+        partial = _partial_unsolicited_re.search(buf)
+        if partial:
+            return partial.start()
+
+        # Only the start of its first line might have arrived
+        start = buf.rfind("\r\n")
+        if start >= 0 and \
+           any(code.startswith(str(buf[start + 2:])) for code in ("+CDS", "+CMT")):
+            return start
+        if buf.endswith("\r"):
+            return len(buf) - 1
+
+        return len(buf)
+
+    def _start_reader(self):
+        if not self._reporter:
+            self._reporter = threading.Thread(target = self._report_loop)
+            self._reporter.daemon = True
+            self._reporter.start()
+
+        if not self._reader:
+            self._read_error = None
+            self._reader = threading.Thread(target = self._read_loop,
+                                            args = (self.sp,))
+            self._reader.daemon = True
+            self._reader.start()
+
+    def _stop_reader(self):
+        reader, self._reader = self._reader, None
+        if reader and reader is not threading.current_thread():
+            reader.join()
+
+    def _read_loop(self, sp):
+        """
+        Reads serial port while :py:meth:`_stop_reader` is not called
+        """
+
+        while self._reader is threading.current_thread():
+            try:
+                data = sp.read(sp.inWaiting() or 1)
+            except Exception as e:
+                with self._cond:
+                    self._read_error = SerialException(str(e))
+                    self._cond.notify_all()
+                return
+
+            if data:
+                with self._cond:
+                    self._buffer.extend(data)
+                    self._take_unsolicited()
+                    self._cond.notify_all()
+
+    def _report_loop(self):
+        """
+        Handles unsolicited result codes, matching reports to sent sms-es
+        and reading received sms-es
+        """
+
+        while True:
+            item = self._unsolicited.get()
+            if item is None or self._closing.is_set():
+                return
+
+            code, value = item
+            try:
+                if code == "CMTI":
+                    self._list_stored()
+                elif code == "CDSI":
+                    self._handle_pdu(self._read_stored(int(value)))
+                else:
+                    self._handle_pdu(value)
+            except (SmsException, ValueError) as e:
+                self.logger.warning("Problem handling unsolicited %s (%s)",
+                                    code, e)
+
+    def _handle_pdu(self, pdu):
+        if int(_tpdu(pdu)[:2], 16) & 0x03 == 2:
+            self._match_report(*_decode_status_report(pdu))
+        else:
+            self._receive_part(pdu)
+
+    def _list_stored(self):
+        """
+        Reads all sms-es in modem storage, deleting them once handled
+
+        Sms-es are deleted in bulk after they are queued, so while queue is
+        full they wait in modem storage.
+        """
+
+        self._list_queued = False
+        response = self._call(self._prepared_command, "AT+CMGL=4\r")
+        if _final_re.search(response).group(1) != "OK":
+            raise _with_code(CommunicationException("Cannot list messages (%s)"
+                                                    %response.strip()),
+                             response)
+
+        stored = _cmgl_re.findall(response)
+        for index, pdu in stored:
+            try:
+                self._handle_pdu(pdu)
+            except ValueError as e:
+                self.logger.warning("Skipping message %s (%s)", index, e)
+
+        if stored:
+            # Listed sms-es are marked read, only they are deleted
+            self._call(self._ser_send_verify, "AT+CMGD=1,1")
+
+    def _receive_part(self, pdu):
+        """
+        Decodes received sms, keeping parts of long sms until all arrive
+        """
 
-    def _ser_send(self, data):
+        sms = SMS_DELIVER.fromPDU(_tpdu(pdu), "")
+        number = sms.tp_oa
+        if sms.tp_toa & 0x70 == 0x10:
+            number = "+" + number
+        sent = datetime.datetime.strptime(sms.tp_scts[:12], "%y%m%d%H%M%S")
+
+        info = sms.concatInfo()
+        if not info or info['count'] < 2:
+            self._receive(InboundMessage(number, sms.user_data, sent,
+                                         self.sp_name))
+            return
+
+        key = (number, info['ref'], info['count'])
+        arrived, sent, parts = self._parts.setdefault(key,
+                                                      (time.time(), sent, {}))
+        parts[info['seq']] = sms.user_data
+        if len(parts) == info['count']:
+            del self._parts[key]
+            self._receive(InboundMessage(number, self._join(parts), sent,
+                                         self.sp_name))
+
+        # Parts that waited too long are passed on as they are
+        while self._parts:
+            key, (arrived, sent, parts) = next(self._parts.iteritems())
+            if len(self._parts) <= _max_parts and \
+               time.time() - arrived < _part_timeout:
+                break
+
+            del self._parts[key]
+            self._receive(InboundMessage(key[0], self._join(parts), sent,
+                                         self.sp_name, complete = False))
+
+    @staticmethod
+    def _join(parts):
+        texts = [parts[seq] for seq in sorted(parts)]
+        # Text is unicode, while binary data is str
+        return texts[0][:0].join(texts)
+
+    def _receive(self, message):
+        metrics.count("received", provider = type(self).__name__)
+
+        if self.on_message:
+            try:
+                self.on_message(message)
+            except Exception:
+                self.logger.exception("Received message callback failed")
+            return
+
+        # Inbox is full while nobody reads it, so close does not wait for
+        # space, and sms-es listed from storage stay there
+        while not self._closing.is_set():
+            try:
+                return self._inbox.put(message, timeout = 0.1)
+            except Queue.Full:
+                pass
+
+        raise SmsException("Modem closing, sms from %s left unread"
+                           %message.number)
+
+    def listen(self):
+        """
+        Sets modem up, so it starts passing on reports and received sms-es
+        before anything is sent
+
+        :raises: :py:exc:`pysms.sms.SmsException`
+        """
+
+        self._call(self._prepare_modem)
+
+    def received(self, timeout = None):
+        """
+        Iterates over received sms-es as they arrive
+
+        Sms-es are only queued if `on_message` is not set. Queue holds up to
+        1000 sms-es, while it is full the rest wait in modem storage.
+
+        :param timeout: Seconds to wait for next sms, forever if not set
+        :type timeout: float
+
+        :returns: Generator of :py:class:`InboundMessage`, ending when no
+                  sms arrives for `timeout` seconds
+        :raises: :py:exc:`pysms.sms.InputException` if sms-es are not
+                 received or passed to `on_message`,
+                 :py:exc:`pysms.sms.SmsException` if modem can not be set up
+        """
+
+        if not self.receive_messages:
+            raise InputException("Receiving sms-es is not enabled")
+        if self.on_message:
+            raise InputException("Received sms-es are passed to on_message")
+
+        self.listen()
+        return self._received(timeout)
+
+    def _received(self, timeout):
+        while True:
+            try:
+                yield self._inbox.get(timeout = timeout)
+            except Queue.Empty:
+                return
+
+    def _read_stored(self, index):
+        """
+        Reads and deletes pdu modem stored at `index`
+        """
+
+        response = self._call(self._prepared_command, "AT+CMGR=%d\r" %index)
+        match = _cmgr_re.search(response)
+        if not match:
+            raise _with_code(CommunicationException("Cannot read message %d (%s)"
+                                                    %(index, response.strip())),
+                             response)
+        self._call(self._ser_send_verify, "AT+CMGD=%d" %index)
+
+        return match.group(1)
+
+    def _expect(self, references, params):
+        """
+        Registers sent sms, so its delivery reports can be matched to it
+
+        :param references: Message references of all segments
+        :type references: list
+        """
+
+        if not self.delivery_reports or not params['delivery_report'] or \
+           None in references:
+            return
+
+        pending = _Pending(references[0], params, references)
+        now = time.time()
+        early = []
+        with self._pending_lock:
+            for reference in references:
+                if reference in self._pending:
+                    self.logger.debug("Forgetting sms waiting for report %d",
+                                      reference)
+                self._pending[reference] = pending
+
+                arrived, report = self._unmatched.pop(reference, (0, None))
+                if now - arrived < 60:
+                    early.append(report)
+
+        for report in early:
+            self._match_report(*report)
+
+    def _match_report(self, reference, number, accepted, done, status):
+        now = time.time()
+        with self._pending_lock:
+            pending = self._pending.get(reference)
+            if pending is None or pending.params['number'] != number:
+                # Report can be read before send returns its reference
+                self._unmatched[reference] = \
+                    (now, (reference, number, accepted, done, status))
+                return
+
+            report = DeliveryReport(pending.reference, number, status,
+                                    accepted, done, pending.params.get("key"),
+                                    self.sp_name)
+            if report.final:
+                # Long sms is reported once all of its segments are
+                del self._pending[reference]
+                pending.waiting.discard(reference)
+                if not report.delivered and not pending.failed:
+                    pending.failed = report
+                if pending.waiting:
+                    return
+                report = pending.failed or report
+
+        self._report(report)
+
+    def _report(self, report):
+        metrics.count("delivery_reports", provider = type(self).__name__)
+
+        if self.on_report:
+            try:
+                self.on_report(report)
+            except Exception:
+                self.logger.exception("Delivery report callback failed")
+            return
+
+        try:
+            self._reports.put_nowait(report)
+        except Queue.Full:
+            self.logger.warning("Dropping delivery report %r, nobody reads them",
+                                report)
+
+    def reports(self, timeout = None):
+        """
+        Iterates over delivery reports as they arrive
+
+        Reports are only queued if `on_report` is not set.
+
+        :param timeout: Seconds to wait for next report, forever if not set
+        :type timeout: float
+
+        :returns: Generator of :py:class:`DeliveryReport`, ending when no
+                  report arrives for `timeout` seconds
+        """
+
+        while True:
+            try:
+                yield self._reports.get(timeout = timeout)
+            except Queue.Empty:
+                return
+
+    def _ser_send(self, data, prompt = False, timeout = None):
         # if serial port is not opened, open it
         if not self.sp:
             try:
-                self.logger.info("Opening serial port", self.sp_name)
+                self.logger.info("Opening serial port %s", self.sp_name)
                 self.sp = Serial(self.sp_name, timeout = self.timeout)
             except SerialException as e:
                 raise CommunicationException("Problem opening serial port %s" %e)
 
-        self.logger.debug("Sending data over serial", data)
-        self.sp.write(data)
-        time.sleep(self.timeout)
+            self._reset_state()
+
+        # Leftovers of a previous command are of no use anymore, unless
+        # unsolicited result code is still arriving
+        with self._cond:
+            self._take_unsolicited()
+            del self._buffer[:self._unsolicited_start()]
 
+        if isinstance(data, unicode):
+            data = data.encode("ascii")
+
+        provider = type(self).__name__
+        self.logger.debug("Sending data over serial %r", data)
         try:
-            data = "".join([data for data in iter(lambda: self.sp.read(64), '')])
-        except SerialTimeoutException as e:
-            raise CommunicationException("Timeout reading from serial port")
+            with metrics.timed("serial_write", provider = provider):
+                self.sp.write(data)
         except SerialException as e:
-            raise CommunicationException("Problem reading from serial port %s" %e)
+            self._close()
+            raise CommunicationException("Problem writing to serial port %s" %e)
+        metrics.count("serial_bytes_out", len(data), provider = provider)
+
+        try:
+            with metrics.timed("serial_wait", provider = provider):
+                response = self._read_response(prompt, timeout)
+        except CommunicationException:
+            self._reset_state()
+            raise
+        metrics.count("serial_bytes_in", len(response), provider = provider)
+
+        # After an error we can not be sure about modem state anymore
+        final = _final_re.search(response)
+        if final and final.group(1) != "OK":
+            self._reset_state()
+        else:
+            self._last_ok = time.time()
+
+        return response
 
-        return data
+    def _prepared_command(self, data):
+        self._prepare_modem()
+        return self._ser_send(data)
 
     def _ser_send_verify(self, data):
-        if not "OK" in self._ser_send("%s\r" %data):
-            raise CommunicationException("Modem is not ready")
+        response = self._ser_send("%s\r" %data)
+        if not _final_re.search(response).group(1) == "OK":
+            raise _with_code(CommunicationException("Modem is not ready (%s)"
+                                                    %response.strip()),
+                             response)
 
     def send(self, number, text, source_number = None,
-             silent = False, delivery_report = False):
+             silent = False, delivery_report = False, key = None):
         """
         Sends sms
 
+        Transient errors of every segment are retried on their own, so
+        segments modem already acknowledged are not sent again.
+
         .. note::
 
             Changing source number does not work on most providers, but sending
@@ -102,36 +946,417 @@ class GsmModemSms(Sms):
         :type silent: boolean
         :param delivery_report: Should delivery report be received
         :type delivery_report: boolean
+        :param key: Idempotency key, sms with key already sent is not sent
+                    again
+        :type key: str
 
+        :returns: Message reference, of the first segment of a long sms,
+                  which delivery reports refer to
+        :rtype: int
         :raises: :py:exc:`pysms.sms.SmsException`,
                  :py:exc:`pysms.sms.InputException`,
                  :py:exc:`pysms.sms.SendException`,
-                 :py:exc:`pysms.sms.AuthException`,
+                 :py:exc:`pysms.sms.CommunicationException`
         """
 
-        try:
-            params = self.SendSchema().deserialize(locals())
-        except colander.Invalid as e:
-            raise InputException("Problems with input data %s" %e)
+        return self._send(self._validate(locals()))
 
-        if not silent:
-            pdu = SMS_SUBMIT.create(params['source_number'][1:],
-                                    params['number'][1:],
-                                    params['text'],
-                                    tp_pid = 64 if params['silent'] else 0,
-                                    tp_srr = 1 if params['delivery_report'] else 0
-                                   ).toPDU()
+    def _create_pdus(self, params):
+        # Same text sent to many recipients is encoded only once
+        message = self._messages.get(params['text'], PreparedMessage)
+        metrics.count("segments", len(message.user_data),
+                      provider = type(self).__name__)
+
+        return message.pdus(params['number'][1:],
+                            silent = params['silent'],
+                            delivery_report = params['delivery_report'],
+                            reference = next(self._references))
+
+    def _prepare_modem(self):
+        """
+        Sets modem up for sending, skipping steps already done
+
+        Setup is repeated only after reconnect or error response, while
+        modem liveness is probed only when it was quiet for longer than
+        `probe_interval`.
+        """
 
         # Verify modem
-        try:
+        if not self._verified or \
+           time.time() - self._last_ok > self.probe_interval:
             self._ser_send_verify("AT")
-        except SendException as e:
-            raise AuthException("Cannot verify modem (%s)" %e.message)
+            self._verified = True
+            self._last_ok = time.time()
 
-        for x in range(0, self.retries+1):
-            # Go to PDU mode
+        # Go to PDU mode
+        if not self._pdu_mode:
             self._ser_send_verify("AT+CMGF=0")
-            self._ser_send_verify("AT+CMGS=" + str(len(pdu)/2))
-            self._ser_send("00" + pdu + "\x1A")
+            self._pdu_mode = True
+
+        if not self._configured:
+            if self.smsc:
+                self._ser_send_verify('AT+CSCA="%s"' %self.smsc)
+            if self.storage:
+                self._ser_send_verify('AT+CPMS="{0}","{0}","{0}"'.format(self.storage))
+            if self.delivery_reports or self.receive_messages:
+                self._start_reader()
+                # Received sms-es are stored and announced with +CMTI,
+                # status reports are passed on as +CDS, or as +CDSI if
+                # modem can only store them
+                self._ser_send_verify("AT+CNMI=2,%d,0,%d,0"
+                                      %(self.receive_messages,
+                                        self.delivery_reports))
+            self._configured = True
+
+            if self.receive_messages and not self._list_queued:
+                # Sms-es received while nobody was listening
+                self._list_queued = True
+                self._unsolicited.put(("CMTI", None))
+
+    def _submit_pdu(self, pdu):
+        response = self._ser_send("AT+CMGS=%d\r" %(len(pdu)/2), prompt = True)
+        if not _prompt_re.search(response):
+            raise _with_code(CommunicationException("Modem did not prompt for pdu (%s)"
+                                                    %response.strip()),
+                             response)
+
+        response = self._ser_send("00" + pdu + "\x1A")
+        if not _final_re.search(response).group(1) == "OK":
+            raise _with_code(SendException("Error sending sms (%s)"
+                                           %response.strip()),
+                             response)
+
+        match = _cmgs_re.search(response)
+        return int(match.group(1)) if match else None
+
+    def _send(self, params):
+        return self.retry_policy.once(params.get("key"), self._submit, (params,))
+
+    def _submit(self, params):
+        references = [self.retry_policy.run(self._call, (self._send_once, pdu),
+                                            type(self).__name__)
+                      for pdu in self._create_pdus(params)]
+        self._expect(references, params)
+
+        return references[0]
+
+    def _send_once(self, pdu):
+        """
+        Submits pdu once, setting modem up first if needed
+
+        :returns: Message reference modem gave to pdu
+        :rtype: int
+        """
+
+        try:
+            self._prepare_modem()
+            return self._submit_pdu(pdu)
+        except CommunicationException:
+            self._reset_state()
+            raise
+
+    def send_many(self, messages, concurrency = 1):
+        """
+        Sends many sms-es over an already prepared modem
+
+        Modem is set up only once, unless it reports an error, and each pdu
+        is submitted only once, with transient errors retried by
+        :py:attr:`retry_policy`.
+
+        :param messages: Iterable of `(number, text)` tuples or dicts
+        :type messages: iterable
+        :param concurrency: Ignored, serial port handles one sms at a time
+        :type concurrency: int
+
+        :returns: Generator of :py:class:`pysms.sms.SendResult`
+        """
+
+        return _dispatch(self._send, self._validate_many(messages))
+
+class _Task(object):
+    def __init__(self, params):
+        self.params = params
+        self.pdus = None
+        self.attempts = 0
+        self.deadline = None
+        self.ready_at = 0
+        self.value = None
+        self.exception = None
+        self.done = threading.Event()
+
+class _ModemWorker(object):
+    def __init__(self, modem):
+        self.modem = modem
+        self.latency = 0
+        self.idle = True
+        self.quarantined_until = 0
+
+    @property
+    def healthy(self):
+        return not self.quarantined_until
+
+class GsmModemPool(Sms):
+    """
+    Send sms-es using many gsm modems
+
+    Every modem gets its own worker thread, all feeding from a shared queue.
+    Faster modems get the first pick of waiting sms-es, based on observed
+    per-sms latency, so slow modems only help when there is enough backlog.
+    Modem failing with :py:exc:`pysms.sms.CommunicationException` is put in
+    quarantine, and modem is probed again after `quarantine` seconds. Sms
+    failing with an error :py:attr:`retry_policy` finds transient, like
+    that or a temporary `+CMS ERROR`, is given to the next available modem
+    after policy's backoff. Long sms, of which modem already submitted some
+    segments, fails instead, as the rest sent from another modem could not
+    be put together with them. While no modem is healthy, every failed
+    probe uses up a retry of waiting sms-es, and those out of retries fail
+    with :py:exc:`pysms.sms.SendException`.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    SendSchema = GsmModemSms.SendSchema
+
+    def __init__(self, modems, retries = 2, quarantine = 60, smoothing = 0.2,
+                 limiter = None, retry_policy = None):
+        """
+        Constructor
+
+        :param modems: List of serial port names or
+                       :py:class:`GsmModemSms` instances
+        :type modems: list
+        :param retries: Number of retries, each on next available modem
+        :type retries: int
+        :param quarantine: Seconds modem is out of rotation after failure
+        :type quarantine: float
+        :param smoothing: Weight of last sms in moving latency average
+        :type smoothing: float
+        :param limiter: Rate limiter applied to every modem
+        :type limiter: :py:class:`pysms.ratelimit.RateLimiter`
+        :param retry_policy: Policy of retrying sms-es, overrides `retries`
+        :type retry_policy: :py:class:`pysms.sms.RetryPolicy`
+        """
+
+        self.retries = self.InitSchema().deserialize(locals())["retries"]
+        self.retry_policy = retry_policy or RetryPolicy(self.retries)
+        self.quarantine = quarantine
+        self.smoothing = smoothing
+        self.limiter = limiter
+
+        self.workers = []
+        for modem in modems:
+            if not isinstance(modem, GsmModemSms):
+                modem = GsmModemSms(sp_name = modem)
+            self.workers.append(_ModemWorker(modem))
+
+        self._tasks = deque()
+        self._cond = threading.Condition()
+        self._running = True
+
+        self._threads = [threading.Thread(target = self._run, args = (worker,))
+                         for worker in self.workers]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """Stops workers and closes serial ports"""
+
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        for worker in self.workers:
+            worker.modem.close()
+
+    def _should_take(self, worker, ready):
+        # Faster idle modems get the first pick
+        faster = sum(1 for other in self.workers
+                     if other is not worker and other.idle and other.healthy
+                     and other.latency < worker.latency)
+
+        return ready > faster
+
+    def _next(self, worker):
+        with self._cond:
+            while self._running:
+                now = time.time()
+                # Retried tasks wait for their backoff
+                ready = [task for task in self._tasks if task.ready_at <= now]
+
+                if not worker.healthy:
+                    wait = worker.quarantined_until - now
+                    if wait <= 0:
+                        return None
+                elif ready and self._should_take(worker, len(ready)):
+                    worker.idle = False
+                    self._tasks.remove(ready[0])
+                    return ready[0]
+                elif len(ready) < len(self._tasks):
+                    wait = min(task.ready_at for task in self._tasks) - now
+                else:
+                    wait = None
+
+                self._cond.wait(min(wait or 1, 1))
+
+    def _probe(self, worker):
+        try:
+            worker.modem._call(worker.modem._ser_send_verify, "AT")
+        except Exception as e:
+            self.logger.info("Modem %s still not responding (%s)",
+                             worker.modem.sp_name, e)
+            with self._cond:
+                worker.quarantined_until = time.time() + self.quarantine
+                if not any(other.healthy for other in self.workers):
+                    self._expire(e)
+            return
+
+        self.logger.info("Modem %s back in rotation", worker.modem.sp_name)
+        with self._cond:
+            worker.quarantined_until = 0
+            self._cond.notify_all()
+
+    def _expire(self, exception):
+        # Waiting for a modem counts as failed attempt, so callers do not
+        # wait forever when all modems are gone
+        now = time.time()
+        for task in list(self._tasks):
+            delay = self.retry_policy.next_delay(
+                CommunicationException(str(exception)), task.attempts,
+                task.deadline)
+            task.attempts += 1
+
+            if delay is None:
+                self._tasks.remove(task)
+                task.exception = SendException("No modem available (%s)"
+                                               %exception)
+                task.done.set()
+            else:
+                task.ready_at = max(task.ready_at, now + delay)
+
+    def _run(self, worker):
+        while True:
+            task = self._next(worker)
+            if task is None:
+                if not self._running:
+                    return
+                self._probe(worker)
+                continue
+
+            if self.limiter:
+                self.limiter.acquire(worker.modem)
+
+            if task.attempts:
+                metrics.count("retry", provider = type(self).__name__)
+
+            start = time.time()
+            references = []
+            try:
+                task.attempts += 1
+                # All segments go through the same modem, or recipient
+                # could not put them together
+                for pdu in task.pdus:
+                    references.append(
+                        worker.modem._call(worker.modem._send_once, pdu))
+            except Exception as e:
+                # Any error completes task, so its caller does not hang
+                if not isinstance(e, SmsException):
+                    self.logger.exception("Error sending over modem %s",
+                                          worker.modem.sp_name)
+                self._report(worker, e)
+                if references or not isinstance(e, SmsException):
+                    delay = None
+                else:
+                    delay = self.retry_policy.next_delay(e, task.attempts - 1,
+                                                         task.deadline)
+
+                with self._cond:
+                    if isinstance(e, CommunicationException):
+                        self.logger.warning("Modem %s failed, quarantining "
+                                            "it (%s)", worker.modem.sp_name, e)
+                        worker.quarantined_until = time.time() + self.quarantine
+                    else:
+                        worker.latency += self.smoothing * \
+                                          (time.time() - start - worker.latency)
+                    worker.idle = True
+
+                    if delay is None:
+                        task.exception = e
+                        task.done.set()
+                    else:
+                        self.logger.info("Retrying in %.3fs (%s)", delay, e)
+                        task.ready_at = time.time() + delay
+                        self._tasks.appendleft(task)
+                    self._cond.notify_all()
+                continue
+            else:
+                self._report(worker)
+                try:
+                    worker.modem._expect(references, task.params)
+                except Exception:
+                    # Sms is sent, only its delivery reports are not matched
+                    self.logger.exception("Error registering sms %s",
+                                          references[0])
+                task.value = references[0]
+
+            with self._cond:
+                worker.latency += self.smoothing * (time.time() - start - worker.latency)
+                worker.idle = True
+                self._cond.notify_all()
+
+            task.done.set()
+
+    def _report(self, worker, exception = None):
+        if self.limiter:
+            self.limiter.report(worker.modem, exception)
+
+    def _send(self, params):
+        return self.retry_policy.once(params.get("key"), self._submit,
+                                      (params,))
+
+    def _submit(self, params):
+        task = _Task(params)
+        task.pdus = self.workers[0].modem._create_pdus(params)
+        deadline = self.retry_policy.deadline
+        task.deadline = deadline and time.time() + deadline
+
+        with self._cond:
+            self._tasks.append(task)
+            self._cond.notify_all()
+
+        task.done.wait()
+        if task.exception is not None:
+            raise task.exception
+
+        return task.value
+
+    def send(self, number, text, source_number = None,
+             silent = False, delivery_report = False, key = None):
+        """
+        Sends sms over the next available modem
+
+        See :py:meth:`GsmModemSms.send` for parameters. Message reference
+        is only unique per modem, so delivery reports are collected by
+        modems, and :py:attr:`DeliveryReport.account` tells which one sent
+        the sms.
+        """
+
+        return self._send(self._validate(locals()))
+
+    def send_many(self, messages, concurrency = None):
+        """
+        Sends many sms-es spread over all modems
+
+        :param messages: Iterable of `(number, text)` tuples or dicts
+        :type messages: iterable
+        :param concurrency: Maximal number of sms-es queued or in flight,
+                            defaults to twice the number of modems
+        :type concurrency: int
+
+        :returns: Generator of :py:class:`pysms.sms.SendResult`
+        """
 
-        return float('inf')
+        return Sms.send_many(self, messages,
+                             concurrency or 2 * len(self.workers))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: memory.py
+   :platform: Unix, Windows
+   :synopsis: Loopback provider keeping sms-es in memory, for load testing
+"""
+
+import time, logging
+import random
+import threading
+
+from collections import deque, Counter
+
+from pysms import Sms, segment_count
+from pysms import SmsException, SendException, RetryPolicy
+
+class MemorySms(Sms):
+    """
+    Loopback provider, which only records sms-es in memory
+
+    Meant for load testing code around pysms without sending anything.
+    Sending takes time drawn from `latency`, fails with configured rates
+    of injected exceptions and charges balance one sms per segment, raising
+    :py:exc:`pysms.sms.SendException` once balance runs out.
+
+    Only the last `record` sms-es are kept as `(number, text)` tuples in
+    :py:attr:`messages`, so memory stays bounded however many are sent,
+    while :py:attr:`sent`, :py:attr:`segments` and :py:attr:`failed` count
+    all of them.
+
+    Example::
+
+        sms = MemorySms(latency = lambda: random.expovariate(50),
+                        errors = {CommunicationException: 0.01},
+                        balance = 100000)
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, latency = 0, balance = float('inf'), errors = None,
+                 record = 10000, capabilities = None, seed = None,
+                 retry_policy = None):
+        """
+        Constructor
+
+        :param latency: Seconds a send takes, or function returning them,
+                        like `lambda: random.gauss(0.05, 0.01)`
+        :type latency: float or callable
+        :param balance: Number of sms segments that can be sent
+        :type balance: int
+        :param errors: Map of :py:exc:`pysms.sms.SmsException` subclasses
+                       to rates of sends failing with them
+        :type errors: dict
+        :param record: Number of last sms-es kept in :py:attr:`messages`
+        :type record: int
+        :param capabilities: Capabilities of provider being simulated
+        :param seed: Seed of random generator choosing failed sends
+        :type seed: int
+        :param retry_policy: Policy remembering idempotency keys, failed
+                             sends are not retried by default
+        :type retry_policy: :py:class:`pysms.sms.RetryPolicy`
+
+        :raises: :py:exc:`ValueError` if error rates are invalid
+        """
+
+        self.latency = latency
+        self.capabilities = capabilities
+
+        # Cumulative rates, so a single random draw picks the exception
+        self._errors = []
+        total = 0
+        for exception, rate in sorted((errors or {}).items(),
+                                      key = lambda item: item[0].__name__):
+            if not issubclass(exception, SmsException) or rate < 0:
+                raise ValueError("Invalid error rate %r of %r"
+                                 %(rate, exception))
+            total += rate
+            self._errors.append((total, exception))
+        if total > 1:
+            raise ValueError("Error rates add up to more than 1")
+
+        self.retry_policy = retry_policy or RetryPolicy(retries = 0)
+
+        self._random = random.Random(seed)
+        self._balance = balance
+        self._lock = threading.Lock()
+
+        self.messages = deque(maxlen = record)
+        """Last sent sms-es as `(number, text)` tuples"""
+        self.sent = 0
+        """Number of sent sms-es"""
+        self.segments = 0
+        """Number of sent sms segments"""
+        self.failed = Counter()
+        """Number of failed sends by exception name"""
+
+    @property
+    def account(self):
+        return "memory-%x" %id(self)
+
+    @property
+    def balance(self):
+        """
+        Sms segments left
+
+        returns: Balance
+        :rtype: int
+        """
+
+        return self._balance
+
+    def clear(self):
+        """
+        Forgets recorded sms-es and resets counters
+        """
+
+        with self._lock:
+            self.messages.clear()
+            self.sent = 0
+            self.segments = 0
+            self.failed.clear()
+
+    def send(self, number, text, key = None):
+        """
+        Records sms
+
+        :param number: Number where sms should be sent
+        :type number: str
+        :param text: Text you want to send
+        :type text: str
+        :param key: Idempotency key, sms with key already sent is not sent
+                    again
+        :type key: str
+
+        :returns: Balance
+        :rtype: int
+        :raises: :py:exc:`pysms.sms.SendException` when out of balance,
+                 :py:exc:`pysms.sms.InputException`,
+                 injected :py:exc:`pysms.sms.SmsException`
+        """
+
+        return self._send(self._validate(locals()))
+
+    def _fail(self, exception):
+        with self._lock:
+            self.failed[type(exception).__name__] += 1
+        raise exception
+
+    def _send(self, params):
+        return self.retry_policy.once(params.get("key"), self._submit,
+                                      (params,))
+
+    def _submit(self, params):
+        return self.retry_policy.run(self._record, (params,),
+                                     type(self).__name__)
+
+    def _record(self, params):
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+        if self._errors:
+            draw = self._random.random()
+            for limit, exception in self._errors:
+                if draw < limit:
+                    self._fail(exception("Injected %s" %exception.__name__))
+
+        number, text = params["number"], params["text"]
+        segments = segment_count(text)
+        with self._lock:
+            if self._balance >= segments:
+                self._balance -= segments
+                self.sent += 1
+                self.segments += segments
+                self.messages.append((number, text))
+                return self._balance
+
+        self._fail(SendException("Out of balance"))
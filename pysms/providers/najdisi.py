@@ -5,8 +5,8 @@
    :synopsis: Sends sms-es using http://www.najdi.si/> service
 """
 
-import logging
-import re, urllib, json
+import time, logging, threading
+import re, urllib, urlparse, json
 import six
 import mechanize
 import colander
@@ -14,10 +14,140 @@ import colander
 from colander import SchemaNode
 from colander import String
 
-from pysms import Sms, prepare_number
+from pysms import Sms, AsyncSms, RetryPolicy, NumberCache, prepare_number, \
+                  coroutine, Return
+from pysms import metrics
+from pysms.sms import _dispatch
+from pysms.transport import AsyncHttpClient, HttpTransport
+from pysms.session import SessionStore, dump_cookies, load_cookies
 from pysms import SmsException, CommunicationException, AuthException, \
                   SendException, ResponseException
 
+_session_re = re.compile(r'sms_so_l_(\d+)')
+_balance_re = re.compile(r'<strong id="sms_left" name="sms_left">\s?(\d+)\s?/\s?(\d+)\s?</strong>')
+_msg_left_re = re.compile(r'"msg_left"\s*:\s*"?(\d+)')
+
+# Marks idempotency key that was not acknowledged yet
+_missing = object()
+
+def _scan_session_page(resp, chunk_size = 8192, overlap = 256):
+    """
+    Reads session page only until session id and balance are found
+
+    Page is read in chunks and each chunk is searched once, with the end
+    of previous chunk prepended, so matches spanning chunks are found.
+
+    :param resp: File like response
+    :param chunk_size: Bytes read at once
+    :type chunk_size: int
+    :param overlap: Bytes of previous chunk searched again, must be longer
+                    than any match
+    :type overlap: int
+
+    :returns: Tuple of session id and balance, None for values not found
+    :rtype: tuple
+    """
+
+    session = balance = None
+    data = ""
+    while session is None or balance is None:
+        chunk = resp.read(chunk_size)
+        if not chunk:
+            break
+        data = data[-overlap:] + chunk
+
+        if session is None:
+            match = _session_re.search(data)
+            # Session id could continue in the next chunk
+            if match and match.end() < len(data):
+                session = match.group(1)
+        if balance is None:
+            match = _balance_re.search(data)
+            if match:
+                balance = int(match.group(2)) - int(match.group(1))
+
+    if session is None:
+        match = _session_re.search(data[-overlap:])
+        if match:
+            session = match.group(1)
+
+    return session, balance
+
+def _parse_msg_left(body):
+    """
+    Extracts balance from json response to a send
+
+    :raises: :py:exc:`pysms.sms.ResponseException`
+    """
+
+    match = _msg_left_re.search(body)
+    if match:
+        return int(match.group(1))
+
+    # Only tell apart broken json from unexpected one
+    try:
+        json.loads(body)
+    except ValueError as e:
+        raise ResponseException("Error parsing response %s... %s" %(body[0:100], e))
+    raise ResponseException("Incorrect response %s..." %body[0:100])
+
+class _NoHistory(mechanize._mechanize.History):
+    """
+    Browser history keeping no responses, login never goes back
+    """
+
+    def add(self, request, response):
+        pass
+
+class _LockedCookieJar(mechanize.CookieJar):
+    """
+    Cookie jar shared by browser logging in and transport sending from many
+    threads
+
+    :py:attr:`version` changes whenever cookies do, so they are only saved
+    when needed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        mechanize.CookieJar.__init__(self, *args, **kwargs)
+        self._lock = threading.RLock()
+        self.version = 0
+
+    def add_cookie_header(self, request):
+        with self._lock:
+            mechanize.CookieJar.add_cookie_header(self, request)
+
+    def extract_cookies(self, response, request):
+        with self._lock:
+            mechanize.CookieJar.extract_cookies(self, response, request)
+
+    def set_cookie(self, cookie):
+        with self._lock:
+            old = self._cookies.get(cookie.domain, {}) \
+                               .get(cookie.path, {}).get(cookie.name)
+            # Servers often set the same cookie again with every response
+            if old is None or (old.value, old.expires) != \
+                              (cookie.value, cookie.expires):
+                self.version += 1
+            mechanize.CookieJar.set_cookie(self, cookie)
+
+    def clear(self, *args):
+        with self._lock:
+            mechanize.CookieJar.clear(self, *args)
+            self.version += 1
+
+    def clear_session_cookies(self):
+        with self._lock:
+            mechanize.CookieJar.clear_session_cookies(self)
+
+    def clear_expired_cookies(self):
+        with self._lock:
+            mechanize.CookieJar.clear_expired_cookies(self)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(mechanize.CookieJar.__iter__(self)))
+
 class NajdiSiSms(Sms):
     """
     Send free sms-es using `www.najdi.si <http://www.najdi.si/>`_ service
@@ -37,6 +167,10 @@ class NajdiSiSms(Sms):
     Go `here <https://id.najdi.si/account/signupwizard/>`_ to register and enter
     relevant user data. Sms will be sent to your phone for confirmation.
     You will need working username and password to use this class.
+
+    A single instance can be used from many threads. They share one session,
+    which only one of them logs in for, while sms-es are sent concurrently
+    over pooled connections of :py:class:`pysms.transport.HttpTransport`.
     """
 
     logger = logging.getLogger(__name__)
@@ -58,8 +192,12 @@ class NajdiSiSms(Sms):
         number = SchemaNode(String(),
                             preparer = lambda n: prepare_number(n, 'SI'),
                             validator = colander.Length(1, 12))
+        # Web form sends a single sms, without splitting
+        text = SchemaNode(String(), validator = colander.Length(0, 160))
 
-    def __init__(self, username, password, retries = 2):
+    def __init__(self, username, password, retries = 2, session_file = None,
+                 transport = None, keepalive = None, balance_ttl = None,
+                 retry_policy = None):
         """
         Constructor
 
@@ -69,43 +207,213 @@ class NajdiSiSms(Sms):
         :type password: str
         :param retries: Number of retries
         :type retries: int
+        :param session_file: Optional file where session is stored, so it
+                             can be reused after restart or by other processes
+        :type session_file: str
+        :param transport: Transport used to send sms-es, defaults to
+                          :py:class:`pysms.transport.HttpTransport` sharing
+                          cookies with browser used to log in
+        :param keepalive: If set, session is kept alive by a background
+                          thread, which logs in right away and refreshes
+                          session when it was idle for this many seconds,
+                          so sends do not log in themselves
+        :type keepalive: float
+        :param balance_ttl: Seconds balance is served from cache before it
+                            is refreshed, forever by default
+        :type balance_ttl: float
+        :param retry_policy: Policy of retrying sends, overrides `retries`
+        :type retry_policy: :py:class:`pysms.sms.RetryPolicy`
         """
 
         self.__dict__.update(self.InitSchema().deserialize(locals()))
+        self.keepalive = keepalive
+        self.balance_ttl = balance_ttl
+        self.retry_policy = retry_policy or RetryPolicy(self.retries)
 
-        self.br = mechanize.Browser()
+        self.cookiejar = _LockedCookieJar()
+        self.br = mechanize.Browser(history = _NoHistory())
         self.br.set_handle_robots(False)
+        self.br.set_cookiejar(self.cookiejar)
+
+        self.transport = transport or HttpTransport(self.cookiejar)
 
         self._session = None
+        self._stale = None
         self._balance = 0
+        # When session was last known to be alive and balance was updated
+        self._session_time = 0
+        self._balance_time = 0
+        # Browser is used by one thread at a time, so logins are not repeated
+        self._login_lock = threading.RLock()
+        # Version of cookie jar last saved to store
+        self._saved_version = 0
+
+        self.store = SessionStore(session_file) if session_file else None
+        self._load_session()
+
+        self._keeper = None
+        if keepalive:
+            self._keeper = _SessionKeeper(self, keepalive)
+            self._keeper.start()
+
+    def close(self):
+        """
+        Stops background session keeper, if any
+        """
+
+        if self._keeper:
+            self._keeper.stop()
+
+    @property
+    def account(self):
+        return self.username
+
+    def _load_session(self, stale = None):
+        """
+        Loads session from store, unless it is the same as a stale one
+
+        Stored session is not validated here, it is simply used and if sending
+        fails we log in again.
+
+        :param stale: Session id known not to work anymore
+        :type stale: str
+
+        :returns: Whether session was loaded
+        :rtype: bool
+        """
+
+        if not self.store:
+            return False
+
+        data = self.store.load()
+        if not data or data.get("username") != self.username \
+           or not data.get("session") or data["session"] == stale:
+            return False
+
+        self.cookiejar.clear()
+        load_cookies(self.cookiejar, data["cookies"], mechanize.Cookie)
+        self._session = data["session"]
+        self._balance = data["balance"]
+        self._saved_version = self.cookiejar.version
+
+        self.logger.info("Loaded session %s from store", self._session)
+        return True
+
+    def _save_session(self):
+        """
+        Saves session and cookies to store
+
+        Called after login and refresh. Sends only save when they changed
+        cookies, as writing the store on every send would serialize all of
+        them on disk syncs. Balance of store can therefore be behind, until
+        the first send after warm start updates it.
+        """
+
+        if not self.store or not self._session:
+            return
 
-    def _parse_balance(self, resp):
-        match = re.search('<strong id="sms_left" name="sms_left">\s?(\d+)\s?/\s?(\d+)\s?</strong>',
-                          resp)
+        self._saved_version = self.cookiejar.version
+        self.store.save({"username": self.username,
+                         "session": self._session,
+                         "balance": self._balance,
+                         "cookies": dump_cookies(self.cookiejar)})
+
+    @staticmethod
+    def _parse_balance(resp):
+        match = _balance_re.search(resp)
         if not match:
             raise ResponseException("Could not parse balance")
 
         return int(match.group(2)) - int(match.group(1))
 
+    def _balance_fresh(self):
+        return self.balance_ttl is None or \
+               time.time() - self._balance_time < self.balance_ttl
+
     @property
     def balance(self):
         """
         Balance in form of sms-es left
 
+        Balance is cached for `balance_ttl` seconds. With session keeper,
+        stale balance is refreshed in background and cached value is
+        returned right away.
+
         returns: Balance
         :rtype: int
         """
 
-        if not self._balance:
-            self._login()
+        if self._keeper:
+            if not self._session:
+                self._keeper.wait()
+            elif not self._balance_fresh():
+                self._keeper.refresh()
+            return self._balance
+
+        with self._login_lock:
+            if not self._balance:
+                self._login()
+            elif not self._balance_fresh():
+                if not (self._session and self._refresh()):
+                    self._login()
 
         return self._balance
 
+    def _refresh(self):
+        """
+        Reloads session page, which keeps session alive and updates balance
+
+        :returns: Whether session is still valid
+        :rtype: bool
+        """
+
+        with self._login_lock, \
+             metrics.timed("refresh", provider = type(self).__name__):
+            try:
+                resp = self.br.open_novisit(self.session_url)
+            except mechanize.URLError as e:
+                raise CommunicationException("Error in communication with service %s" %e)
+
+            if resp.geturl() == self.login_url:
+                resp.close()
+                return False
+            session, balance = self._read_session_page(resp)
+
+        if session is None:
+            return False
+        if balance is None:
+            raise ResponseException("Could not parse balance")
+
+        self._session = session
+        self._balance = balance
+        self._session_time = self._balance_time = time.time()
+        self._save_session()
+
+        return True
+
+    def _read_session_page(self, resp):
+        """
+        Reads session id and balance from session page, then closes it
+
+        :returns: Tuple of session id and balance, None for values not found
+        :rtype: tuple
+        """
+
+        try:
+            return _scan_session_page(resp)
+        finally:
+            resp.close()
+
     def _login(self):
+        with self._login_lock, \
+             metrics.timed("login", provider = type(self).__name__):
+            self._do_login()
+
+    def _do_login(self):
         # We have to log out first to provide consistency,
         # najdi.si has some wierd bugs
         try:
-            self.br.open(self.logout_url)
+            self.br.open_novisit(self.logout_url).close()
             resp = self.br.open(self.login_url)
 
             try:
@@ -119,21 +427,27 @@ class NajdiSiSms(Sms):
             except mechanize._form.ControlNotFoundError as e:
                 raise ResponseException("Error getting username and password form inputs %s" %e)
 
-            resp = self.br.submit()
-            resp = self.br.open(self.session_url)
+            self.br.submit()
+            resp = self.br.open_novisit(self.session_url)
 
-        except mechanize._response.response_seek_wrapper as e:
+        except mechanize.URLError as e:
             raise CommunicationException("Error in communication with service %s" %e)
 
         if resp.geturl() == self.login_url:
+            resp.close()
             raise AuthException("Error logging in, incorrect username or password")
 
-        match = re.search('sms_so_l_(\d+)', resp.get_data())
-        if not match:
+        session, balance = self._read_session_page(resp)
+        if session is None:
             raise ResponseException("Error getting session id, sms_so_l_(\d+) not found")
+        if balance is None:
+            raise ResponseException("Could not parse balance")
 
-        self._balance = self._parse_balance(resp.get_data())
-        self._session = match.group(1)
+        self._balance = balance
+        self._session = session
+        self._session_time = self._balance_time = time.time()
+
+        self._save_session()
 
     def _send_sms( self, session, prefix, number, data ):
         quoted = urllib.quote(data) if six.PY3 else urllib.quote(data.encode("utf-8"))
@@ -143,27 +457,27 @@ class NajdiSiSms(Sms):
                                    data = quoted)
 
         try:
-            resp = self.br.open(url)
-        except mechanize._response.response_seek_wrapper as e:
+            with metrics.timed("http", provider = type(self).__name__):
+                resp = self.transport.open(url)
+        except CommunicationException as e:
             raise CommunicationException("Error sending sms (%s)" %e)
 
-        try:
-            data = json.loads(resp.get_data())
-        except ValueError as e:
-            raise ResponseException("Error parsing response %s... %s" %(data[0:100], e))
-        if not data.has_key("msg_left"):
-            raise ResponseException("Incorrect response %s..." %data[0:100])
-
-        self._balance = int(data["msg_left"])
+        self._balance = _parse_msg_left(resp.body)
+        self._session_time = self._balance_time = time.time()
 
-    def send(self, number, text):
+    def send(self, number, text, key = None):
         """
         Sends sms
 
+        Transient errors are retried with a new session.
+
         :param number: Number where sms should be sent
         :type number: str
         :param text: Text you want to send
         :type text: str
+        :param key: Idempotency key, sms with key already sent is not sent
+                    again
+        :type key: str
 
         :returns: Balance
         :rtype: int
@@ -174,36 +488,630 @@ class NajdiSiSms(Sms):
                  :py:exc:`pysms.sms.ResponseException`
         """
 
-        options = self.SendSchema().deserialize(locals())
+        balance = self._send(self._validate(locals()))
+        if self.cookiejar.version != self._saved_version:
+            self._save_session()
+
+        return balance
+
+    def _send(self, options):
+        number = options["number"]
+        text = options["text"]
+
+        self.logger.info("Sms with number %s and text %s", number, text)
+
+        return self.retry_policy.once(options.get("key"), self._submit,
+                                      (number, text))
+
+    def _submit(self, number, text):
+        self.retry_policy.run(self._attempt, (number, text),
+                              type(self).__name__)
+
+        self.logger.info("Sms sent")
+        return self._balance
+
+    def _attempt(self, number, text):
+        session = self._session
+        try:
+            session = self._get_session()
+
+            self.logger.info("Sending sms")
+            self._send_sms(session, number[4:6], number[6:], text )
+        except SmsException:
+            # Session could be the cause, so it is not used again, unless
+            # another thread already replaced it
+            with self._login_lock:
+                if self._session == session:
+                    self._stale = session or self._stale
+                    self._session = None
+            raise
+
+    def _get_session(self):
+        """
+        Returns current session, logging in if there is none
+
+        Threads needing a session at the same time wait for the one logging
+        in, instead of logging in again.
+
+        :raises: :py:exc:`pysms.sms.SendException` if out of balance
+        """
+
+        session = self._session
+        if session:
+            metrics.count("session_reuse", provider = type(self).__name__)
+            return session
+
+        with self._login_lock:
+            if self._session or self._load_session(self._stale):
+                metrics.count("session_reuse", provider = type(self).__name__)
+                return self._session
+
+            if not self._keeper:
+                self.logger.debug("We are not yet logged in")
+                self._login()
+                self.logger.info("Login complete")
+
+        if self._keeper:
+            self.logger.debug("Waiting for session keeper")
+            self._keeper.wait()
+
+        if not self._balance:
+            self.logger.info("Out of balance")
+            raise SendException("Out of balance")
+
+        return self._session
+
+    def _send_batched(self, options):
+        # Session is still valid, but account is out of balance, so there is
+        # no point in logging in again for every remaining message
+        if self._session and not self._balance:
+            raise SendException("Out of balance")
+
+        return self._send(options)
+
+    def send_many(self, messages, concurrency = 1):
+        """
+        Sends many sms-es over a single session
+
+        Once account runs out of balance remaining sms-es fail without
+        logging in again.
+
+        :param messages: Iterable of `(number, text)` tuples or dicts
+        :type messages: iterable
+        :param concurrency: Maximal number of sms-es sent at once
+        :type concurrency: int
+
+        :returns: Generator of :py:class:`pysms.sms.SendResult`
+        """
+
+        for result in _dispatch(self._send_batched,
+                                self._validate_many(messages), concurrency):
+            yield result
+
+        if self.cookiejar.version != self._saved_version:
+            self._save_session()
+
+class _SessionKeeper(threading.Thread):
+    """
+    Thread keeping session of :py:class:`NajdiSiSms` alive
+
+    Logs in whenever there is no session and reloads session page once
+    session was idle for `interval` seconds, or when stale balance is
+    requested. Failed logins are retried after `retry_interval` seconds,
+    and until then sends waiting for session fail with the same error.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, sms, interval, retry_interval = 30, timeout = 60):
+        threading.Thread.__init__(self, name = "najdisi-keeper-%s" %sms.username)
+        self.daemon = True
+
+        self.sms = sms
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+
+        self.attempts = 0
+        self.error = None
+        self.failed_at = 0
+
+        self._cond = threading.Condition()
+        self._running = True
+        self._refresh = False
+
+    def _delay(self):
+        # Seconds until there is something to do
+        if not self.sms._session:
+            return self.failed_at + self.retry_interval - time.time()
+        if self._refresh:
+            return 0
+
+        return self.sms._session_time + self.interval - time.time()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and self._delay() > 0:
+                    self._cond.wait(self._delay())
+                if not self._running:
+                    return
+                self._refresh = False
+
+            self._keep()
+
+    def _keep(self):
+        sms = self.sms
+        try:
+            if not (sms._session and sms._refresh()):
+                self.logger.info("Logging in %s", sms.username)
+                sms._login()
+        except Exception as e:
+            self.logger.warning("Keeping session of %s failed (%s)",
+                                sms.username, e)
+            if not isinstance(e, SmsException):
+                e = CommunicationException("Error keeping session (%s)" %e)
+
+            with self._cond:
+                sms._session = None
+                self.attempts += 1
+                self.error = e
+                self.failed_at = time.time()
+                self._cond.notify_all()
+            return
+
+        with self._cond:
+            self.attempts += 1
+            self.error = None
+            self._cond.notify_all()
+
+    def refresh(self):
+        """Asks keeper to refresh session, without waiting for it"""
+
+        with self._cond:
+            self._refresh = True
+            self._cond.notify_all()
+
+    def wait(self):
+        """
+        Waits until keeper logs in
+
+        :raises: Exception of failed login,
+                 :py:exc:`pysms.sms.CommunicationException` on timeout
+        """
+
+        deadline = time.time() + self.timeout
+        with self._cond:
+            attempts = self.attempts
+            while not self.sms._session:
+                # Login failed while we waited, or it failed recently and
+                # keeper is not going to try again yet
+                if self.error and (self.attempts != attempts or
+                   time.time() - self.failed_at < self.retry_interval):
+                    raise self.error
+
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running:
+                    raise CommunicationException("Timeout waiting for login")
+
+                self._cond.notify_all()
+                self._cond.wait(remaining)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        if self is not threading.current_thread():
+            self.join()
+
+class _PoolAccount(object):
+    def __init__(self, provider):
+        self.provider = provider
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.disabled_until = 0
+        self.probe = True
+
+    @property
+    def score(self):
+        # Accounts with unknown balance are tried first, so we learn it
+        balance = float('inf') if self.probe else self.provider._balance
+        return (balance - self.in_flight, -self.in_flight)
+
+class NajdiSiPool(Sms):
+    """
+    Send free sms-es using many `www.najdi.si <http://www.najdi.si/>`_
+    accounts
+
+    Every sms is routed to the account with the most remaining balance and
+    the fewest sends in flight, every account keeping its own session.
+    Accounts which run out of balance or fail to authenticate are taken out
+    of rotation for `cooldown` seconds and then tried again.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    SendSchema = NajdiSiSms.SendSchema
+
+    def __init__(self, accounts, retries = 2, cooldown = 3600, limiter = None,
+                 retry_policy = None):
+        """
+        Constructor
+
+        :param accounts: List of `(username, password)` tuples or
+                         :py:class:`NajdiSiSms` instances
+        :type accounts: list
+        :param retries: Number of retries per account
+        :type retries: int
+        :param cooldown: Seconds account is out of rotation after failure
+        :type cooldown: float
+        :param limiter: Rate limiter applied to every account
+        :type limiter: :py:class:`pysms.ratelimit.RateLimiter`
+        :param retry_policy: Policy of retrying sends, shared by accounts
+                             given as tuples, overrides `retries`
+        :type retry_policy: :py:class:`pysms.sms.RetryPolicy`
+        """
+
+        self.retries = self.InitSchema().deserialize(locals())["retries"]
+        self.cooldown = cooldown
+        self.limiter = limiter
+        self.retry_policy = retry_policy or RetryPolicy(self.retries)
+
+        self.accounts = []
+        for account in accounts:
+            if not isinstance(account, NajdiSiSms):
+                username, password = account
+                account = NajdiSiSms(username, password, retries,
+                                     retry_policy = self.retry_policy)
+            self.accounts.append(_PoolAccount(account))
+
+        self._acknowledged = NumberCache(maxsize = 10000)
+
+        self._lock = threading.Lock()
+
+    @property
+    def balance(self):
+        """
+        Sum of known balances of accounts in rotation
+
+        returns: Balance
+        :rtype: int
+        """
+
+        now = time.time()
+        return sum(account.provider._balance for account in self.accounts
+                   if account.disabled_until <= now)
+
+    def _acquire(self, tried):
+        with self._lock:
+            now = time.time()
+            accounts = [account for account in self.accounts
+                        if account.disabled_until <= now
+                        and account not in tried]
+            if not accounts:
+                return None
+
+            account = max(accounts, key = lambda account: account.score)
+            account.in_flight += 1
+
+            return account
+
+    def _release(self, account, disable = False):
+        with self._lock:
+            account.in_flight -= 1
+            account.probe = False
+
+            if disable:
+                self.logger.info("Taking account %s out of rotation",
+                                 account.provider.username)
+                account.disabled_until = time.time() + self.cooldown
+                account.provider._session = None
+                account.probe = True
+
+    def send(self, number, text, key = None):
+        """
+        Sends sms using the best available account
+
+        :param number: Number where sms should be sent
+        :type number: str
+        :param text: Text you want to send
+        :type text: str
+        :param key: Idempotency key, sms with key already sent by any
+                    account is not sent again
+        :type key: str
+
+        :returns: Balance left on account used
+        :rtype: int
+        :raises: :py:exc:`pysms.sms.SendException` if no account could send,
+                 :py:exc:`pysms.sms.CommunicationException`,
+                 :py:exc:`pysms.sms.ResponseException`
+        """
+
+        return self._send(self._validate(locals()))
+
+    def _send(self, options):
+        key = options.get("key")
+        if key is None:
+            return self._route(options)
+
+        return self._acknowledged.get(key, lambda key: self._route(options))
+
+    def _route(self, options):
+        tried = set()
+        last_exception = SendException("No account available")
+
+        while True:
+            account = self._acquire(tried)
+            if not account:
+                raise last_exception
+            tried.add(account)
+
+            try:
+                with account.lock:
+                    if self.limiter:
+                        self.limiter.acquire(account.provider)
+                    balance = account.provider._send(options)
+            except (AuthException, SendException) as e:
+                self.logger.info("Account %s failed (%s)",
+                                 account.provider.username, e)
+                last_exception = e
+                self._report(account, e)
+                self._release(account, disable = True)
+            except Exception as e:
+                self._report(account, e)
+                self._release(account)
+                raise
+            else:
+                self._report(account)
+                self._release(account, disable = not balance)
+                return balance
+
+    def _report(self, account, exception = None):
+        if self.limiter:
+            self.limiter.report(account.provider, exception)
+
+    def send_many(self, messages, concurrency = None):
+        """
+        Sends many sms-es spread over all accounts
+
+        :param messages: Iterable of `(number, text)` tuples or dicts
+        :type messages: iterable
+        :param concurrency: Maximal number of sends in flight, defaults to
+                            number of accounts
+        :type concurrency: int
+
+        :returns: Generator of :py:class:`pysms.sms.SendResult`
+        """
+
+        return Sms.send_many(self, messages, concurrency or len(self.accounts))
+
+class AsyncNajdiSiSms(AsyncSms):
+    """
+    Send free sms-es using `www.najdi.si <http://www.najdi.si/>`_ service
+    without blocking
+
+    Works the same as :py:class:`NajdiSiSms`, but logs in and sends over a non
+    blocking http client, so a single event loop can carry many sends in
+    flight. Sends started while logging in wait for that same login.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    home_url = NajdiSiSms.home_url
+    login_url = NajdiSiSms.login_url
+    logout_url = NajdiSiSms.logout_url
+    session_url = NajdiSiSms.session_url
+    send_url = NajdiSiSms.send_url
+
+    InitSchema = NajdiSiSms.InitSchema
+    SendSchema = NajdiSiSms.SendSchema
+
+    _parse_balance = staticmethod(NajdiSiSms._parse_balance)
+
+    def __init__(self, username, password, retries = 2,
+                 socket_map = None, timeout = 30, retry_policy = None):
+        """
+        Constructor
+
+        :param username: Your najdi.si username
+        :type username: str
+        :param password: Your najdi.si password
+        :type password: str
+        :param retries: Number of retries
+        :type retries: int
+        :param socket_map: :py:mod:`asyncore` socket map to run on
+        :type socket_map: dict
+        :param timeout: Http request timeout
+        :type timeout: float
+        :param retry_policy: Policy of retrying sends, overrides `retries`
+        :type retry_policy: :py:class:`pysms.sms.RetryPolicy`
+        """
+
+        self.__dict__.update(self.InitSchema().deserialize(locals()))
+        AsyncSms.__init__(self, socket_map)
+        self.retry_policy = retry_policy or RetryPolicy(self.retries)
+
+        self.client = AsyncHttpClient(self.socket_map, timeout)
+
+        self._session = None
+        self._balance = 0
+        self._login_result = None
+        # Sends in flight by idempotency key
+        self._sending = {}
+
+    def _poll(self, timeout):
+        self.client.poll(timeout)
+
+    @coroutine
+    def balance(self):
+        """
+        Balance in form of sms-es left
+
+        :returns: Result with balance as value
+        :rtype: :py:class:`pysms.sms.AsyncResult`
+        """
+
+        if not self._balance:
+            yield self._login()
+
+        raise Return(self._balance)
+
+    def _parse_login_form(self, resp):
+        for match in re.finditer(r'<form\b([^>]*)>(.*?)(?:</form>|$)', resp,
+                                 re.S | re.I):
+            attrs, form = match.groups()
+            if not re.search(r'\bname=["\']lgn["\']', attrs):
+                continue
+
+            for name in ("j_username", "j_password"):
+                if not re.search(r'<input\b[^>]*\bname=["\']%s["\']' %name, form):
+                    raise ResponseException(
+                        "Error getting username and password form inputs "
+                        "(%s not found)" %name)
+
+            action = re.search(r'\baction=["\']([^"\']*)["\']', attrs)
+            return action.group(1) if action else ""
+
+        raise ResponseException("Error extracting login form (lgn not found)")
+
+    def _login(self):
+        if not self._login_result or self._login_result.done:
+            self._login_result = self._do_login()
+
+        return self._login_result
+
+    @coroutine
+    def _do_login(self):
+        start = time.time()
+
+        # We have to log out first to provide consistency,
+        # najdi.si has some wierd bugs
+        yield self.client.request(self.logout_url)
+        resp = yield self.client.request(self.login_url)
+
+        action = urlparse.urljoin(resp.url, self._parse_login_form(resp.body))
+        yield self.client.request(action, urllib.urlencode(
+            [("j_username", self.username), ("j_password", self.password)]))
+
+        resp = yield self.client.request(self.session_url)
+        if resp.url == self.login_url:
+            raise AuthException("Error logging in, incorrect username or password")
+
+        match = _session_re.search(resp.body)
+        if not match:
+            raise ResponseException("Error getting session id, sms_so_l_(\d+) not found")
+
+        self._balance = self._parse_balance(resp.body)
+        self._session = match.group(1)
+
+        metrics.timing("login", time.time() - start,
+                       provider = type(self).__name__)
+
+    @coroutine
+    def _send_sms(self, session, prefix, number, data):
+        quoted = urllib.quote(data) if six.PY3 else urllib.quote(data.encode("utf-8"))
+        url = self.send_url.format(session = session,
+                                   prefix = prefix,
+                                   number = number,
+                                   data = quoted)
+
+        start = time.time()
+        try:
+            resp = yield self.client.request(url)
+        except CommunicationException as e:
+            raise CommunicationException("Error sending sms (%s)" %e)
+        metrics.timing("http", time.time() - start,
+                       provider = type(self).__name__)
+
+        self._balance = _parse_msg_left(resp.body)
+
+    def send(self, number, text, key = None):
+        """
+        Sends sms
+
+        Transient errors are retried with a new session, after backoff of
+        :py:attr:`retry_policy`, which does not block the event loop.
+
+        :param number: Number where sms should be sent
+        :type number: str
+        :param text: Text you want to send
+        :type text: str
+        :param key: Idempotency key, sms with key already sent is not sent
+                    again
+        :type key: str
+
+        :returns: Result with balance as value
+        :rtype: :py:class:`pysms.sms.AsyncResult`
+        """
+
+        return self._send(self._validate(locals()))
+
+    def _send(self, options):
         number = options["number"]
         text = options["text"]
 
         self.logger.info("Sms with number %s and text %s", number, text)
 
-        last_exception = None
-        for x in range(0, self.retries + 1):
-            self.logger.info("Send retry %d", x)
+        key = options.get("key")
+        if key is None:
+            return self._submit(number, text)
+
+        return self._once(key, number, text)
 
+    @coroutine
+    def _once(self, key, number, text):
+        # Waits for send with the same key already in flight, and sends
+        # again only if it failed
+        while key in self._sending:
             try:
-                if not self._session:
-                    self.logger.debug("We are not yet logged in")
-                    self._login()
-                    self.logger.info("Login complete")
+                yield self._sending[key]
+            except SmsException:
+                pass
+
+        acknowledged = self.retry_policy.acknowledged
+        balance = acknowledged.peek(key, _missing)
+        if balance is not _missing:
+            raise Return(balance)
+
+        result = self._sending[key] = self._submit(number, text)
+        try:
+            balance = yield result
+        finally:
+            del self._sending[key]
+
+        acknowledged.put(key, balance)
+        raise Return(balance)
+
+    @coroutine
+    def _submit(self, number, text):
+        policy = self.retry_policy
+        deadline = policy.deadline and time.time() + policy.deadline
+        attempt = 0
+
+        while True:
+            session = self._session
+            try:
+                if not session:
+                    yield self._login()
 
                     if not self._balance:
-                        self.logger.info("Out of balance")
                         raise SendException("Out of balance")
+                    session = self._session
 
-                self.logger.info("Sending sms")
-                self._send_sms(self._session, number[4:6], number[6:], text )
+                yield self._send_sms(session, number[4:6], number[6:], text)
             except SmsException as e:
-                last_exception = e
-                self._session = None
+                delay = policy.next_delay(e, attempt, deadline)
+                # Session could be the cause of a transient error, unless
+                # another send already replaced it
+                if policy.is_transient(e) and self._session == session:
+                    self._session = None
+                if delay is None:
+                    raise
+                self.logger.info("Retrying in %.3fs (%s)", delay, e)
             else:
-                last_exception = None
-                break
-
-        if last_exception: raise last_exception
+                raise Return(self._balance)
 
-        self.logger.info("Sms sent")
-        return self._balance
+            metrics.count("retry", provider = type(self).__name__)
+            yield self._sleep(delay)
+            attempt += 1
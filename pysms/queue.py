@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: queue.py
+   :platform: Unix, Windows
+   :synopsis: Durable queue of outgoing sms-es
+"""
+
+import time, json, logging
+import sqlite3
+import threading
+
+from pysms.sms import InputException
+
+class QueuedMessage(object):
+    """
+    Message leased from :py:class:`SmsQueue`
+    """
+
+    def __init__(self, id, message, attempts):
+        """
+        Constructor
+
+        :param id: Id of message in queue
+        :type id: int
+        :param message: Arguments for :py:meth:`pysms.sms.Sms.send`
+        :type message: dict
+        :param attempts: Number of times message was leased, including this one
+        :type attempts: int
+        """
+
+        self.id = id
+        self.message = message
+        self.attempts = attempts
+
+    def __repr__(self):
+        return "<QueuedMessage %d>" %self.id
+
+class SmsQueue(object):
+    """
+    Queue of outgoing sms-es stored in sqlite database
+
+    Every message is pending, leased, sent or failed. Leased messages
+    belong to a worker until their lease expires, so messages leased by a
+    crashed process are sent again, while sent messages never are.
+
+    Writes of concurrent callers are grouped and committed together in a
+    single transaction, and messages are only loaded in leased batches, so
+    queue can hold any number of messages.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    PENDING = 0
+    """Message waits to be sent"""
+    LEASED = 1
+    """Message is being sent by a worker"""
+    SENT = 2
+    """Message was sent"""
+    FAILED = 3
+    """Message could not be sent"""
+
+    def __init__(self, path, lease_timeout = 300, max_attempts = 3,
+                 batch_size = 1000, synchronous = "FULL"):
+        """
+        Constructor
+
+        :param path: Path to sqlite database, created if it does not exist
+        :type path: str
+        :param lease_timeout: Seconds after which leased message which was
+                              not acknowledged is given out again
+        :type lease_timeout: float
+        :param max_attempts: Maximal number of send attempts per message
+        :type max_attempts: int
+        :param batch_size: Maximal number of messages written in a single
+                           transaction by :py:meth:`enqueue_many`
+        :type batch_size: int
+        :param synchronous: Sqlite synchronous mode, `NORMAL` survives
+                            process crashes but may lose last commits on
+                            power loss
+        :type synchronous: str
+        """
+
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.commits = 0
+
+        self._db = sqlite3.connect(path, isolation_level = None,
+                                   check_same_thread = False)
+        self._lock = threading.Lock()
+
+        # Group commit state
+        self._cond = threading.Condition()
+        self._writes = []
+        self._committing = False
+
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = %s" %synchronous)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message TEXT NOT NULL,
+                    state INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL DEFAULT 0,
+                    result TEXT
+                )""")
+            self._db.execute("""
+                CREATE INDEX IF NOT EXISTS messages_available
+                ON messages (state, available_at)""")
+            self._db.execute("""
+                CREATE INDEX IF NOT EXISTS messages_order
+                ON messages (state, id)""")
+
+    def close(self):
+        """Closes database"""
+
+        with self._lock:
+            self._db.close()
+
+    def _transaction(self, writes):
+        with self._lock:
+            cursor = self._db.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for write in writes:
+                    cursor.execute(write[0], write[1])
+                    write[2] = cursor.lastrowid
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+
+            self.commits += 1
+
+    def _write(self, sql, args):
+        """
+        Executes write, committed together with writes of other threads
+
+        First caller becomes leader and commits writes of everyone who
+        arrived in the meantime, others wait for the leader to finish.
+        """
+
+        write = [sql, args, None, None, False]
+
+        with self._cond:
+            self._writes.append(write)
+
+            while not write[4]:
+                if self._committing:
+                    self._cond.wait()
+                    continue
+
+                writes, self._writes = self._writes, []
+                self._committing = True
+                self._cond.release()
+                try:
+                    self._transaction(writes)
+                except Exception as e:
+                    for other in writes:
+                        other[3] = e
+                finally:
+                    self._cond.acquire()
+                    self._committing = False
+                    for other in writes:
+                        other[4] = True
+                    self._cond.notify_all()
+
+        if write[3] is not None:
+            raise write[3]
+
+        return write[2]
+
+    def enqueue(self, number, text, **params):
+        """
+        Adds message to queue
+
+        Returns once message is stored on disk.
+
+        :param number: Number where sms should be sent
+        :type number: str
+        :param text: Text you want to send
+        :type text: str
+        :param params: Additional arguments for provider's send
+
+        :returns: Id of message
+        :rtype: int
+        """
+
+        params.update(number = number, text = text)
+        return self._write("INSERT INTO messages (message) VALUES (?)",
+                           (json.dumps(params),))
+
+    def enqueue_many(self, messages):
+        """
+        Adds many messages to queue, in transactions of `batch_size`
+
+        :param messages: Iterable of `(number, text)` tuples or dicts with
+                         arguments for provider's send
+        :type messages: iterable
+
+        :returns: Number of added messages
+        :rtype: int
+        """
+
+        count = 0
+        batch = []
+        for message in messages:
+            if not isinstance(message, dict):
+                number, text = message
+                message = {"number": number, "text": text}
+
+            batch.append(["INSERT INTO messages (message) VALUES (?)",
+                          (json.dumps(message),), None])
+            if len(batch) >= self.batch_size:
+                self._transaction(batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            self._transaction(batch)
+            count += len(batch)
+
+        return count
+
+    def lease(self, count = 1, timeout = None):
+        """
+        Leases messages for sending
+
+        Messages are leased in order they were added, including messages
+        whose lease has expired. Expired messages which already had
+        `max_attempts` are failed instead, so a message crashing or hanging
+        its worker is not given out forever.
+
+        :param count: Maximal number of messages to lease
+        :type count: int
+        :param timeout: Lease timeout, `lease_timeout` by default
+        :type timeout: float
+
+        :returns: Leased messages
+        :rtype: list of :py:class:`QueuedMessage`
+        """
+
+        now = time.time()
+        until = now + (timeout or self.lease_timeout)
+
+        with self._lock:
+            cursor = self._db.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute(
+                    "UPDATE messages SET state = ?, available_at = 0, "
+                    "result = ? WHERE state = ? AND available_at <= ? "
+                    "AND attempts >= ?",
+                    (self.FAILED, json.dumps("Lease expired"), self.LEASED,
+                     now, self.max_attempts))
+                # Every state is read in order of its index, instead of
+                # sorting all waiting messages on each lease
+                rows = []
+                for state in (self.PENDING, self.LEASED):
+                    rows.extend(cursor.execute(
+                        "SELECT id, message, attempts FROM messages "
+                        "INDEXED BY messages_order WHERE state = ? "
+                        "AND available_at <= ? ORDER BY id LIMIT ?",
+                        (state, now, count)).fetchall())
+                rows = sorted(rows)[:count]
+                cursor.executemany(
+                    "UPDATE messages SET state = ?, available_at = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    [(self.LEASED, until, row[0]) for row in rows])
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+
+        return [QueuedMessage(id, json.loads(message), attempts + 1)
+                for id, message, attempts in rows]
+
+    def ack(self, id, result = None):
+        """
+        Marks leased message as sent
+
+        :param id: Id of message
+        :type id: int
+        :param result: Json serializable value returned by provider
+        """
+
+        self._write("UPDATE messages SET state = ?, result = ? WHERE id = ?",
+                    (self.SENT, json.dumps(result), id))
+
+    def fail(self, message, error, retry = True, delay = 0):
+        """
+        Returns leased message to queue, or marks it as failed
+
+        Message is failed when `retry` is not set, or after `max_attempts`.
+
+        :param message: Leased message
+        :type message: :py:class:`QueuedMessage`
+        :param error: Error sending message
+        :param retry: Whether message should be retried
+        :type retry: bool
+        :param delay: Seconds before message is available again
+        :type delay: float
+        """
+
+        if retry and message.attempts < self.max_attempts:
+            state, available_at = self.PENDING, time.time() + delay
+        else:
+            state, available_at = self.FAILED, 0
+
+        self._write("UPDATE messages SET state = ?, available_at = ?, "
+                    "result = ? WHERE id = ?",
+                    (state, available_at, json.dumps(str(error)), message.id))
+
+    def stats(self):
+        """
+        Counts messages in each state
+
+        :returns: Number of messages by state
+        :rtype: dict
+        """
+
+        with self._lock:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM messages "
+                                    "GROUP BY state").fetchall()
+
+        counts = dict.fromkeys([self.PENDING, self.LEASED, self.SENT,
+                                self.FAILED], 0)
+        counts.update(rows)
+        return counts
+
+class QueueWorker(object):
+    """
+    Pool of threads sending messages from :py:class:`SmsQueue`
+
+    Each thread leases batches of messages and sends them with provider's
+    :py:meth:`pysms.sms.Sms.send_many`. Invalid messages fail right away,
+    other failures are retried after `retry_delay`.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, queue, sms, workers = 1, concurrency = 1,
+                 batch_size = 100, retry_delay = 60, poll_interval = 1):
+        """
+        Constructor
+
+        :param queue: Queue to send messages from
+        :type queue: :py:class:`SmsQueue`
+        :param sms: Provider used for sending
+        :type sms: :py:class:`pysms.sms.Sms`
+        :param workers: Number of worker threads
+        :type workers: int
+        :param concurrency: Concurrency of each batch send
+        :type concurrency: int
+        :param batch_size: Number of messages leased at once
+        :type batch_size: int
+        :param retry_delay: Seconds before failed message is retried
+        :type retry_delay: float
+        :param poll_interval: Seconds to wait when queue is empty
+        :type poll_interval: float
+        """
+
+        self.queue = queue
+        self.sms = sms
+        self.workers = workers
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._threads = []
+
+    def run_once(self):
+        """
+        Leases and sends a single batch of messages
+
+        :returns: Number of processed messages
+        :rtype: int
+        """
+
+        leased = self.queue.lease(self.batch_size)
+        if not leased:
+            return 0
+
+        # Every result is written as it arrives, so messages sent before a
+        # crash are not leased and sent again
+        pending = dict(enumerate(leased))
+        try:
+            for result in self.sms.send_many([m.message for m in leased],
+                                             self.concurrency):
+                message = pending.pop(result.index)
+                if result.ok:
+                    self.queue.ack(message.id, result.value)
+                    continue
+
+                self.logger.warning("Error sending message %d (%s)",
+                                    message.id, result.exception)
+                self.queue.fail(message, result.exception,
+                                retry = not isinstance(result.exception,
+                                                       InputException),
+                                delay = self.retry_delay)
+        except Exception as e:
+            # Messages without result are released, instead of waiting for
+            # their leases to expire
+            for message in pending.values():
+                self.queue.fail(message, e, delay = self.retry_delay)
+            raise
+
+        return len(leased)
+
+    def run(self, until_empty = False):
+        """
+        Sends messages until stopped
+
+        :param until_empty: Return once no message is available
+        :type until_empty: bool
+        """
+
+        while not self._stop.is_set():
+            try:
+                processed = self.run_once()
+            except Exception:
+                # Worker keeps going, so queue does not stall on a bad batch
+                self.logger.exception("Error sending batch")
+                self._stop.wait(self.poll_interval)
+                continue
+
+            if not processed:
+                if until_empty:
+                    return
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        """Starts worker threads"""
+
+        self._stop.clear()
+        self._threads = [threading.Thread(target = self.run)
+                         for x in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stops worker threads, waiting for batches in flight"""
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: ratelimit.py
+   :platform: Unix, Windows
+   :synopsis: Rate limiting of sms sends
+"""
+
+import time, logging
+import threading
+
+from pysms.sms import Sms
+from pysms.sms import CommunicationException, ResponseException, SendException
+
+class TokenBucket(object):
+    """
+    Token bucket with rate adapting to errors
+
+    Rate is cut by `backoff` on every error reported with :py:meth:`report`,
+    down to `min_rate`, and grows back by `recovery` of configured rate
+    with every success.
+    """
+
+    def __init__(self, rate, burst = 1, min_rate = None, backoff = 0.5,
+                 recovery = 0.05):
+        """
+        Constructor
+
+        :param rate: Tokens per second
+        :type rate: float
+        :param burst: Maximal number of tokens saved up
+        :type burst: float
+        :param min_rate: Lowest rate errors can push rate down to, tenth
+                         of `rate` by default
+        :type min_rate: float
+        :param backoff: Factor rate is multiplied with on error
+        :type backoff: float
+        :param recovery: Part of `rate` added to rate on success
+        :type recovery: float
+        """
+
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate or rate / 10.
+        self.backoff = backoff
+        self.recovery = recovery
+
+        self.tokens = burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens = 1):
+        """
+        Takes tokens, possibly before they are available
+
+        Callers are served in order of reservations, so waiting callers
+        do not need to poll.
+
+        :param tokens: Number of tokens to take
+        :type tokens: float
+
+        :returns: Seconds caller must wait before using tokens
+        :rtype: float
+        """
+
+        with self._lock:
+            self._refill()
+            self.tokens -= tokens
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self, tokens = 1):
+        """
+        Takes tokens, blocking until they are available
+        """
+
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    def report(self, ok):
+        """
+        Adapts rate to result of a send
+
+        :param ok: Whether send succeeded
+        :type ok: bool
+        """
+
+        with self._lock:
+            # Tokens until now are counted with the old rate
+            self._refill()
+            if ok:
+                self.rate = min(self.max_rate,
+                                self.rate + self.recovery * self.max_rate)
+            else:
+                self.rate = max(self.min_rate, self.rate * self.backoff)
+
+class RateLimiter(object):
+    """
+    Token buckets per provider and per account
+
+    Limits are configured per provider class name, like `NajdiSiSms`,
+    shared by all instances of that provider, and per `(class name,
+    account)` tuple, where account is :py:attr:`pysms.sms.Sms.account`,
+    like najdi.si username or modem serial port. Sending takes a token from
+    each bucket that applies.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    errors = (CommunicationException, ResponseException, SendException)
+    """Exceptions that can be caused by sending too fast"""
+
+    def __init__(self, limits = None, default = None):
+        """
+        Constructor
+
+        :param limits: Map of provider class names or `(class name, account)`
+                       tuples to `(rate, burst)` tuples or
+                       :py:class:`TokenBucket` arguments as dicts
+        :type limits: dict
+        :param default: Limit of every account without its own limit
+        :type default: tuple
+        """
+
+        self.limits = dict(limits or {})
+        self.default = default
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, limit):
+        if limit is None:
+            return None
+
+        with self._lock:
+            try:
+                return self._buckets[key]
+            except KeyError:
+                if isinstance(limit, dict):
+                    bucket = TokenBucket(**limit)
+                else:
+                    bucket = TokenBucket(*limit)
+                return self._buckets.setdefault(key, bucket)
+
+    def buckets(self, sms):
+        """
+        Returns buckets that apply to provider
+
+        :param sms: Provider
+        :type sms: :py:class:`pysms.sms.Sms`
+
+        :returns: Token buckets
+        :rtype: list of :py:class:`TokenBucket`
+        """
+
+        name = type(sms).__name__
+        key = (name, sms.account)
+
+        buckets = [self._bucket(name, self.limits.get(name)),
+                   self._bucket(key, self.limits.get(key, self.default))]
+
+        return [bucket for bucket in buckets if bucket]
+
+    def reserve(self, sms, tokens = 1):
+        """
+        Takes tokens for provider, for callers able to reschedule sends
+
+        :returns: Seconds to wait before sending
+        :rtype: float
+        """
+
+        return max([bucket.reserve(tokens)
+                    for bucket in self.buckets(sms)] or [0])
+
+    def acquire(self, sms, tokens = 1):
+        """
+        Takes tokens for provider, blocking until they are available
+        """
+
+        wait = self.reserve(sms, tokens)
+        if wait:
+            self.logger.debug("Waiting %.3fs for %s", wait, sms.account)
+            time.sleep(wait)
+
+    def report(self, sms, exception = None):
+        """
+        Adapts limits of provider to result of a send
+
+        :param sms: Provider
+        :type sms: :py:class:`pysms.sms.Sms`
+        :param exception: Exception raised by send, if any
+        :type exception: :py:exc:`pysms.sms.SmsException`
+        """
+
+        ok = not isinstance(exception, self.errors)
+        for bucket in self.buckets(sms):
+            bucket.report(ok)
+
+class RateLimitedSms(Sms):
+    """
+    Wraps provider, so it sends no faster than limiter allows
+
+    Sends block until tokens are available, instead of failing. For limits
+    per account of :py:class:`pysms.providers.NajdiSiPool` or per modem of
+    :py:class:`pysms.providers.GsmModemPool`, pass limiter to the pool.
+    """
+
+    def __init__(self, sms, limiter):
+        """
+        Constructor
+
+        :param sms: Provider to wrap
+        :type sms: :py:class:`pysms.sms.Sms`
+        :param limiter: Limiter to take tokens from
+        :type limiter: :py:class:`RateLimiter`
+        """
+
+        self.sms = sms
+        self.limiter = limiter
+
+        self.SendSchema = sms.SendSchema
+        self.capabilities = sms.capabilities
+
+    @property
+    def balance(self):
+        return self.sms.balance
+
+    @property
+    def account(self):
+        return self.sms.account
+
+    def _call(self, func, *args, **kwargs):
+        self.limiter.acquire(self.sms)
+        try:
+            value = func(*args, **kwargs)
+        except Exception as e:
+            self.limiter.report(self.sms, e)
+            raise
+
+        self.limiter.report(self.sms)
+        return value
+
+    def send(self, *args, **kwargs):
+        """
+        Sends sms once limiter allows it
+
+        See provider's send for parameters.
+        """
+
+        return self._call(self.sms.send, *args, **kwargs)
+
+    def _send(self, params):
+        return self._call(self.sms._send, params)
+
+    def _validate_many(self, messages):
+        return self.sms._validate_many(messages)
+
+    def _limited(self, messages):
+        for message in messages:
+            self.limiter.acquire(self.sms)
+            yield message
+
+    def send_many(self, messages, concurrency = 1):
+        """
+        Sends many sms-es with provider's batching, once limiter allows it
+
+        Messages are handed to provider no faster than limiter allows.
+
+        :param messages: Iterable of `(number, text)` tuples or dicts
+        :type messages: iterable
+        :param concurrency: Maximal number of sends in flight
+        :type concurrency: int
+
+        :returns: Generator of :py:class:`pysms.sms.SendResult`
+        """
+
+        for result in self.sms.send_many(self._limited(messages), concurrency):
+            self.limiter.report(self.sms, result.exception)
+            yield result
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: router.py
+   :platform: Unix, Windows
+   :synopsis: Routing of sms-es over many providers
+"""
+
+import time, logging
+import threading
+
+from pysms.sms import Sms
+from pysms.sms import SmsException, SendException, \
+                      CommunicationException, ResponseException
+
+class _Route(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, sms):
+        self.sms = sms
+        self.latency = 0
+        self.error_rate = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.state = self.CLOSED
+        self.opened_until = 0
+
+    @property
+    def cost(self):
+        # Expected time until successful send, if failed sends were retried
+        # here, with sends in flight waiting in line
+        return self.latency * (self.in_flight + 1) / \
+               max(1 - self.error_rate, 0.01)
+
+    def __repr__(self):
+        return "<Route %s %s latency=%.3f errors=%.2f>" %(
+            type(self.sms).__name__, self.state, self.latency, self.error_rate)
+
+class Router(Sms):
+    """
+    Sends sms-es over the best of many providers
+
+    Each provider has a moving average of latency and error rate, and sms
+    is sent over the provider with the lowest expected time to a successful
+    send. When provider fails, sms is sent over the next one.
+
+    After `threshold` consecutive
+    :py:exc:`pysms.sms.CommunicationException` or
+    :py:exc:`pysms.sms.ResponseException` errors, provider's circuit is
+    opened and provider gets no sms-es for `reset_timeout` seconds. Then a
+    single sms is let through as a probe, which closes the circuit if it
+    succeeds and opens it again if it fails.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    errors = (CommunicationException, ResponseException)
+    """Exceptions that count towards opening the circuit"""
+
+    def __init__(self, providers, threshold = 3, reset_timeout = 30,
+                 smoothing = 0.2):
+        """
+        Constructor
+
+        :param providers: Providers to route between
+        :type providers: list of :py:class:`pysms.sms.Sms`
+        :param threshold: Number of consecutive errors that open circuit
+        :type threshold: int
+        :param reset_timeout: Seconds before provider with open circuit is
+                              probed
+        :type reset_timeout: float
+        :param smoothing: Weight of last send in moving averages
+        :type smoothing: float
+        """
+
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.smoothing = smoothing
+
+        self.routes = [_Route(sms) for sms in providers]
+        self._lock = threading.Lock()
+
+    @property
+    def balance(self):
+        """
+        Sum of balances of providers with closed circuit
+
+        returns: Balance
+        :rtype: int
+        """
+
+        return sum(route.sms.balance for route in self.routes
+                   if route.state == _Route.CLOSED)
+
+    def _acquire(self, tried):
+        with self._lock:
+            now = time.time()
+
+            routes = []
+            for route in self.routes:
+                if route in tried:
+                    continue
+                if route.state == _Route.OPEN and route.opened_until <= now:
+                    self.logger.info("Probing %s", route)
+                    route.state = _Route.HALF_OPEN
+                    return self._take(route)
+                if route.state == _Route.CLOSED:
+                    routes.append(route)
+
+            if not routes:
+                return None
+
+            return self._take(min(routes, key = lambda route: route.cost))
+
+    def _take(self, route):
+        route.in_flight += 1
+        return route
+
+    def _release(self, route, latency, exception = None):
+        with self._lock:
+            route.in_flight -= 1
+
+            if exception is None:
+                route.latency += self.smoothing * (latency - route.latency)
+                route.error_rate -= self.smoothing * route.error_rate
+                route.failures = 0
+                if route.state == _Route.HALF_OPEN:
+                    self.logger.info("Closing circuit of %s", route)
+                    route.state = _Route.CLOSED
+                return
+
+            if not isinstance(exception, self.errors):
+                # Provider is not at fault, but probe did not prove anything
+                if route.state == _Route.HALF_OPEN:
+                    route.state = _Route.OPEN
+                return
+
+            route.error_rate += self.smoothing * (1 - route.error_rate)
+            route.failures += 1
+            if route.state == _Route.HALF_OPEN or \
+               route.failures >= self.threshold:
+                self.logger.warning("Opening circuit of %s (%s)", route,
+                                    exception)
+                route.state = _Route.OPEN
+                route.opened_until = time.time() + self.reset_timeout
+
+    def send(self, number, text, key = None):
+        """
+        Sends sms over the best available provider
+
+        :param number: Number where sms should be sent
+        :type number: str
+        :param text: Text you want to send
+        :type text: str
+        :param key: Idempotency key passed to provider
+        :type key: str
+
+        :returns: Value returned by provider
+        :raises: :py:exc:`pysms.sms.SendException` if no provider is
+                 available, last provider's exception if all failed
+        """
+
+        params = {"number": number, "text": text}
+        if key is not None:
+            params["key"] = key
+
+        return self._send(params)
+
+    def _send(self, params):
+        tried = set()
+        last_exception = SendException("No provider available")
+
+        while True:
+            route = self._acquire(tried)
+            if not route:
+                raise last_exception
+            tried.add(route)
+
+            start = time.time()
+            try:
+                value = route.sms.send(**params)
+            except SmsException as e:
+                # Even invalid input may be valid for another provider
+                self.logger.info("Sending over %s failed (%s)", route, e)
+                self._release(route, time.time() - start, e)
+                last_exception = e
+            except Exception as e:
+                self._release(route, time.time() - start, e)
+                raise
+            else:
+                self._release(route, time.time() - start)
+                return value
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: session.py
+   :platform: Unix, Windows
+   :synopsis: On-disk store of provider sessions
+"""
+
+import os, json, logging
+import tempfile
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No file locking on windows, writes are still atomic
+    fcntl = None
+
+_cookie_attrs = ["version", "name", "value", "port", "port_specified",
+                 "domain", "domain_specified", "domain_initial_dot", "path",
+                 "path_specified", "secure", "expires", "discard", "comment",
+                 "comment_url", "rfc2109"]
+
+def dump_cookies(cookiejar):
+    """
+    Serializes cookies from cookie jar
+
+    :param cookiejar: Cookie jar to serialize
+    :type cookiejar: :py:class:`cookielib.CookieJar`
+
+    :returns: List of cookies as dicts
+    :rtype: list
+    """
+
+    cookies = []
+    for cookie in cookiejar:
+        data = dict((attr, getattr(cookie, attr)) for attr in _cookie_attrs)
+        data["rest"] = cookie._rest
+        cookies.append(data)
+
+    return cookies
+
+def load_cookies(cookiejar, cookies, cookie_class):
+    """
+    Loads cookies serialized with :py:func:`dump_cookies` into cookie jar
+
+    :param cookiejar: Cookie jar to load cookies into
+    :type cookiejar: :py:class:`cookielib.CookieJar`
+    :param cookies: List of cookies as dicts
+    :type cookies: list
+    :param cookie_class: Class of cookies cookie jar holds
+    """
+
+    for data in cookies:
+        cookiejar.set_cookie(cookie_class(**data))
+
+class SessionStore(object):
+    """
+    Session data stored in a json file and shared among processes
+
+    Writes go to a temporary file which replaces the store atomically, so
+    readers never see a partial write, and concurrent writers are
+    serialized with a lock file.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, path):
+        """
+        Constructor
+
+        :param path: Path to the store file
+        :type path: str
+        """
+
+        self.path = os.path.abspath(path)
+        self.lock_path = self.path + ".lock"
+
+    @contextmanager
+    def lock(self, exclusive = True):
+        """
+        Locks store for the duration of the context
+
+        :param exclusive: Whether lock is exclusive or shared
+        :type exclusive: bool
+        """
+
+        if not fcntl:
+            yield
+            return
+
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        """
+        Loads session data
+
+        :returns: Session data or None if store is empty or unreadable
+        :rtype: dict
+        """
+
+        with self.lock(exclusive = False):
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except (IOError, ValueError) as e:
+                self.logger.debug("Cannot load session from %s (%s)",
+                                  self.path, e)
+                return None
+
+    def save(self, data):
+        """
+        Saves session data atomically
+
+        :param data: Json serializable session data
+        :type data: dict
+        """
+
+        directory = os.path.dirname(self.path)
+        with self.lock():
+            fd, tmp_path = tempfile.mkstemp(dir = directory,
+                                            prefix = ".session")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, self.path)
+            except:
+                os.unlink(tmp_path)
+                raise
+
+    def clear(self):
+        """Removes stored session data"""
+
+        with self.lock():
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
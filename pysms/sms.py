@@ -5,24 +5,34 @@
    :synopsis: Base class declarations
 """
 
+import re
 import inspect
 import locale, logging
+import time
+import random
+import asyncore
+import functools
+import heapq
+import itertools
+import threading
+import Queue
+from collections import OrderedDict
 import six
 import colander
 
-from phonenumbers import parse as parse_number
-from phonenumbers import PhoneNumberFormat, format_number
-from phonenumbers.phonenumberutil import NumberParseException
 from colander import MappingSchema, SchemaNode
 from colander import String, Integer, Bool
 
-# We will need locale set-up for international phone number parsing
-locale.setlocale(locale.LC_ALL, '')
+from pysms import metrics
 
 class SmsException(Exception):
     """
     General sms exception
     """
+
+    code = None
+    """Error code reported by provider, like `+CMS ERROR` code of modem"""
+
     def __init__(self, message = None):
         """
         Handles the exception.
@@ -91,7 +101,7 @@ class ResponseException(SmsException):
         :type message: str
         """
 
-        SmsException.__init__(self, message or self.__doc_)
+        SmsException.__init__(self, message or self.__doc__)
 
 class InputException(SmsException):
     """
@@ -108,17 +118,623 @@ class InputException(SmsException):
 
         SmsException.__init__(self, message or self.__doc__)
 
-def prepare_number(number, country = None):
-    if not country:
-        country = locale.getlocale()[0].split("_")[1]
+class NumberCache(object):
+    """
+    Bounded LRU cache of normalized phone numbers or other computed values
+    """
+
+    def __init__(self, maxsize = 10000):
+        """
+        Constructor
+
+        :param maxsize: Maximal number of cached values
+        :type maxsize: int
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = OrderedDict()
+        self._computing = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, func):
+        """
+        Gets cached value for key or computes it with `func`
+
+        Value is computed by one thread at a time, others asking for the same
+        key wait for it, so `func` can have side effects like sending sms.
+        If it raises, the next waiting thread computes value itself.
+
+        :param key: Cache key
+        :param func: Function computing value from key on a miss
+        """
+
+        while True:
+            with self._lock:
+                try:
+                    value = self._cache.pop(key)
+                except KeyError:
+                    computing = self._computing.get(key)
+                    if computing is None:
+                        self.misses += 1
+                        computing = self._computing[key] = threading.Event()
+                        break
+                else:
+                    self.hits += 1
+                    self._cache[key] = value
+                    return value
+
+            computing.wait()
+
+        try:
+            value = func(key)
+            self.put(key, value)
+        finally:
+            with self._lock:
+                del self._computing[key]
+            computing.set()
+
+        return value
+
+    def peek(self, key, default = None):
+        """
+        Gets cached value for key, without computing it on a miss
+
+        :param key: Cache key
+        :param default: Value returned if key is not cached
+        """
+
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def put(self, key, value):
+        """
+        Caches value for key
+
+        :param key: Cache key
+        :param value: Value to cache
+        """
+
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last = False)
+
+    def clear(self):
+        """Clears cache and resets counters"""
+
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+number_cache = NumberCache()
+"""Cache of numbers normalized by :py:func:`prepare_number`"""
+
+_default_country = None
+
+def set_default_country(country):
+    """
+    Sets country numbers without international prefix belong to
+
+    By default country is taken from locale environment variables, like
+    `LANG`, without changing process locale.
+
+    :param country: Two letter country code ( ex. SI ), or None to take
+                    it from locale again
+    :type country: str
+    """
+
+    global _default_country
+
+    _default_country = country
+    number_cache.clear()
+
+def _locale_country():
+    language = locale.getdefaultlocale()[0]
+    if not language or "_" not in language:
+        return None
+
+    return language.split("_")[1]
+
+def _normalize_number(key):
+    # Phonenumbers takes a while to import, so it is imported when needed
+    from phonenumbers import parse, format_number, PhoneNumberFormat
+    from phonenumbers.phonenumberutil import NumberParseException
+
+    number, country = key
 
     try:
-      number = parse_number(number, country)
+      number = parse(number, country)
     except NumberParseException:
         return ''
 
     return format_number(number, PhoneNumberFormat.E164)
 
+def prepare_number(number, country = None):
+    global _default_country
+
+    if not country:
+        if not _default_country:
+            _default_country = _locale_country()
+        country = _default_country
+
+    return number_cache.get((number, country), _normalize_number)
+
+ENCODING_GSM7 = "gsm7"
+"""GSM 03.38 default alphabet, 7 bits per character"""
+ENCODING_UCS2 = "ucs2"
+"""UCS-2 (UTF-16 big endian), 16 bits per character"""
+
+MAX_SEGMENTS = 255
+"""Maximal number of segments of a concatenated sms"""
+
+_segment_size = {
+    # (single sms, segment of concatenated sms), in septets and octets
+    ENCODING_GSM7: (160, 153),
+    ENCODING_UCS2: (140, 134)
+}
+
+_gsm7_basic = (u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./"
+               u"0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§"
+               u"¿abcdefghijklmnopqrstuvwxyzäöñüà")
+_gsm7_extension = {u"\x0c": 0x0A, u"^": 0x14, u"{": 0x28, u"}": 0x29,
+                   u"\\": 0x2F, u"[": 0x3C, u"~": 0x3D, u"]": 0x3E,
+                   u"|": 0x40, u"€": 0x65}
+
+_gsm7_table = dict((ord(char), unichr(septet))
+                   for septet, char in enumerate(_gsm7_basic)
+                   if char != u"\x1b")
+_gsm7_table.update((ord(char), u"\x1b" + unichr(septet))
+                   for char, septet in _gsm7_extension.items())
+
+_gsm7_invalid_re = re.compile(u"[^%s]" %u"".join(
+    re.escape(unichr(char)) for char in _gsm7_table))
+_gsm7_extension_re = re.compile(u"[%s]" %u"".join(
+    re.escape(char) for char in _gsm7_extension))
+
+def _encode_gsm7(text):
+    """
+    Encodes text to unpacked septets, one septet per byte
+
+    :returns: Septets or None if text can not be encoded with GSM-7
+    :rtype: str
+    """
+
+    if _gsm7_invalid_re.search(text):
+        return None
+
+    return text.translate(_gsm7_table).encode("ascii")
+
+def _split(data, single, segment, unit, can_split):
+    if len(data) <= single:
+        return [data]
+
+    segments = []
+    start = 0
+    while start < len(data):
+        end = min(start + segment, len(data))
+        # Escape sequences and surrogate pairs must stay in one segment
+        while end < len(data) and not can_split(data, end):
+            end -= unit
+        segments.append(data[start:end])
+        start = end
+
+    return segments
+
+def _gsm7_can_split(data, end):
+    return data[end - 1] != "\x1b"
+
+def _ucs2_can_split(data, end):
+    return not "\xd8" <= data[end - 2] <= "\xdb"
+
+def split_text(text):
+    """
+    Encodes text and splits it into sms segments
+
+    GSM-7 is used whenever text can be encoded with it, since even text made
+    only of extension table characters, taking two septets each, fits more
+    characters in a segment than UCS-2. Segments are filled greedily, which
+    gives the fewest segments, without splitting escape sequences or
+    surrogate pairs.
+
+    :param text: Text to split
+    :type text: unicode
+
+    :returns: Tuple of encoding and list of encoded segments, unpacked
+              septets for GSM-7 and big endian octets for UCS-2
+    :rtype: tuple
+    """
+
+    data = _encode_gsm7(text)
+    if data is not None:
+        single, segment = _segment_size[ENCODING_GSM7]
+        return ENCODING_GSM7, _split(data, single, segment, 1,
+                                     _gsm7_can_split)
+
+    single, segment = _segment_size[ENCODING_UCS2]
+    return ENCODING_UCS2, _split(text.encode("utf-16-be"), single, segment, 2,
+                                 _ucs2_can_split)
+
+def segment_count(text):
+    """
+    Counts sms segments needed for text, without encoding it
+
+    :param text: Text to count segments for
+    :type text: unicode
+
+    :returns: Number of segments, same as number of segments returned by
+              :py:func:`split_text`
+    :rtype: int
+    """
+
+    if not _gsm7_invalid_re.search(text):
+        encoding = ENCODING_GSM7
+        extension = len(_gsm7_extension_re.findall(text))
+        length = len(text) + extension
+        exact = not extension
+    else:
+        encoding = ENCODING_UCS2
+        length = len(text.encode("utf-16-be"))
+        exact = length == 2 * len(text)
+
+    single, segment = _segment_size[encoding]
+    if length <= single:
+        return 1
+    if exact:
+        # Without multi-unit characters every segment is filled completely
+        return -(-length // segment)
+
+    return len(split_text(text)[1])
+
+def validate_text(node, value):
+    """
+    Colander validator checking that text fits in :py:data:`MAX_SEGMENTS`
+    """
+
+    if segment_count(value) > MAX_SEGMENTS:
+        raise colander.Invalid(node, "Text longer than %d sms segments"
+                               %MAX_SEGMENTS)
+
+_schemas = {}
+
+def compile_schema(schema):
+    """
+    Returns schema instance, constructed only once per schema class
+
+    Colander schemas are stateless once constructed, so the same instance can
+    deserialize any number of messages without building the node tree again.
+
+    :param schema: Schema class
+    :type schema: :py:class:`colander.MappingSchema`
+    """
+
+    try:
+        return _schemas[schema]
+    except KeyError:
+        return _schemas.setdefault(schema, schema())
+
+class SendResult(object):
+    """
+    Result of a single sms sent with :py:meth:`Sms.send_many`
+    """
+
+    def __init__(self, index, message, value = None, exception = None):
+        """
+        Constructor
+
+        :param index: Position of message in the input iterable
+        :type index: int
+        :param message: Message as it was passed in
+        :param value: Value returned by send
+        :param exception: Exception raised while validating or sending
+        :type exception: :py:exc:`pysms.sms.SmsException`
+        """
+
+        self.index = index
+        self.message = message
+        self.value = value
+        self.exception = exception
+
+    @property
+    def ok(self):
+        """True if sms was sent"""
+
+        return self.exception is None
+
+    def __repr__(self):
+        return "<SendResult %d %s>" %(self.index,
+                                      "ok" if self.ok else repr(self.exception))
+
+def _call(func, index, message, params, exception):
+    if exception is None:
+        try:
+            return SendResult(index, message, value = func(params))
+        except SmsException as e:
+            exception = e
+
+    return SendResult(index, message, exception = exception)
+
+def _dispatch(func, prepared, concurrency = 1):
+    """
+    Calls `func` for every prepared message with bounded concurrency
+
+    :param func: Function sending validated parameters
+    :param prepared: Iterable of `(index, message, params, exception)`
+    :param concurrency: Maximal number of calls in flight
+
+    :returns: Generator of :py:class:`SendResult` in order of completion
+    """
+
+    if concurrency <= 1:
+        for task in prepared:
+            yield _call(func, *task)
+        return
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def worker():
+        for task in iter(tasks.get, None):
+            try:
+                results.put(_call(func, *task))
+            except BaseException as e:
+                results.put(e)
+
+    threads = [threading.Thread(target = worker) for x in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def result():
+        res = results.get()
+        if isinstance(res, BaseException):
+            raise res
+        return res
+
+    pending = 0
+    try:
+        for task in prepared:
+            if task[3] is not None:
+                yield _call(func, *task)
+                continue
+
+            while pending >= concurrency:
+                pending -= 1
+                yield result()
+
+            tasks.put(task)
+            pending += 1
+
+        while pending:
+            pending -= 1
+            yield result()
+    finally:
+        # Sends nobody waits for any more are dropped, and workers are
+        # joined, so no thread outlives the call
+        try:
+            while True:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+def _send_defaults(send):
+    args, varargs, keywords, defaults = inspect.getargspec(send)
+    if not defaults:
+        return {}
+
+    return dict(zip(args[-len(defaults):], defaults))
+
+def _validate(sms, data):
+    try:
+        with metrics.timed("validate", provider = type(sms).__name__):
+            return compile_schema(sms.SendSchema).deserialize(data)
+    except colander.Invalid as e:
+        raise InputException("Problems with input data %s" %e)
+
+def _validate_many(schema, defaults, messages, provider = None):
+    """
+    Validates messages using a single schema instance
+
+    :param schema: Schema instance
+    :param defaults: Default values of send arguments
+    :type defaults: dict
+    :param messages: Iterable of `(number, text)` tuples or dicts
+    :param provider: Provider name used as label of validation timings
+    :type provider: str
+
+    :returns: Generator of `(index, message, params, exception)`
+    """
+
+    for index, message in enumerate(messages):
+        data = dict(defaults)
+        if isinstance(message, dict):
+            data.update(message)
+        else:
+            data["number"], data["text"] = message
+
+        try:
+            with metrics.timed("validate", provider = provider):
+                params = schema.deserialize(data)
+        except colander.Invalid as e:
+            yield index, message, None, \
+                  InputException("Problems with input data %s" %e)
+        else:
+            yield index, message, params, None
+
+class RetryPolicy(object):
+    """
+    Decides which failed sends are retried and when
+
+    Errors are transient or permanent. Errors with provider's error
+    :py:attr:`SmsException.code` are transient if the code is in
+    :py:attr:`transient_codes`, others if they are instances of
+    :py:attr:`transient`. Only transient errors are retried, up to `retries`
+    times, with exponentially growing delays, randomized by `jitter`, so
+    many senders failing at once do not retry in lockstep. No retry is
+    started if it would end after `deadline`.
+
+    Sends with idempotency key are remembered once acknowledged, so a send
+    repeated with the same key returns the first result instead of sending
+    sms again. Share one policy among providers to share remembered keys.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    transient = (CommunicationException, ResponseException)
+    """Exceptions worth retrying"""
+
+    transient_codes = frozenset([
+        27,  # Destination out of service
+        38,  # Network out of order
+        41,  # Temporary failure
+        42,  # Congestion
+        47,  # Resources unavailable
+        314, # SIM busy
+        331, # No network service
+        332, # Network timeout
+        500  # Unknown error
+    ])
+    """`+CMS ERROR` codes worth retrying"""
+
+    def __init__(self, retries = 2, backoff = 0.1, max_backoff = 10,
+                 jitter = 1, deadline = None, keys = 10000):
+        """
+        Constructor
+
+        :param retries: Maximal number of retries
+        :type retries: int
+        :param backoff: Delay before first retry, doubled for every next one
+        :type backoff: float
+        :param max_backoff: Maximal delay before retry
+        :type max_backoff: float
+        :param jitter: Part of delay that is random, from 0 for fixed
+                       delays to 1 for delays between 0 and full delay
+        :type jitter: float
+        :param deadline: Seconds after which no more retries are started
+        :type deadline: float
+        :param keys: Number of idempotency keys remembered
+        :type keys: int
+        """
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+        self.acknowledged = NumberCache(maxsize = keys)
+
+    def is_transient(self, exception):
+        """
+        Returns whether error is worth retrying
+
+        :param exception: Send error
+        :type exception: :py:exc:`SmsException`
+
+        :rtype: bool
+        """
+
+        if exception.code is not None:
+            return exception.code in self.transient_codes
+
+        return isinstance(exception, self.transient)
+
+    def delay(self, attempt):
+        """
+        Returns delay before retry
+
+        :param attempt: Number of retry, starting with 0
+        :type attempt: int
+
+        :returns: Seconds to wait
+        :rtype: float
+        """
+
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def next_delay(self, exception, attempt, deadline = None):
+        """
+        Returns delay before retrying failed attempt
+
+        :param exception: Error attempt failed with
+        :type exception: :py:exc:`SmsException`
+        :param attempt: Number of failed attempt, starting with 0
+        :type attempt: int
+        :param deadline: Time after which no more retries are started
+        :type deadline: float
+
+        :returns: Seconds to wait, or None if error should not be retried
+        :rtype: float
+        """
+
+        if attempt >= self.retries or not self.is_transient(exception):
+            return None
+
+        delay = self.delay(attempt)
+        if deadline and time.time() + delay > deadline:
+            return None
+
+        return delay
+
+    def run(self, func, args = (), provider = None):
+        """
+        Calls function, retrying transient errors
+
+        :param func: Function to call
+        :param args: Function arguments
+        :type args: tuple
+        :param provider: Provider name used as label of retry counter
+        :type provider: str
+
+        :returns: Value returned by function
+        :raises: Last error
+        """
+
+        deadline = self.deadline and time.time() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except SmsException as e:
+                delay = self.next_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                self.logger.info("Retrying in %.3fs (%s)", delay, e)
+
+            metrics.count("retry", provider = provider)
+            time.sleep(delay)
+            attempt += 1
+
+    def once(self, key, func, args = ()):
+        """
+        Calls function, unless it already succeeded with the same key
+
+        :param key: Idempotency key, function is always called if None
+        :param func: Function to call
+        :param args: Function arguments
+        :type args: tuple
+
+        :returns: Value returned by function now or when it succeeded
+        """
+
+        if key is None:
+            return func(*args)
+
+        return self.acknowledged.get(key, lambda key: func(*args))
+
 class Sms(object):
     """
     Abstract base class for sending sms-es.
@@ -152,12 +768,15 @@ class Sms(object):
         number = SchemaNode(String(),
                             preparer = prepare_number,
                             validator = colander.Length(1,12))
-        text = SchemaNode(String(),
-                          validator = colander.Length(0, 160))
+        text = SchemaNode(String(), validator = validate_text)
+        key = SchemaNode(String(), missing = colander.drop)
 
     capabilities = None
     """Flag representing sms provider capabilities"""
 
+    account = None
+    """Account or device sms-es are sent from, like username or serial port"""
+
     @property
     def balance(self):
       """
@@ -203,3 +822,354 @@ class Sms(object):
         """
 
         raise NotImplementedError
+
+    def _send(self, params):
+        """
+        Sends sms with already validated parameters
+
+        Providers should override this to skip validation in
+        :py:meth:`send_many`.
+
+        :param params: Deserialized :py:class:`SendSchema` data
+        :type params: dict
+        """
+
+        return self.send(**params)
+
+    def _validate(self, data):
+        """
+        Deserializes send arguments with :py:class:`SendSchema`
+
+        :param data: Arguments of :py:meth:`send`
+        :type data: dict
+
+        :returns: Deserialized data
+        :rtype: dict
+        :raises: :py:exc:`pysms.sms.InputException`
+        """
+
+        return _validate(self, data)
+
+    def _validate_many(self, messages):
+        return _validate_many(compile_schema(self.SendSchema),
+                              _send_defaults(self.send), messages,
+                              type(self).__name__)
+
+    def send_many(self, messages, concurrency = 1):
+        """
+        Sends many sms-es
+
+        Messages are validated in bulk and an invalid message does not abort
+        the batch, its error is reported in its result instead.
+
+        :param messages: Iterable of `(number, text)` tuples or dicts with
+                         arguments for :py:meth:`send`
+        :type messages: iterable
+        :param concurrency: Maximal number of sends in flight
+        :type concurrency: int
+
+        :returns: Generator of :py:class:`pysms.sms.SendResult` in order of
+                  completion
+        """
+
+        return _dispatch(self._send, self._validate_many(messages),
+                         concurrency)
+
+class AsyncResult(object):
+    """
+    Result of an operation that completes later, see :py:class:`AsyncSms`
+    """
+
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.exception = None
+
+        self._callbacks = []
+
+    def set_result(self, value):
+        """Completes operation with value"""
+
+        self.value = value
+        self._complete()
+
+    def set_exception(self, exception):
+        """Completes operation with exception"""
+
+        self.exception = exception
+        self._complete()
+
+    def _complete(self):
+        self.done = True
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        """
+        Adds callback called with this result when operation completes
+
+        :param callback: Function accepting :py:class:`AsyncResult`
+        """
+
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def get(self):
+        """
+        Gets value of completed operation
+
+        :raises: Exception operation completed with
+        """
+
+        if not self.done:
+            raise SmsException("Result is not ready yet")
+        if self.exception is not None:
+            raise self.exception
+
+        return self.value
+
+class Return(Exception):
+    """
+    Raised inside :py:func:`coroutine` to complete it with a value
+    """
+
+    def __init__(self, value = None):
+        Exception.__init__(self)
+        self.value = value
+
+def coroutine(func):
+    """
+    Turns generator yielding :py:class:`AsyncResult` objects into a function
+    returning :py:class:`AsyncResult`
+
+    Value of every yielded result is sent back into the generator, or its
+    exception is raised there, so asynchronous code reads like blocking one.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = AsyncResult()
+        gen = func(*args, **kwargs)
+
+        def step(value = None, exception = None):
+            try:
+                if exception is not None:
+                    yielded = gen.throw(exception)
+                else:
+                    yielded = gen.send(value)
+            except StopIteration:
+                result.set_result(None)
+            except Return as e:
+                result.set_result(e.value)
+            except Exception as e:
+                result.set_exception(e)
+            else:
+                yielded.add_callback(lambda r: step(r.value, r.exception))
+
+        step()
+        return result
+
+    return wrapper
+
+class AsyncSms(object):
+    """
+    Abstract base class for sending sms-es without blocking.
+
+    Methods return :py:class:`AsyncResult` immediately, while the work is
+    done by :py:meth:`run`, which drives the :py:mod:`asyncore` event loop.
+    Providers constructed with the same `socket_map` share one event loop.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    CAP_SILENT = Sms.CAP_SILENT
+    CAP_SPOOF_SOURCE = Sms.CAP_SPOOF_SOURCE
+    CAP_DELIVERY_REPORT = Sms.CAP_DELIVERY_REPORT
+
+    InitSchema = Sms.InitSchema
+    SendSchema = Sms.SendSchema
+
+    capabilities = None
+    """Flag representing sms provider capabilities"""
+
+    def __init__(self, socket_map = None):
+        """
+        Constructor
+
+        :param socket_map: :py:mod:`asyncore` socket map to run on
+        :type socket_map: dict
+        """
+
+        self.socket_map = {} if socket_map is None else socket_map
+
+        self._timers = []
+        self._timer_ids = itertools.count()
+
+    def balance(self):
+        """
+        Balance in form of money or sms-es left on provider
+
+        :returns: Result with balance as value
+        :rtype: :py:class:`AsyncResult`
+        """
+
+        result = AsyncResult()
+        result.set_result(float('inf'))
+
+        return result
+
+    def send(self, number, text):
+        """
+        Sends sms
+
+        :param number: Number where sms should be sent
+        :type number: str
+        :param text: Text you want to send
+        :type text: str
+
+        :returns: Result with balance as value
+        :rtype: :py:class:`AsyncResult`
+        """
+
+        raise NotImplementedError
+
+    def _send(self, params):
+        """
+        Sends sms with already validated parameters
+
+        :param params: Deserialized :py:class:`SendSchema` data
+        :type params: dict
+        """
+
+        return self.send(**params)
+
+    def _validate(self, data):
+        return _validate(self, data)
+
+    def send_many(self, messages, callback = None, concurrency = 100):
+        """
+        Sends many sms-es
+
+        Messages are pulled from the iterable only as sends complete, so at
+        most `concurrency` sends are in flight and messages are never all
+        loaded in memory.
+
+        :param messages: Iterable of `(number, text)` tuples or dicts with
+                         arguments for :py:meth:`send`
+        :type messages: iterable
+        :param callback: Function called with :py:class:`SendResult` as each
+                         sms completes
+        :param concurrency: Maximal number of sends in flight
+        :type concurrency: int
+
+        :returns: Result with number of sent sms-es as value
+        :rtype: :py:class:`AsyncResult`
+        """
+
+        done = AsyncResult()
+        prepared = _validate_many(compile_schema(self.SendSchema),
+                                  _send_defaults(self.send), messages,
+                                  type(self).__name__)
+        state = {"pending": 0, "sent": 0, "exhausted": False, "filling": False}
+
+        def complete(result):
+            if result.ok:
+                state["sent"] += 1
+            if callback:
+                callback(result)
+
+        def sent(index, message, res):
+            state["pending"] -= 1
+            complete(SendResult(index, message, res.value, res.exception))
+            fill()
+
+        def fill():
+            # Sends completing right away would otherwise recurse here
+            if state["filling"]:
+                return
+            state["filling"] = True
+
+            while not state["exhausted"] and state["pending"] < concurrency:
+                try:
+                    index, message, params, exception = next(prepared)
+                except StopIteration:
+                    state["exhausted"] = True
+                    break
+
+                if exception is not None:
+                    complete(SendResult(index, message, exception = exception))
+                    continue
+
+                state["pending"] += 1
+                try:
+                    res = self._send(params)
+                except SmsException as e:
+                    res = AsyncResult()
+                    res.set_exception(e)
+
+                res.add_callback(functools.partial(sent, index, message))
+
+            state["filling"] = False
+            if state["exhausted"] and not state["pending"] and not done.done:
+                done.set_result(state["sent"])
+
+        fill()
+        return done
+
+    def _sleep(self, seconds):
+        """
+        Returns result completing after `seconds`, while :py:meth:`run` runs
+
+        :param seconds: Seconds to wait
+        :type seconds: float
+
+        :rtype: :py:class:`AsyncResult`
+        """
+
+        result = AsyncResult()
+        heapq.heappush(self._timers, (time.time() + seconds,
+                                      next(self._timer_ids), result))
+
+        return result
+
+    def _fire_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            heapq.heappop(self._timers)[2].set_result(None)
+
+    def _poll(self, timeout):
+        asyncore.loop(timeout, True, self.socket_map, 1)
+
+    def run(self, result = None, timeout = None):
+        """
+        Runs event loop until result completes or there is no more work
+
+        :param result: Result to wait for
+        :type result: :py:class:`AsyncResult`
+        :param timeout: Maximal time to run in seconds
+        :type timeout: float
+
+        :returns: Value of result
+        :raises: :py:exc:`pysms.sms.CommunicationException` on timeout, or
+                 exception result completed with
+        """
+
+        deadline = time.time() + timeout if timeout else None
+        while (self.socket_map or self._timers) and \
+              not (result and result.done):
+            if deadline and time.time() > deadline:
+                raise CommunicationException("Timeout running event loop")
+
+            if self.socket_map:
+                self._poll(0.05)
+            else:
+                # Only timers are left, like retries waiting for backoff
+                time.sleep(max(0, min(0.05, self._timers[0][0] - time.time())))
+            self._fire_timers()
+
+        if result:
+            return result.get()
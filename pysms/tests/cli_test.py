@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import tempfile
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from pysms import cli
+
+class Input(StringIO):
+    """Stdin counting lines read"""
+
+    def __init__(self, data):
+        StringIO.__init__(self, data)
+        self.lines = 0
+
+    def readline(self, *args):
+        self.lines += 1
+        return StringIO.readline(self, *args)
+
+class Output(StringIO):
+    """Stdout remembering how much input was read at first result"""
+
+    def __init__(self, stdin):
+        StringIO.__init__(self)
+        self.stdin = stdin
+        self.first = None
+
+    def write(self, data):
+        if self.first is None:
+            self.first = self.stdin.lines
+        StringIO.write(self, data)
+
+class unit_tests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def config(self, config):
+        path = os.path.join(self.dir, "config.json")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        return path
+
+    def run_cli(self, data, *args, **config):
+        stdin = Input(data)
+        stdout = Output(stdin)
+        stderr = StringIO()
+        config = config.get("config", {"provider": "MemorySms",
+                                       "options": {"balance": 10}})
+        status = cli.main(["--config", self.config(config), "--progress", "0"]
+                          + list(args), stdin, stdout, stderr)
+
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        return status, results, stderr.getvalue(), stdout.first
+
+    def test_jsonl(self):
+        status, results, progress, first = self.run_cli(
+            '{"number": "+38641928491", "text": "test"}\n'
+            '\n'
+            '["+38641928492", "test"]\n'
+            'not json\n'
+            '{"number": "abc", "text": "test"}\n')
+
+        self.assertEqual(status, 1)
+        results = dict((result["index"], result) for result in results)
+        self.assertEqual(results[0], {"index": 0, "number": "+38641928491",
+                                      "ok": True, "value": 9})
+        self.assertEqual(results[1]["value"], 8)
+        self.assertEqual(results[2]["error"], "InputException")
+        self.assertEqual(results[3]["error"], "InputException")
+        self.assertEqual(results[3]["number"], "abc")
+        self.assertIn("2 sent, 2 failed", progress)
+
+    def test_csv(self):
+        path = os.path.join(self.dir, "messages.csv")
+        with open(path, "w") as f:
+            f.write('number,text\n'
+                    '+38641928491,"test, with comma"\n'
+                    '+38641928492,\xc4\x8d\xc5\xbe\xc5\xa1\n'
+                    '+38641928493\n')
+
+        status, results, progress, first = self.run_cli("", path)
+
+        self.assertEqual(status, 1)
+        self.assertEqual([result["ok"] for result in results],
+                         [False, True, True])
+        self.assertEqual(results[0]["message"], "Expected 2 columns, got 1")
+
+        with open(path, "w") as f:
+            f.write('phone,text\n+38641928491,test\n')
+        with self.assertRaises(SystemExit):
+            self.run_cli("", path)
+
+    def test_lazy(self):
+        data = '{"number": "+38641928491", "text": "test"}\n' * 10000
+
+        status, results, progress, first = self.run_cli(
+            data, "--chunk-size", "10", "--concurrency", "4",
+            config = {"provider": "MemorySms"})
+
+        self.assertEqual(status, 0)
+        self.assertEqual(len(results), 10000)
+        # Unlimited balance is not valid json
+        self.assertIsNone(results[0]["value"])
+        # Sending starts before the rest of input is read
+        self.assertLessEqual(first, 11)
+
+    def test_router(self):
+        status, results, progress, first = self.run_cli(
+            '["+38641928491", "test"]\n' * 15,
+            config = [{"provider": "MemorySms", "options": {"balance": 10}},
+                      {"provider": "MemorySms", "options": {"balance": 10}}])
+
+        self.assertEqual(status, 0)
+        self.assertEqual(len(results), 15)
+
+    def test_processes(self):
+        status, results, progress, first = self.run_cli(
+            '["+38641928491", "test"]\n' * 1000,
+            "--processes", "3", "--chunk-size", "50", "--concurrency", "2",
+            config = {"provider": "MemorySms"})
+
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(result["index"] for result in results),
+                         range(1000))
+        self.assertIn("1000 sent, 0 failed", progress)
+
+    def test_invalid_config(self):
+        with self.assertRaises(SystemExit):
+            self.run_cli("", config = {"provider": "Unknown"})
+
+        status, results, progress, first = self.run_cli(
+            '["+38641928491", "test"]\n', "--processes", "2",
+            config = {"provider": "MemorySms", "options": {"unknown": 1}})
+
+        self.assertEqual(status, 2)
+        self.assertIn("Worker failed TypeError", progress)
+
+    def test_worker_failed(self):
+        # Sleeping for a string raises outside of send_many
+        status, results, progress, first = self.run_cli(
+            '["+38641928491", "test"]\n' * 100,
+            "--processes", "1", "--chunk-size", "1",
+            config = {"provider": "MemorySms", "options": {"latency": "x"}})
+
+        self.assertEqual(status, 2)
+        self.assertIn("Worker failed TypeError", progress)
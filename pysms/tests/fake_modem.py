@@ -0,0 +1,108 @@
+"""
+Gsm modem simulated on a pseudo terminal, for testing and benchmarking
+:py:class:`pysms.providers.GsmModemSms` without real hardware.
+"""
+
+import os
+import re
+import time
+import select
+import threading
+
+class FakeModem(object):
+    """
+    Answers AT commands written to the slave side of a pty
+
+    :param delay: Seconds to wait before answering each command
+    :param submit_delay: Seconds to wait before acknowledging a pdu
+    """
+
+    def __init__(self, delay = 0, submit_delay = 0):
+        self.delay = delay
+        self.submit_delay = submit_delay
+        self.dead = False
+
+        self.commands = []
+        self.pdus = []
+        self.reference = 0
+
+        self.master, self.slave = os.openpty()
+        self.port = os.ttyname(self.slave)
+
+        self._buffer = ""
+        self._pdu_mode = False
+        self._running = True
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def _run(self):
+        while self._running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+
+            try:
+                self._buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+
+            while self._handle():
+                pass
+
+    def _handle(self):
+        if self._pdu_mode:
+            pdu, sep, rest = self._buffer.partition("\x1A")
+            if not sep:
+                return False
+
+            self._buffer = rest
+            self._pdu_mode = False
+            self.pdus.append(pdu)
+            self.reference = (self.reference + 1) % 256
+            self._answer("\r\n+CMGS: %d\r\n\r\nOK\r\n" %self.reference,
+                         self.submit_delay)
+            return True
+
+        command, sep, rest = self._buffer.partition("\r")
+        if not sep:
+            return False
+
+        self._buffer = rest
+        command = command.strip()
+        if not command:
+            return True
+        self.commands.append(command)
+
+        if re.match(r"AT\+CMGS=\d+$", command):
+            self._pdu_mode = True
+            self._answer("\r\n> ", self.delay)
+        elif command in ("AT", "AT+CMGF=0") or \
+             re.match(r"AT\+(CSCA|CPMS|CNMI)=", command):
+            self._answer("\r\nOK\r\n", self.delay)
+        else:
+            self._answer(self.respond(command), self.delay)
+
+        return True
+
+    def respond(self, command):
+        """Answer to commands fake modem does not know, override in tests"""
+
+        return "\r\nERROR\r\n"
+
+    def _answer(self, data, delay):
+        if self.dead:
+            return
+        if delay:
+            time.sleep(delay)
+
+        self.write(data)
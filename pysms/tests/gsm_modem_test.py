@@ -0,0 +1,656 @@
+import time
+import datetime
+import threading
+import Queue
+
+from unittest import TestCase
+from mock import Mock, patch
+from smspdu import SMS_SUBMIT, SMS_DELIVER
+from smspdu.pdu import pack_date
+
+from pysms import CommunicationException, InputException, SendException
+from pysms import RetryPolicy
+from pysms.providers import GsmModemSms, GsmModemPool, PreparedMessage
+from pysms.providers.gsm_modem import _decode_status_report
+from pysms.tests.fake_modem import FakeModem
+
+class FakeSerial(object):
+    """
+    Serial port answering written commands with scripted responses
+    """
+
+    def __init__(self, responses, delay = 0):
+        self.responses = responses
+        self.delay = delay
+        self.written = []
+        self.pending = ""
+        self.ready_at = 0
+
+    def write(self, data):
+        self.written.append(data)
+        self.pending += self.responses(data)
+        self.ready_at = time.time() + self.delay
+
+    def inWaiting(self):
+        return len(self.pending) if time.time() >= self.ready_at else 0
+
+    def read(self, size = 1):
+        if time.time() < self.ready_at:
+            time.sleep(self.ready_at - time.time())
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+def modem_responses(data):
+    if data.startswith("AT+CMGS"):
+        return data + "\r\n> "
+    if data.endswith("\x1A"):
+        return data[:-1] + "\r\n+CMGS: 12\r\n\r\nOK\r\n"
+    if data.startswith("AT+FAIL"):
+        return data + "\r\n+CMS ERROR: 500\r\n"
+    if data.startswith("AT+SILENT"):
+        return ""
+    return data + "\r\nOK\r\n"
+
+def status_report(reference, number, status):
+    """
+    Creates SMS-STATUS-REPORT pdu, without service center address
+    """
+
+    tp_al, tp_toa, packed = SMS_SUBMIT.determineAddress(number)
+    stamp = pack_date("130221183000+04").encode("hex").upper()
+
+    return "0006%02X%02X%02X%s%s%s%02X" %(reference, tp_al, tp_toa,
+                                          packed.encode("hex").upper(),
+                                          stamp, stamp, status)
+
+def deliver(text, part = None):
+    """
+    Creates SMS-DELIVER pdu, with `part` as `(reference, count, seq)`
+    """
+
+    return "00" + SMS_DELIVER.create("38641928491", "", text,
+                                     tp_scts = "130221183000+04",
+                                     user_data_headers = [(0, part)] if part else []
+                                     ).toPDU()
+
+class framing_tests(TestCase):
+    def setUp(self):
+        self.s = GsmModemSms(retries = 0, response_timeout = 0.5)
+        self.s.sp = FakeSerial(modem_responses)
+
+    def test_final_result(self):
+        self.assertEqual(self.s._ser_send("AT\r"), "AT\r\r\nOK\r\n")
+
+        with self.assertRaisesRegexp(CommunicationException, r"\+CMS ERROR: 500"):
+            self.s._ser_send_verify("AT+FAIL")
+
+    def test_prompt(self):
+        response = self.s._ser_send("AT+CMGS=10\r", prompt = True)
+        self.assertTrue(response.endswith("> "))
+
+    def test_returns_without_timeout(self):
+        self.s.sp.delay = 0.01
+
+        start = time.time()
+        for x in range(10):
+            self.s._ser_send_verify("AT")
+
+        # Read timeout is 0.2s, so waiting for it would take at least 2s
+        self.assertLess(time.time() - start, 1)
+
+    def test_timeout(self):
+        with self.assertRaisesRegexp(CommunicationException, "Timeout"):
+            self.s._ser_send("AT+SILENT\r")
+
+    def test_send(self):
+        self.assertEqual(self.s.send("+38641928491", u"test"), 12)
+
+        self.assertEqual(self.s.sp.written[:2], ["AT\r", "AT+CMGF=0\r"])
+        self.assertEqual(len(self.s.sp.written), 4)
+
+    def test_unsolicited(self):
+        report = "\r\n+CDS: 25\r\n%s\r\n" %status_report(12, "38641928491", 0)
+        self.s.sp.responses = lambda data: data + report + "\r\nOK\r\n"
+
+        self.assertEqual(self.s._ser_send("AT\r"), "AT\r\r\nOK\r\n")
+
+    def test_unsolicited_split(self):
+        self.s._reporter = Mock()
+        pdu = status_report(12, "38641928491", 0)
+        # Code started arriving after response to previous command
+        self.s._buffer.extend("\r\nOK\r\n\r\n+C")
+        self.s.sp.responses = lambda data: "DS: 25\r\n%s\r\n%s\r\nOK\r\n" %(pdu, data)
+
+        self.assertEqual(self.s._ser_send("AT\r"), "AT\r\r\nOK\r\n")
+        self.assertEqual(self.s._unsolicited.get_nowait(), ("CDS", pdu))
+
+class state_tests(TestCase):
+    def setUp(self):
+        self.s = GsmModemSms(retries = 0, response_timeout = 0.5,
+                             smsc = "+38640441000", storage = "SM")
+        self.s.sp = FakeSerial(modem_responses)
+
+    def commands(self):
+        return [d.split("=")[0].strip() for d in self.s.sp.written
+                if d.startswith("AT")]
+
+    def test_setup_once(self):
+        self.s.send("+38641928491", u"test")
+        self.s.send("+38641928492", u"test")
+
+        self.assertEqual(self.commands(), ["AT", "AT+CMGF", "AT+CSCA",
+                                           "AT+CPMS", "AT+CMGS", "AT+CMGS"])
+
+    def test_setup_after_error(self):
+        self.s.send("+38641928491", u"test")
+        with self.assertRaises(CommunicationException):
+            self.s._ser_send_verify("AT+FAIL")
+        self.s.send("+38641928492", u"test")
+
+        self.assertEqual(self.commands().count("AT+CMGF"), 2)
+
+    def test_probe(self):
+        self.s.probe_interval = 0.05
+
+        self.s.send("+38641928491", u"test")
+        self.s.send("+38641928492", u"test")
+        time.sleep(0.1)
+        self.s.send("+38641928493", u"test")
+
+        self.assertEqual(self.commands().count("AT"), 2)
+        self.assertEqual(self.commands().count("AT+CMGF"), 1)
+
+class unit_tests(TestCase):
+    def setUp(self):
+        self.s = GsmModemSms(retries = 1)
+
+        self.sent = []
+        def _ser_send(data, prompt = False, timeout = None):
+            self.sent.append(data)
+            if data.startswith("AT+CMGS"):
+                return "\r\n> "
+            return "\r\nOK\r\n"
+
+        self.s._ser_send = Mock(side_effect = _ser_send)
+
+    def test_send(self):
+        self.s.send("+38641928491", u"test")
+
+        self.assertEqual(self.sent[:2], ["AT\r", "AT+CMGF=0\r"])
+        self.assertTrue(self.sent[2].startswith("AT+CMGS="))
+        self.assertTrue(self.sent[3].endswith("\x1A"))
+
+    def test_send_once(self):
+        self.s.send("+38641928491", u"test")
+
+        self.assertEqual(len([d for d in self.sent if d.endswith("\x1A")]), 1)
+
+    def test_retry(self):
+        errors = ["\r\n+CMS ERROR: 42\r\n"]
+        def _ser_send(data, prompt = False, timeout = None):
+            self.sent.append(data)
+            if data.startswith("AT+CMGS"):
+                return "\r\n> "
+            if data.endswith("\x1A") and errors:
+                return errors.pop()
+            return "\r\nOK\r\n"
+        self.s._ser_send.side_effect = _ser_send
+
+        # Congestion is retried
+        self.s.send("+38641928491", u"test")
+        self.assertEqual(len([d for d in self.sent if d.endswith("\x1A")]), 2)
+
+        # Unassigned number is not
+        errors.append("\r\n+CMS ERROR: 1\r\n")
+        with self.assertRaises(SendException) as e:
+            self.s.send("+38641928491", u"test")
+        self.assertEqual(e.exception.code, 1)
+        self.assertEqual(len([d for d in self.sent if d.endswith("\x1A")]), 3)
+
+    def test_idempotency_key(self):
+        self.s.send("+38641928491", u"test", key = "a")
+        self.s.send("+38641928491", u"test", key = "a")
+        list(self.s.send_many([{"number": "+38641928491", "text": u"test",
+                                "key": "a"}]))
+
+        self.assertEqual(len([d for d in self.sent if d.endswith("\x1A")]), 1)
+
+    def test_send_long(self):
+        results = list(self.s.send_many([("+38641928491", u"a" * 200)]))
+
+        self.assertTrue(results[0].ok)
+        self.assertEqual(len([d for d in self.sent if d.endswith("\x1A")]), 2)
+
+    def test_send_many(self):
+        results = list(self.s.send_many([("+38641928491", u"test"),
+                                         ("-1", u"test"),
+                                         ("+38641928492", u"test")]))
+
+        self.assertTrue(results[0].ok)
+        self.assertIsInstance(results[1].exception, InputException)
+        self.assertTrue(results[2].ok)
+
+        # Modem is prepared only once for the whole batch
+        self.assertEqual(self.sent.count("AT\r"), 1)
+        self.assertEqual(self.sent.count("AT+CMGF=0\r"), 1)
+        self.assertEqual(len([d for d in self.sent if d.endswith("\x1A")]), 2)
+
+    def test_send_many_reprepare(self):
+        def _ser_send(data, prompt = False, timeout = None):
+            self.sent.append(data)
+            if data.startswith("AT+CMGS"):
+                if len(self.sent) < 4:
+                    return "\r\nERROR\r\n"
+                return "\r\n> "
+            return "\r\nOK\r\n"
+        self.s._ser_send.side_effect = _ser_send
+
+        results = list(self.s.send_many([("+38641928491", u"test")]))
+
+        self.assertTrue(results[0].ok)
+        self.assertEqual(self.sent.count("AT\r"), 2)
+
+    def test_early_report(self):
+        self.s.delivery_reports = True
+        self.s._ser_send.side_effect = lambda data, prompt = False, timeout = None: \
+            "\r\n> " if data.startswith("AT+CMGS") else "\r\n+CMGS: 12\r\n\r\nOK\r\n"
+
+        # Report read before send returned is kept for it
+        self.s._match_report(12, "+38641928491", None, None, 0)
+        self.assertEqual(self.s.send("+38641928491", u"test",
+                                     delivery_report = True, key = "a"), 12)
+
+        report, = list(self.s.reports(timeout = 0))
+        self.assertEqual((report.reference, report.key), (12, "a"))
+        self.assertTrue(report.delivered)
+
+    def test_decode_status_report(self):
+        self.assertEqual(_decode_status_report(status_report(7, "38641928491", 0x41)),
+                         (7, "+38641928491", datetime.datetime(2013, 2, 21, 18, 30),
+                          datetime.datetime(2013, 2, 21, 18, 30), 0x41))
+
+        with self.assertRaises(ValueError):
+            _decode_status_report(PreparedMessage(u"test").pdus("38641928491")[0])
+        with self.assertRaises(ValueError):
+            _decode_status_report("0006")
+
+class prepared_message_tests(TestCase):
+    def test_pdu(self):
+        for text in [u"test", u"\u010d\u017e\u0161 unicode", u"a" * 160]:
+            message = PreparedMessage(text)
+            for number in ["38641928491", "3864192849"]:
+                for silent in (False, True):
+                    for report in (False, True):
+                        expected = SMS_SUBMIT.create(
+                            "", number, text,
+                            tp_pid = 64 if silent else 0,
+                            tp_srr = 1 if report else 0).toPDU()
+                        self.assertEqual(
+                            message.pdus(number, silent = silent,
+                                         delivery_report = report),
+                            [expected])
+
+    def test_concatenated(self):
+        for text in [u"a" * 300 + u"{", u"\u010d" * 150]:
+            pdus = PreparedMessage(text).pdus("38641928491", reference = 300)
+
+            decoded = [SMS_SUBMIT.fromPDU(pdu, "") for pdu in pdus]
+            self.assertEqual(u"".join(sms.user_data for sms in decoded), text)
+            self.assertEqual([sms.concatInfo()["seq"] for sms in decoded],
+                             range(1, len(pdus) + 1))
+            for sms in decoded:
+                self.assertEqual(sms.concatInfo()["ref"], 300 % 256)
+                self.assertEqual(sms.concatInfo()["count"], len(pdus))
+                self.assertTrue(len(sms.tp_ud) <= 140)
+
+    def test_encoded_once(self):
+        s = GsmModemSms()
+        s._ser_send = Mock(side_effect = lambda data, prompt = False, timeout = None:
+                           "\r\n> " if data.startswith("AT+CMGS") else "\r\nOK\r\n")
+
+        list(s.send_many([("+3864192849%d" %i, u"test") for i in range(5)]))
+
+        self.assertEqual(s._messages.misses, 1)
+        self.assertEqual(s._messages.hits, 4)
+
+class pool_tests(TestCase):
+    def setUp(self):
+        self.fakes = []
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool:
+            self.pool.close()
+        for fake in self.fakes:
+            fake.stop()
+
+    def _pool(self, fakes, **kwargs):
+        self.fakes = fakes
+        modems = [GsmModemSms(sp_name = fake.port, retries = 0,
+                              response_timeout = 0.3) for fake in fakes]
+        self.pool = GsmModemPool(modems, **kwargs)
+
+        return self.pool
+
+    def test_send_many(self):
+        pool = self._pool([FakeModem() for x in range(3)])
+
+        results = list(pool.send_many([("+38641928491", u"test")] * 30))
+
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(sum(len(fake.pdus) for fake in self.fakes), 30)
+        self.assertTrue(all(fake.pdus for fake in self.fakes))
+
+    def test_latency_weighting(self):
+        pool = self._pool([FakeModem(), FakeModem(submit_delay = 0.05)])
+
+        for x in range(20):
+            pool.send("+38641928491", u"test")
+
+        self.assertGreaterEqual(len(self.fakes[0].pdus), 18)
+
+    def test_quarantine(self):
+        pool = self._pool([FakeModem(), FakeModem()], quarantine = 0.5)
+        self.fakes[1].dead = True
+        pool.workers[0].latency = 1
+
+        for x in range(5):
+            pool.send("+38641928491", u"test")
+
+        self.assertEqual(len(self.fakes[0].pdus), 5)
+        self.assertFalse(pool.workers[1].healthy)
+
+        # Modem recovers and gets probed back into rotation
+        self.fakes[1].dead = False
+        time.sleep(1)
+        self.assertTrue(pool.workers[1].healthy)
+
+    def test_no_modem(self):
+        pool = self._pool([FakeModem(), FakeModem()], quarantine = 0.05,
+                          retry_policy = RetryPolicy(retries = 2,
+                                                     backoff = 0.01))
+        for fake in self.fakes:
+            fake.dead = True
+
+        # Waiting sms-es fail once failed probes use up their retries
+        with self.assertRaisesRegexp(SendException, "No modem available"):
+            pool.send("+38641928491", u"test")
+        results = list(pool.send_many([("+38641928491", u"test")] * 3))
+        self.assertEqual([type(result.exception) for result in results],
+                         [SendException] * 3)
+
+    def test_worker_error(self):
+        pool = self._pool([FakeModem()])
+        send_once = pool.workers[0].modem._send_once
+        pool.workers[0].modem._send_once = Mock(side_effect = ValueError)
+
+        with self.assertRaises(ValueError):
+            pool.send("+38641928491", u"test")
+
+        # Worker survives the error
+        pool.workers[0].modem._send_once = send_once
+        pool.send("+38641928491", u"test")
+        self.assertEqual(len(self.fakes[0].pdus), 1)
+
+    def test_partly_sent(self):
+        class DyingModem(FakeModem):
+            def _answer(self, data, delay):
+                FakeModem._answer(self, data, delay)
+                # Stops answering after first segment is submitted
+                if "+CMGS:" in data:
+                    self.dead = True
+
+        pool = self._pool([DyingModem(), FakeModem()])
+        pool.workers[1].latency = 1
+
+        with self.assertRaises(CommunicationException):
+            pool.send("+38641928491", u"a" * 200)
+
+        # Rest of segments is not resent from another modem
+        self.assertEqual(len(self.fakes[0].pdus), 1)
+        self.assertEqual(self.fakes[1].pdus, [])
+
+    def test_transient_cms_error(self):
+        class BusyModem(FakeModem):
+            errors = ["42", "42"]
+
+            def _answer(self, data, delay):
+                # Rejects pdus with scripted +CMS ERROR codes first
+                if "+CMGS:" in data and self.errors:
+                    data = "\r\n+CMS ERROR: %s\r\n" %self.errors.pop(0)
+                FakeModem._answer(self, data, delay)
+
+        pool = self._pool([BusyModem()],
+                          retry_policy = RetryPolicy(retries = 2,
+                                                     backoff = 0.01))
+
+        # Congestion is retried on the same, still healthy modem
+        pool.send("+38641928491", u"test")
+        self.assertEqual(self.fakes[0].errors, [])
+        self.assertTrue(pool.workers[0].healthy)
+
+        # Rejected sms is not retried
+        self.fakes[0].errors = ["21", "21"]
+        with self.assertRaises(SendException):
+            pool.send("+38641928491", u"test")
+        self.assertEqual(self.fakes[0].errors, ["21"])
+        self.assertEqual(len(self.fakes[0].pdus), 4)
+
+    def test_scaling(self):
+        messages = [("+38641928491", u"test")] * 40
+
+        results = list(self._pool([FakeModem(submit_delay = 0.02)
+                                   for x in range(4)]).send_many(messages))
+
+        # Slow submits are spread over all modems
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(sum(len(fake.pdus) for fake in self.fakes), 40)
+        self.assertTrue(all(fake.pdus for fake in self.fakes))
+
+class thread_tests(TestCase):
+    def setUp(self):
+        self.fake = FakeModem(submit_delay = 0.005)
+        self.s = GsmModemSms(sp_name = self.fake.port, retries = 0,
+                             response_timeout = 0.5)
+
+    def tearDown(self):
+        self.s.close()
+        self.fake.stop()
+
+    def test_threads(self):
+        references = []
+        def send():
+            for x in range(10):
+                references.append(self.s.send("+38641928491", u"test"))
+
+        threads = [threading.Thread(target = send) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Commands were not interleaved, every pdu got its own reference
+        self.assertEqual(len(self.fake.pdus), 40)
+        self.assertEqual(sorted(references), range(1, 41))
+        self.assertEqual(self.fake.commands.count("AT+CMGF=0"), 1)
+
+    def test_close(self):
+        self.s.send("+38641928491", u"test")
+        writer = self.s._writer
+        self.s.close()
+
+        self.assertFalse(writer.is_alive())
+        self.assertIsNone(self.s.sp)
+
+        # Modem can be used again after close
+        self.s.send("+38641928491", u"test")
+        self.assertEqual(len(self.fake.pdus), 2)
+
+class report_tests(TestCase):
+    def setUp(self):
+        self.fake = FakeModem()
+        self.received = []
+        self.s = GsmModemSms(sp_name = self.fake.port, retries = 0,
+                             response_timeout = 0.5, delivery_reports = True)
+
+    def tearDown(self):
+        self.s.close()
+        self.fake.stop()
+
+    def unsolicited(self, reference, status):
+        self.fake.write("\r\n+CDS: 25\r\n%s\r\n"
+                        %status_report(reference, "38641928491", status))
+
+    def test_report(self):
+        reference = self.s.send("+38641928491", u"test", delivery_report = True)
+        self.assertIn("AT+CNMI=2,0,0,1,0", self.fake.commands)
+
+        self.unsolicited(reference, 0)
+        report = next(self.s.reports(timeout = 1))
+
+        self.assertEqual((report.reference, report.number, report.account),
+                         (reference, "+38641928491", self.fake.port))
+        self.assertTrue(report.delivered)
+
+    def test_long(self):
+        reference = self.s.send("+38641928491", u"a" * 200,
+                                delivery_report = True)
+
+        # Service center is still trying
+        self.unsolicited(reference + 1, 0x21)
+        report = next(self.s.reports(timeout = 1))
+        self.assertFalse(report.final)
+
+        # Long sms is reported once, after all of its segments
+        self.unsolicited(reference + 1, 0)
+        self.unsolicited(reference, 0x41)
+        report, = list(self.s.reports(timeout = 0.5))
+
+        self.assertEqual((report.reference, report.status), (reference, 0x41))
+        self.assertFalse(report.delivered)
+
+    def test_interleaved(self):
+        self.s.on_report = self.received.append
+
+        for x in range(10):
+            reference = self.s.send("+38641928491", u"test",
+                                    delivery_report = True)
+            self.unsolicited(reference, 0)
+        self.s.send("+38641928491", u"test")
+
+        for x in range(50):
+            if len(self.received) == 10:
+                break
+            time.sleep(0.02)
+        self.assertEqual(len(self.received), 10)
+
+    def test_stored(self):
+        done = threading.Event()
+        self.s.on_report = lambda report: (self.received.append(report),
+                                           done.set())
+        pdu = status_report(1, "38641928491", 0)
+        self.fake.respond = lambda command: {
+            "AT+CMGR=3": "\r\n+CMGR: 0,,25\r\n%s\r\n\r\nOK\r\n" %pdu,
+            "AT+CMGD=3": "\r\nOK\r\n"}.get(command, "\r\nERROR\r\n")
+
+        self.assertEqual(self.s.send("+38641928491", u"test",
+                                     delivery_report = True), 1)
+        self.fake.write('\r\n+CDSI: "SM",3\r\n')
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(self.received[0].reference, 1)
+        self.assertEqual(self.fake.commands[-2:], ["AT+CMGR=3", "AT+CMGD=3"])
+
+class receive_tests(TestCase):
+    def setUp(self):
+        self.fake = FakeModem()
+        self.stored = []
+        self.fake.respond = self.respond
+        self.s = GsmModemSms(sp_name = self.fake.port, retries = 0,
+                             response_timeout = 0.5, receive_messages = True)
+
+    def tearDown(self):
+        self.s.close()
+        self.fake.stop()
+
+    def respond(self, command):
+        if command == "AT+CMGL=4":
+            self.read = list(self.stored)
+            return "".join("\r\n+CMGL: %d,0,,%d\r\n%s" %(index, len(pdu) / 2 - 1, pdu)
+                           for index, pdu in enumerate(self.read, 1)) + \
+                   "\r\n\r\nOK\r\n"
+        if command == "AT+CMGD=1,1":
+            # Only sms-es already read are deleted
+            for pdu in self.read:
+                self.stored.remove(pdu)
+            return "\r\nOK\r\n"
+        return "\r\nERROR\r\n"
+
+    def test_stored(self):
+        self.stored = [deliver(u"part two", (7, 2, 2)), deliver(u"hello"),
+                       deliver(u"part one ", (7, 2, 1))]
+
+        messages = list(self.s.received(timeout = 0.5))
+
+        self.assertEqual([(m.number, m.text, m.complete) for m in messages],
+                         [("+38641928491", u"hello", True),
+                          ("+38641928491", u"part one part two", True)])
+        self.assertEqual(messages[0].sent, datetime.datetime(2013, 2, 21, 18, 30))
+        self.assertIn("AT+CNMI=2,1,0,0,0", self.fake.commands)
+        self.assertEqual(self.fake.commands[-2:], ["AT+CMGL=4", "AT+CMGD=1,1"])
+        self.assertEqual(self.stored, [])
+
+    def test_announced(self):
+        received = self.s.received(timeout = 1)
+        self.s.listen()
+
+        # Announcements arrive between sends on the same serial port
+        for x in range(5):
+            self.stored.append(deliver(u"reply %d" %x))
+            self.fake.write('\r\n+CMTI: "SM",%d\r\n' %len(self.stored))
+            self.s.send("+38641928491", u"test")
+        self.fake.write("\r\n+CMT: ,20\r\n%s\r\n" %deliver(u"direct"))
+
+        texts = [next(received).text for x in range(6)]
+
+        self.assertEqual(sorted(texts), [u"direct"] + [u"reply %d" %x
+                                                       for x in range(5)])
+        self.assertEqual(len(self.fake.pdus), 5)
+
+    def test_close_full_inbox(self):
+        self.s._inbox = Queue.Queue(maxsize = 1)
+        self.stored = [deliver(u"one"), deliver(u"two")]
+        self.s.listen()
+        self.fake.write('\r\n+CMTI: "SM",2\r\n')
+        for x in range(50):
+            if self.s._inbox.full():
+                break
+            time.sleep(0.02)
+
+        # Nobody reads received sms-es, so reporter waits for space
+        closing = threading.Thread(target = self.s.close)
+        closing.start()
+        closing.join(2)
+        self.assertFalse(closing.is_alive())
+
+        # Sms-es not taken are left in modem storage
+        self.assertNotIn("AT+CMGD=1,1", self.fake.commands)
+        self.assertEqual(len(self.stored), 2)
+
+    def test_not_receiving(self):
+        s = GsmModemSms(sp_name = self.fake.port, receive_messages = False)
+        with self.assertRaises(InputException):
+            s.received()
+
+        self.s.on_message = Mock()
+        with self.assertRaises(InputException):
+            self.s.received()
+
+    def test_incomplete(self):
+        self.s.on_message = Mock()
+
+        with patch("pysms.providers.gsm_modem._max_parts", 0):
+            self.s._receive_part(deliver(u"part one ", (7, 2, 1)))
+
+        message, = self.s.on_message.call_args[0]
+        self.assertEqual((message.text, message.complete), (u"part one ", False))
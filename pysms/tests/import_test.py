@@ -0,0 +1,54 @@
+import os
+import sys
+import subprocess
+
+from unittest import TestCase
+
+import pysms
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(pysms.__file__)))
+
+def run(code):
+    return subprocess.check_output([sys.executable, "-c", code],
+                                   cwd = root).strip()
+
+class import_tests(TestCase):
+    def test_lazy_providers(self):
+        self.assertEqual(run("import sys, pysms.providers; "
+                             "print 'mechanize' in sys.modules, "
+                             "'serial' in sys.modules"), "False False")
+        self.assertEqual(run("import sys; "
+                             "from pysms.providers import GsmModemSms; "
+                             "print 'mechanize' in sys.modules, "
+                             "'serial' in sys.modules"), "False True")
+
+    def test_providers_list(self):
+        import pysms.providers
+        from pysms.providers import NajdiSiSms, GsmModemSms, get_provider
+
+        self.assertEqual(pysms.providers.providers, [NajdiSiSms, GsmModemSms])
+        self.assertIs(get_provider("GsmModemSms"), GsmModemSms)
+        with self.assertRaises(KeyError):
+            get_provider("Sms")
+        with self.assertRaises(ImportError):
+            from pysms.providers import Nonexistent
+
+    def test_no_locale_change(self):
+        self.assertEqual(run("import locale; "
+                             "before = locale.setlocale(locale.LC_ALL); "
+                             "import pysms; "
+                             "print before == locale.setlocale(locale.LC_ALL)"),
+                         "True")
+
+    def test_lazy_modules(self):
+        # Provider modules are imported only once their class is used
+        self.assertEqual(run("import sys, pysms.providers; "
+                             "print sorted(name for name in sys.modules "
+                             "if name.startswith('pysms.providers.') "
+                             "and sys.modules[name])"), "[]")
+        self.assertEqual(run("import sys; "
+                             "from pysms.providers import NajdiSiSms; "
+                             "print sorted(name for name in sys.modules "
+                             "if name.startswith('pysms.providers.') "
+                             "and sys.modules[name])"),
+                         "['pysms.providers.najdisi']")
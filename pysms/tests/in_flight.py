@@ -0,0 +1,28 @@
+"""
+Counter of calls in flight, for testing that sends overlap without
+measuring wall clock.
+"""
+
+import threading
+
+class InFlight(object):
+    """
+    Context manager counting threads inside it
+
+    Remembers the most threads that were inside at once as `peak`.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.peak = 0
+
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.now += 1
+            self.peak = max(self.peak, self.now)
+
+    def __exit__(self, *args):
+        with self._lock:
+            self.now -= 1
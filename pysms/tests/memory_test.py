@@ -0,0 +1,115 @@
+import time
+import threading
+
+from unittest import TestCase
+
+from pysms import SendException, CommunicationException, InputException
+from pysms.providers import MemorySms
+from pysms.tests.in_flight import InFlight
+
+class unit_tests(TestCase):
+    def test_send(self):
+        s = MemorySms(balance = 10)
+
+        self.assertEqual(s.send("+38641928491", u"test"), 9)
+        # Long sms is charged per segment
+        self.assertEqual(s.send("+38641928492", u"a" * 200), 7)
+
+        self.assertEqual(list(s.messages), [("+38641928491", u"test"),
+                                            ("+38641928492", u"a" * 200)])
+        self.assertEqual((s.sent, s.segments), (2, 3))
+
+    def test_key(self):
+        s = MemorySms(balance = 10)
+
+        self.assertEqual(s.send("+38641928491", u"test", key = "a"), 9)
+        self.assertEqual(s.send("+38641928491", u"test", key = "a"), 9)
+        self.assertEqual(s.send("+38641928491", u"test", key = "b"), 8)
+
+        self.assertEqual(s.sent, 2)
+
+    def test_out_of_balance(self):
+        s = MemorySms(balance = 1)
+
+        s.send("+38641928491", u"test")
+        with self.assertRaises(SendException):
+            s.send("+38641928491", u"test")
+
+        self.assertEqual(s.balance, 0)
+        self.assertEqual(s.failed, {"SendException": 1})
+
+    def test_validation(self):
+        s = MemorySms()
+
+        results = list(s.send_many([("+38641928491", u"test"),
+                                    ("abc", u"test")]))
+
+        self.assertIsInstance(results[1].exception, InputException)
+        self.assertEqual(s.sent, 1)
+
+    def test_errors(self):
+        s = MemorySms(errors = {CommunicationException: 0.2,
+                                SendException: 0.1}, seed = 1)
+
+        results = list(s.send_many(("+38641928491", u"test")
+                                   for x in range(10000)))
+
+        self.assertEqual(sum(result.ok for result in results), s.sent)
+        self.assertAlmostEqual(s.failed["CommunicationException"] / 10000.,
+                               0.2, places = 1)
+        self.assertAlmostEqual(s.failed["SendException"] / 10000.,
+                               0.1, places = 1)
+
+        with self.assertRaises(ValueError):
+            MemorySms(errors = {CommunicationException: 0.7,
+                                SendException: 0.4})
+        with self.assertRaises(ValueError):
+            MemorySms(errors = {ValueError: 0.1})
+
+    def test_latency(self):
+        flight = InFlight()
+        def latency():
+            with flight:
+                time.sleep(0.01)
+            return 0
+
+        s = MemorySms(latency = latency)
+        results = list(s.send_many([("+38641928491", u"test")] * 20, 10))
+
+        # Sends in flight wait concurrently, but no more than allowed
+        self.assertTrue(all(result.ok for result in results))
+        self.assertGreater(flight.peak, 1)
+        self.assertLessEqual(flight.peak, 10)
+
+    def test_bounded_record(self):
+        s = MemorySms(record = 100)
+
+        for result in s.send_many(("+38641928491", u"test %d" %x)
+                                  for x in range(1000)):
+            pass
+
+        self.assertEqual(len(s.messages), 100)
+        self.assertEqual(s.messages[-1], ("+38641928491", u"test 999"))
+        self.assertEqual(s.sent, 1000)
+
+        s.clear()
+        self.assertEqual((len(s.messages), s.sent), (0, 0))
+
+    def test_threads(self):
+        s = MemorySms(balance = 1000)
+
+        def send():
+            for x in range(300):
+                try:
+                    s.send("+38641928491", u"test")
+                except SendException:
+                    pass
+
+        threads = [threading.Thread(target = send) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(s.sent, 1000)
+        self.assertEqual(s.failed["SendException"], 200)
@@ -0,0 +1,147 @@
+import time
+
+from unittest import TestCase
+from mock import Mock
+
+from pysms import metrics, CommunicationException
+from pysms.metrics import PrometheusCollector
+from pysms.providers import NajdiSiSms, GsmModemSms
+from pysms.tests.gsm_modem_test import FakeSerial, modem_responses
+
+class Recorder(object):
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, kind, name, value, labels):
+        self.events.append((kind, name, value, labels))
+
+    def names(self, kind = None):
+        return [name for k, name, value, labels in self.events
+                if kind is None or k == kind]
+
+class events_tests(TestCase):
+    def setUp(self):
+        self.recorder = Recorder()
+        metrics.subscribe(self.recorder)
+
+    def tearDown(self):
+        metrics.unsubscribe(self.recorder)
+
+    def test_timed(self):
+        with metrics.timed("stage", provider = "test"):
+            time.sleep(0.01)
+
+        with self.assertRaises(ValueError):
+            with metrics.timed("stage", provider = "test"):
+                raise ValueError
+
+        self.assertEqual(len(self.recorder.events), 2)
+        kind, name, value, labels = self.recorder.events[0]
+        self.assertEqual((kind, name, labels),
+                         (metrics.TIMING, "stage", {"provider": "test"}))
+        self.assertGreaterEqual(value, 0.01)
+
+    def test_unsubscribed(self):
+        metrics.unsubscribe(self.recorder)
+        metrics.count("stage")
+        with metrics.timed("stage"):
+            pass
+        metrics.subscribe(self.recorder)
+
+        self.assertEqual(self.recorder.events, [])
+
+    def test_najdisi(self):
+        s = NajdiSiSms(username = "test", password = "test", retries = 1)
+
+        def _do_login():
+            s._session = "1361468289330"
+            s._balance = 10
+        s._do_login = Mock(side_effect = _do_login)
+        s.transport = Mock()
+        s.transport.open.return_value.body = '{"msg_left": "9"}'
+
+        s.send("041928491", "test")
+        s.send("041928491", "test")
+
+        self.assertEqual(self.recorder.names(),
+                         ["validate", "login", "http",
+                          "validate", "session_reuse", "http"])
+
+        s.transport.open.side_effect = [CommunicationException(),
+                                        Mock(body = '{"msg_left": "8"}')]
+        del self.recorder.events[:]
+        s.send("041928491", "test")
+
+        self.assertEqual(self.recorder.names(metrics.COUNTER),
+                         ["session_reuse", "retry"])
+        self.assertEqual(self.recorder.names(metrics.TIMING).count("login"), 1)
+
+    def test_gsm_modem(self):
+        s = GsmModemSms(retries = 0, response_timeout = 0.5)
+        s.sp = FakeSerial(modem_responses)
+
+        s.send("+38641928491", u"a" * 200)
+
+        counters = {}
+        for kind, name, value, labels in self.recorder.events:
+            self.assertEqual(labels, {"provider": "GsmModemSms"})
+            if kind == metrics.COUNTER:
+                counters[name] = counters.get(name, 0) + value
+
+        self.assertEqual(counters["segments"], 2)
+        self.assertEqual(counters["serial_bytes_out"],
+                         sum(len(data) for data in s.sp.written))
+        # Modem echoes commands, so it sends back more than it got
+        self.assertGreater(counters["serial_bytes_in"],
+                           counters["serial_bytes_out"])
+        # AT, AT+CMGF and AT+CMGS with pdu for each segment
+        self.assertEqual(self.recorder.names().count("serial_write"), 6)
+        self.assertEqual(self.recorder.names().count("serial_wait"), 6)
+
+    def test_overhead(self):
+        metrics.unsubscribe(self.recorder)
+
+        start = time.time()
+        for x in range(10000):
+            with metrics.timed("stage", provider = "test"):
+                pass
+            metrics.count("stage", provider = "test")
+        elapsed = time.time() - start
+
+        metrics.subscribe(self.recorder)
+        # Microseconds per send stage, against milliseconds of sending
+        self.assertLess(elapsed / 10000, 0.0001)
+
+class prometheus_tests(TestCase):
+    def test_render(self):
+        collector = PrometheusCollector()
+        collector(metrics.COUNTER, "retry", 1, {"provider": "NajdiSiSms"})
+        collector(metrics.COUNTER, "retry", 2, {"provider": "NajdiSiSms"})
+        collector(metrics.TIMING, "http", 0.02, {"provider": "NajdiSiSms"})
+        collector(metrics.TIMING, "http", 2, {"provider": "NajdiSiSms"})
+
+        lines = collector.render().splitlines()
+
+        self.assertIn("# TYPE pysms_retry_total counter", lines)
+        self.assertIn('pysms_retry_total{provider="NajdiSiSms"} 3', lines)
+        self.assertIn("# TYPE pysms_http_seconds histogram", lines)
+        self.assertIn('pysms_http_seconds_bucket{provider="NajdiSiSms",le="0.01"} 0',
+                      lines)
+        self.assertIn('pysms_http_seconds_bucket{provider="NajdiSiSms",le="0.05"} 1',
+                      lines)
+        self.assertIn('pysms_http_seconds_bucket{provider="NajdiSiSms",le="+Inf"} 2',
+                      lines)
+        self.assertIn('pysms_http_seconds_sum{provider="NajdiSiSms"} 2.02', lines)
+        self.assertIn('pysms_http_seconds_count{provider="NajdiSiSms"} 2', lines)
+
+    def test_subscribed(self):
+        collector = PrometheusCollector(prefix = "sms")
+        metrics.subscribe(collector)
+        try:
+            metrics.count("segments", 3, provider = "GsmModemSms")
+        finally:
+            metrics.unsubscribe(collector)
+
+        self.assertEqual(collector.render(),
+                         "# TYPE sms_segments_total counter\n"
+                         'sms_segments_total{provider="GsmModemSms"} 3\n')
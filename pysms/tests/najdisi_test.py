@@ -1,16 +1,26 @@
+import os
+import time
 import socket
+import shutil
+import tempfile
+import threading
 
 from os.path import abspath, split, join
+from StringIO import StringIO
 from urllib import urlencode
 
 from unittest import TestCase
 from mock import Mock, call
 from stubserver.webserver import StubServer
 
-from pysms import CommunicationException, AuthException, SendException, ResponseException
-from pysms.providers import NajdiSiSms
+from pysms import CommunicationException, AuthException, SendException, ResponseException, \
+                  InputException, RetryPolicy, AsyncResult
+from pysms.providers import NajdiSiSms, NajdiSiPool, AsyncNajdiSiSms
+from pysms.providers.najdisi import _scan_session_page, _parse_msg_left
+from pysms.ratelimit import RateLimiter
+from pysms.tests.in_flight import InFlight
 
-class functional_tests(TestCase):
+class stub_server_tests(TestCase):
     """
     We emulate webserver to perform real testing, because mocking mechanize is
     not a way to go.
@@ -40,8 +50,13 @@ class functional_tests(TestCase):
         self.server = StubServer(self.port)
         self.server.run()
 
+        self.s = self._create_provider()
+
+    def _create_provider(self):
+        raise NotImplementedError
+
+    def _set_urls(self):
         # Testing urls are fictional, but it does not really matter
-        self.s = NajdiSiSms(username= "test", password= "test")
         self.s.logout_url = "http://localhost:%d/logout" %self.port
         self.s.login_url = "http://localhost:%d/login" %self.port
         self.s.session_url = "http://localhost:%d/session" %self.port
@@ -52,6 +67,25 @@ class functional_tests(TestCase):
     def tearDown(self):
         self.server.stop()
 
+    def _expect_login(self, capture = {}):
+        self.server.expect(method = "GET", url = "/logout").and_return()
+        self.server.expect(method = "GET", url = "/login").and_return(
+            file_content = join(self.path, "najdisi_login.html")
+        )
+        self.server.expect(method="POST", url="/j_spring_security_check",
+                           data_capture=capture,
+                          ).and_return(reply_code=203)
+        self.server.expect(method="GET", url = "/session").and_return(
+            file_content=join(self.path,"najdisi_loggedin.html")
+        )
+
+class functional_tests(stub_server_tests):
+    def _create_provider(self):
+        self.s = NajdiSiSms(username= "test", password= "test")
+        self._set_urls()
+
+        return self.s
+
     def test_login(self):
         capture= {}
         self.server.expect(method = "GET", url = "/logout").and_return()
@@ -106,6 +140,17 @@ class functional_tests(TestCase):
         with self.assertRaisesRegexp(ResponseException, "Error getting session id"):
             self.s._login()
 
+    def test_login_connection_error(self):
+        # Nothing listens on the port
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.s.logout_url = "http://127.0.0.1:%d/logout" %sock.getsockname()[1]
+        sock.close()
+
+        with self.assertRaisesRegexp(CommunicationException,
+                                     "Error in communication"):
+            self.s._login()
+
     def test_send_sms(self):
         self.server.expect(method = "GET", url="/1361468289330/41/441325/test").and_return(
             mime_type="text/json",
@@ -128,6 +173,141 @@ class functional_tests(TestCase):
         with self.assertRaisesRegexp(ResponseException, "Error parsing response"):
             self.s._send_sms("1361468289330", "41", "441325", "test")
 
+class async_functional_tests(stub_server_tests):
+    def _create_provider(self):
+        self.s = AsyncNajdiSiSms(username= "test", password= "test")
+        self._set_urls()
+
+        return self.s
+
+    def test_login(self):
+        capture= {}
+        self._expect_login(capture)
+
+        self.s.run(self.s._login(), timeout = 10)
+
+        self.assertEqual(capture["body"],
+                         urlencode([('j_username', 'test'), ('j_password', 'test')]),
+                         "posted data incorrect")
+
+        self.assertEqual(self.s._session, '1361468289330')
+        self.assertEqual(self.s.run(self.s.balance(), timeout = 10), 40)
+
+    def test_login_errors(self):
+        self.server.expect(method = "GET", url = "/logout").and_return()
+        self.server.expect(method="GET", url="/login").and_return(
+            content="<html><body><form name='notfound'></body></html>"
+        )
+
+        with self.assertRaisesRegexp(ResponseException, "Error extracting login form"):
+            self.s.run(self.s._login(), timeout = 10)
+
+        self.server.expect(method = "GET", url = "/logout").and_return()
+        self.server.expect(method="GET", url="/login").and_return(
+            content="<html><body><form name='lgn'></body></html>"
+        )
+
+        with self.assertRaisesRegexp(ResponseException, "Error getting username and password"):
+            self.s.run(self.s._login(), timeout = 10)
+
+    def test_send_sms_error(self):
+        self.server.expect(method = "GET", url="/1361468289330/41/441325/test").and_return(
+            reply_code=404)
+        with self.assertRaisesRegexp(CommunicationException, "Error sending sms"):
+            self.s.run(self.s._send_sms("1361468289330", "41", "441325", "test"),
+                       timeout = 10)
+
+    def test_send_many(self):
+        self._expect_login()
+        for x in range(20):
+            self.server.expect(method = "GET",
+                               url="/1361468289330/41/4413%02d/test" %x).and_return(
+                mime_type="text/json",
+                content="{ \"msg_left\" : \"%d\", \"msg_cnt\" : \"10\" }" %(39 - x)
+            )
+
+        results = []
+        messages = [('0414413%02d' %x, 'test') for x in range(20)]
+        messages.insert(5, ('-1', 'test'))
+        sent = self.s.run(self.s.send_many(messages, results.append,
+                                           concurrency = 10),
+                          timeout = 20)
+
+        self.assertEqual(sent, 20)
+        self.assertEqual(len(results), 21)
+        self.assertEqual([r.index for r in results if not r.ok], [5])
+        self.assertIsInstance(results[0].exception, InputException)
+
+def completed(value = None, exception = None):
+    result = AsyncResult()
+    if exception is not None:
+        result.set_exception(exception)
+    else:
+        result.set_result(value)
+    return result
+
+class async_unit_tests(TestCase):
+    def setUp(self):
+        self.s = AsyncNajdiSiSms(username = "test", password = "test",
+                                 retry_policy = RetryPolicy(backoff = 0.01))
+
+        def _login():
+            self.s._session = '1361468289330'
+            self.s._balance = 10
+            return completed()
+
+        self.manager = Mock()
+        self.s._login = self.manager._login
+        self.s._login.side_effect = _login
+        self.s._send_sms = self.manager._send_sms
+        self.s._send_sms.return_value = completed()
+
+    def test_retry(self):
+        self.s._send_sms.side_effect = [
+            completed(exception = CommunicationException()), completed()]
+
+        self.assertEqual(self.s.run(self.s.send('041928491', 'test'),
+                                    timeout = 10), 10)
+
+        # Transient error drops session, so next attempt logs in again
+        self.assertEqual(self.manager._login.call_count, 2)
+        self.assertEqual(self.manager._send_sms.call_count, 2)
+
+    def test_permanent_error(self):
+        self.s._login.side_effect = lambda: completed(
+            exception = AuthException())
+
+        with self.assertRaises(AuthException):
+            self.s.run(self.s.send('041928491', 'test'), timeout = 10)
+
+        self.assertEqual(self.manager._login.call_count, 1)
+
+    def test_out_of_balance(self):
+        self.s._session = '1361468289330'
+        self.s._send_sms.return_value = completed(
+            exception = SendException("Out of balance"))
+
+        with self.assertRaises(SendException):
+            self.s.run(self.s.send('041928491', 'test'), timeout = 10)
+
+        self.assertEqual(self.manager._send_sms.call_count, 1)
+        # Session is still valid, it is only out of balance
+        self.assertEqual(self.s._session, '1361468289330')
+
+    def test_idempotency_key(self):
+        pending = AsyncResult()
+        self.s._send_sms.return_value = pending
+
+        # Second send with the same key waits for the one in flight
+        first = self.s.send('041928491', 'test', key = "a")
+        second = self.s.send('041928491', 'test', key = "a")
+        pending.set_result(None)
+
+        self.assertEqual((first.get(), second.get()), (10, 10))
+        self.s.send('041928491', 'test', key = "a")
+        self.s.send('041928491', 'test', key = "b")
+        self.assertEqual(self.manager._send_sms.call_count, 2)
+
 class unit_tests(TestCase):
     def setUp(self):
         self.s = NajdiSiSms(username= "test", password= "test", retries = 1)
@@ -140,6 +320,35 @@ class unit_tests(TestCase):
         with self.assertRaises(ResponseException):
             res = self.s._parse_balance("<strong id=\"sms_left\" name=\"sms_left\"></strong>")
 
+    def test_scan_session_page(self):
+        with open(join(split(abspath(__file__))[0], "najdisi_loggedin.html")) as f:
+            page = f.read()
+
+        resp = StringIO(page)
+        self.assertEqual(_scan_session_page(resp), ('1361468289330', 40))
+        # Reading stops once both values are found
+        self.assertLess(resp.tell(), len(page))
+
+        # Values split between chunks
+        for size in (1, 7, 50):
+            self.assertEqual(_scan_session_page(StringIO(page[261000:265000]),
+                                                chunk_size = size),
+                             ('1361468289330', 40))
+
+        self.assertEqual(_scan_session_page(StringIO("x" * 100 + "sms_so_l_123"),
+                                            chunk_size = 10),
+                         ('123', None))
+        self.assertEqual(_scan_session_page(StringIO("")), (None, None))
+
+    def test_parse_msg_left(self):
+        self.assertEqual(_parse_msg_left('{ "msg_left" : "10", "msg_cnt" : "10" }'), 10)
+        self.assertEqual(_parse_msg_left('{"msg_left": 7}'), 7)
+
+        with self.assertRaisesRegexp(ResponseException, "Incorrect response"):
+            _parse_msg_left('{"msg_cnt": "10"}')
+        with self.assertRaisesRegexp(ResponseException, "Error parsing response"):
+            _parse_msg_left('error')
+
     def test_send_sms(self):
         def _login():
             self.s._session = '1361468289330'
@@ -167,7 +376,7 @@ class unit_tests(TestCase):
             def _login_second():
                 self.s._session = '1361468289330'
             self.s._login.side_effect = _login_second
-            raise AuthException
+            raise CommunicationException
 
         manager = Mock()
         self.s._login = manager._login
@@ -191,7 +400,8 @@ class unit_tests(TestCase):
         with self.assertRaises(AuthException):
             self.s.send('041928491', 'test')
 
-        expected_calls = [call._login(), call._login()]
+        # Wrong password is not retried
+        expected_calls = [call._login()]
         self.assertEqual(expected_calls, manager.mock_calls)
 
     def test_send_sms_send_error_error(self):
@@ -202,10 +412,10 @@ class unit_tests(TestCase):
         self.s._login = manager._login
         self.s._login.side_effect = _login
         self.s._send_sms = manager._send_sms
-        self.s._send_sms.side_effect = SendException
+        self.s._send_sms.side_effect = ResponseException
         self.s._balance = 10
 
-        with self.assertRaises(SendException):
+        with self.assertRaises(ResponseException):
             self.s.send('041928491', 'test')
 
         expected_calls = [call._login(),
@@ -214,6 +424,22 @@ class unit_tests(TestCase):
                           call._send_sms('1361468289330', '41','928491', 'test')]
         self.assertEqual(expected_calls, manager.mock_calls)
 
+    def test_send_sms_idempotency_key(self):
+        def _login():
+            self.s._session = '1361468289330'
+
+        manager = Mock()
+        self.s._login = manager._login
+        self.s._login.side_effect = _login
+        self.s._send_sms = manager._send_sms
+        self.s._balance = 10
+
+        self.s.send('041928491', 'test', key = "a")
+        self.s.send('041928491', 'test', key = "a")
+        self.s.send('041928491', 'test', key = "b")
+
+        self.assertEqual(manager._send_sms.call_count, 2)
+
     def test_send_sms_balance_error_error(self):
         def _login():
             self.s._session = '1361468289330'
@@ -226,5 +452,335 @@ class unit_tests(TestCase):
         with self.assertRaises(SendException):
             self.s.send('041928491', 'test')
 
-        expected_calls = [call._login(), call._login()]
+        expected_calls = [call._login()]
+        self.assertEqual(expected_calls, manager.mock_calls)
+
+    def test_send_many(self):
+        def _login():
+            self.s._session = '1361468289330'
+
+        def _send_sms(session, prefix, number, data):
+            self.s._balance -= 1
+
+        manager = Mock()
+        self.s._login = manager._login
+        self.s._login.side_effect = _login
+        self.s._send_sms = manager._send_sms
+        self.s._send_sms.side_effect = _send_sms
+        self.s._balance = 1
+
+        results = list(self.s.send_many([('041928491', 'test'),
+                                         ('-1', 'test'),
+                                         ('041928492', 'test')]))
+
+        self.assertTrue(results[0].ok)
+        self.assertIsInstance(results[1].exception, InputException)
+        self.assertIsInstance(results[2].exception, SendException)
+
+        expected_calls = [call._login(),
+                          call._send_sms('1361468289330', '41','928491', 'test')]
+        self.assertEqual(expected_calls, manager.mock_calls)
+
+    def test_threads(self):
+        logins, sent = [], []
+
+        def _login():
+            logins.append(1)
+            time.sleep(0.05)
+            self.s._session = '1361468289330'
+            self.s._balance = 100
+
+        def _send_sms(session, prefix, number, data):
+            sent.append(session)
+            time.sleep(0.01)
+
+        self.s._login = _login
+        self.s._send_sms = _send_sms
+
+        def send():
+            for x in range(5):
+                self.s.send('041928491', 'test')
+
+        threads = [threading.Thread(target = send) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Threads share a single login
+        self.assertEqual(len(logins), 1)
+        self.assertEqual(len(sent), 40)
+
+    def test_send_many_concurrent(self):
+        self.s._session = '1361468289330'
+        self.s._balance = 100
+        flight = InFlight()
+        def send(*args):
+            with flight:
+                time.sleep(0.02)
+        self.s._send_sms = Mock(side_effect = send)
+
+        results = list(self.s.send_many([('041928491', 'test')] * 20,
+                                        concurrency = 10))
+
+        self.assertTrue(all(result.ok for result in results))
+        self.assertGreater(flight.peak, 1)
+        self.assertLessEqual(flight.peak, 10)
+
+class session_store_tests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _provider(self, manager):
+        s = NajdiSiSms(username= "test", password= "test", retries = 1,
+                       session_file = self.path)
+        s._send_sms = manager._send_sms
+
+        def _login():
+            s._session = '1361468289330'
+            s._balance = 10
+            s._save_session()
+
+        s._login = manager._login
+        s._login.side_effect = _login
+
+        return s
+
+    def test_warm_start(self):
+        manager = Mock()
+        self._provider(manager).send('041928491', 'test')
+
+        manager = Mock()
+        s = self._provider(manager)
+        self.assertEqual(s._session, '1361468289330')
+        self.assertEqual(s.balance, 10)
+
+        s.send('041928491', 'test')
+
+        expected_calls = [call._send_sms('1361468289330', '41','928491', 'test')]
+        self.assertEqual(expected_calls, manager.mock_calls)
+
+    def test_stale_session(self):
+        manager = Mock()
+        self._provider(manager).send('041928491', 'test')
+
+        manager = Mock()
+        s = self._provider(manager)
+        s._send_sms.side_effect = [ResponseException, None]
+
+        s.send('041928491', 'test')
+
+        expected_calls = [call._send_sms('1361468289330', '41','928491', 'test'),
+                          call._login(),
+                          call._send_sms('1361468289330', '41','928491', 'test')]
         self.assertEqual(expected_calls, manager.mock_calls)
+
+    def test_save_on_change(self):
+        manager = Mock()
+        s = self._provider(manager)
+        s.store.save = Mock(wraps = s.store.save)
+
+        s.send('041928491', 'test')
+        s.send('041928491', 'test')
+        # Saved after login, but not after sends leaving cookies as they were
+        self.assertEqual(s.store.save.call_count, 1)
+
+        s.cookiejar.clear()
+        s.send('041928491', 'test')
+        self.assertEqual(s.store.save.call_count, 2)
+
+class pool_tests(TestCase):
+    def _account(self, username, balance):
+        account = NajdiSiSms(username = username, password = "test")
+        account._balance = balance
+
+        def _send(options):
+            if not account._balance:
+                raise SendException("Out of balance")
+            account._balance -= 1
+            return account._balance
+
+        account._send = Mock(side_effect = _send)
+        return account
+
+    def test_balance_routing(self):
+        a, b = self._account("a", 3), self._account("b", 2)
+        pool = NajdiSiPool([a, b])
+        for account in pool.accounts:
+            account.probe = False
+
+        self.assertEqual(pool.balance, 5)
+
+        for x in range(4):
+            pool.send('041928491', 'test')
+
+        # a has most balance or ties with b, except for the third send
+        self.assertEqual(a._send.call_count, 3)
+        self.assertEqual(b._send.call_count, 1)
+
+        # a hit zero balance and is out of rotation
+        self.assertEqual(pool.balance, 1)
+
+    def test_out_of_balance_failover(self):
+        a, b = self._account("a", 0), self._account("b", 5)
+        pool = NajdiSiPool([a, b], cooldown = 60)
+
+        self.assertEqual(pool.send('041928491', 'test'), 4)
+        self.assertGreater(pool.accounts[0].disabled_until, 0)
+
+        pool.send('041928491', 'test')
+        self.assertEqual(a._send.call_count, 1)
+
+    def test_auth_error(self):
+        a = self._account("a", 5)
+        a._send.side_effect = AuthException
+        pool = NajdiSiPool([a], cooldown = 0.1)
+
+        with self.assertRaises(AuthException):
+            pool.send('041928491', 'test')
+
+        with self.assertRaisesRegexp(SendException, "No account available"):
+            pool.send('041928491', 'test')
+
+        time.sleep(0.2)
+        with self.assertRaises(AuthException):
+            pool.send('041928491', 'test')
+
+    def test_send_many(self):
+        accounts = [self._account("a%d" %x, 10) for x in range(4)]
+        pool = NajdiSiPool(accounts)
+
+        results = list(pool.send_many([('041928491', 'test')] * 30))
+
+        self.assertEqual(len([r for r in results if r.ok]), 30)
+        self.assertEqual(sorted(a._send.call_count for a in accounts),
+                         [7, 7, 8, 8])
+
+    def test_limiter(self):
+        accounts = [self._account("a%d" %x, 10) for x in range(2)]
+        limiter = RateLimiter(default = (20, 1))
+        pool = NajdiSiPool(accounts, limiter = limiter)
+
+        start = time.time()
+        results = list(pool.send_many([('041928491', 'test')] * 6))
+
+        self.assertTrue(all(r.ok for r in results))
+        # Three sends per account, at most one every 50ms
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertEqual(len(limiter._buckets), 2)
+
+class KeptSms(NajdiSiSms):
+    """
+    Provider counting logins and session refreshes instead of doing them
+    """
+
+    login_error = None
+
+    def __init__(self, *args, **kwargs):
+        self.logins = 0
+        self.refreshes = 0
+        NajdiSiSms.__init__(self, "test", "test", *args, **kwargs)
+
+    def _do_login(self):
+        self.logins += 1
+        if self.login_error:
+            raise self.login_error
+        self._session = '1361468289330'
+        self._balance = 10
+        self._session_time = self._balance_time = time.time()
+
+    def _refresh(self):
+        self.refreshes += 1
+        self._balance = 20
+        self._session_time = self._balance_time = time.time()
+        return True
+
+def wait_for(condition, timeout = 1):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+
+class keeper_tests(TestCase):
+    def _provider(self, **kwargs):
+        s = KeptSms(retries = 1, **kwargs)
+        self.addCleanup(s.close)
+        s._send_sms = Mock()
+
+        return s
+
+    def test_login_ahead(self):
+        s = self._provider(keepalive = 60)
+        wait_for(lambda: s._session)
+
+        self.assertEqual(s.logins, 1)
+        self.assertEqual(s.balance, 10)
+
+        s.send('041928491', 'test')
+        s.send('041928491', 'test')
+        self.assertEqual(s.logins, 1)
+        self.assertEqual(s._send_sms.call_count, 2)
+
+    def test_send_waits_for_login(self):
+        s = self._provider(keepalive = 60)
+
+        s.send('041928491', 'test')
+
+        self.assertEqual(s.logins, 1)
+        s._send_sms.assert_called_once_with('1361468289330', '41', '928491',
+                                            'test')
+
+    def test_refresh_idle_session(self):
+        s = self._provider(keepalive = 0.05)
+
+        time.sleep(0.2)
+
+        self.assertEqual(s.logins, 1)
+        self.assertGreaterEqual(s.refreshes, 2)
+
+    def test_login_after_failure(self):
+        s = self._provider(keepalive = 60)
+        s._send_sms.side_effect = [ResponseException, None]
+
+        s.send('041928491', 'test')
+
+        self.assertEqual(s.logins, 2)
+        self.assertEqual(s._send_sms.call_count, 2)
+
+    def test_login_error(self):
+        KeptSms.login_error = AuthException("Incorrect password")
+        self.addCleanup(setattr, KeptSms, "login_error", None)
+        s = self._provider(keepalive = 60)
+
+        start = time.time()
+        with self.assertRaises(AuthException):
+            s.send('041928491', 'test')
+        with self.assertRaises(AuthException):
+            s.balance
+
+        # Keeper does not try again before retry interval
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(s.logins, 1)
+
+    def test_balance_ttl(self):
+        s = self._provider(keepalive = 60, balance_ttl = 0.05)
+        wait_for(lambda: s._session)
+        self.assertEqual(s.balance, 10)
+
+        time.sleep(0.1)
+        # Stale balance is returned, while keeper refreshes it
+        self.assertEqual(s.balance, 10)
+        wait_for(lambda: s.refreshes)
+        self.assertEqual(s.balance, 20)
+
+    def test_balance_ttl_without_keeper(self):
+        s = self._provider(balance_ttl = 0.05)
+
+        self.assertEqual(s.balance, 10)
+        self.assertEqual(s.balance, 10)
+        time.sleep(0.1)
+        self.assertEqual(s.balance, 20)
+        self.assertEqual((s.logins, s.refreshes), (1, 1))
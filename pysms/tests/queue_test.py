@@ -0,0 +1,221 @@
+import os
+import time
+import signal
+import shutil
+import tempfile
+import threading
+import multiprocessing
+
+from unittest import TestCase
+
+from pysms import Sms, SendException
+from pysms.queue import SmsQueue, QueueWorker
+
+class RecordingSms(Sms):
+    def __init__(self, fail = ()):
+        self.sent = []
+        self.fail = fail
+
+    def send(self, number, text):
+        if text == u"crash":
+            raise ValueError("Provider bug")
+        if text in self.fail:
+            raise SendException()
+        self.sent.append((number, text))
+        return 1
+
+class KillingSms(RecordingSms):
+    """Logs sends to a file and kills its process on text kill"""
+
+    def __init__(self, log):
+        RecordingSms.__init__(self)
+        self.log = log
+
+    def send(self, number, text):
+        if text == u"kill":
+            os.kill(os.getpid(), signal.SIGKILL)
+        with open(self.log, "a") as f:
+            f.write(text + "\n")
+        return RecordingSms.send(self, number, text)
+
+def run_killed_worker(path, log):
+    queue = SmsQueue(path, lease_timeout = 0.1)
+    QueueWorker(queue, KillingSms(log), batch_size = 10).run_once()
+
+class queue_test_base(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "queue.db")
+        self.queue = SmsQueue(self.path, max_attempts = 2)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.dir)
+
+class queue_tests(queue_test_base):
+    def test_lease_ack(self):
+        first = self.queue.enqueue("+38641928491", u"first")
+        self.queue.enqueue("+38641928491", u"second", silent = True)
+
+        leased = self.queue.lease(10)
+        self.assertEqual([m.message["text"] for m in leased],
+                         [u"first", u"second"])
+        self.assertEqual(leased[0].id, first)
+        self.assertEqual(leased[1].message["silent"], True)
+        self.assertEqual(self.queue.lease(10), [])
+
+        self.queue.ack(first, 5)
+        self.assertEqual(self.queue.stats(), {SmsQueue.PENDING: 0,
+                                              SmsQueue.LEASED: 1,
+                                              SmsQueue.SENT: 1,
+                                              SmsQueue.FAILED: 0})
+
+    def test_lease_expiry(self):
+        self.queue.enqueue("+38641928491", u"test")
+
+        self.assertEqual(len(self.queue.lease(timeout = 0.05)), 1)
+        self.assertEqual(self.queue.lease(), [])
+        time.sleep(0.1)
+
+        leased = self.queue.lease()
+        self.assertEqual(len(leased), 1)
+        self.assertEqual(leased[0].attempts, 2)
+
+    def test_lease_order(self):
+        ids = [self.queue.enqueue("+38641928491", u"%d" %i) for i in range(4)]
+
+        # Expired leases and pending messages are given out by id
+        self.queue.lease(2, timeout = 0.01)
+        time.sleep(0.02)
+        self.queue.fail(self.queue.lease(1, timeout = 0.01)[0],
+                        SendException(), delay = 10)
+        self.assertEqual([m.id for m in self.queue.lease(3)],
+                         [ids[1], ids[2], ids[3]])
+
+    def test_lease_expiry_attempts(self):
+        self.queue.enqueue("+38641928491", u"test")
+
+        # Worker crashes or hangs every time it gets the message
+        for x in range(2):
+            self.assertEqual(len(self.queue.lease(timeout = 0.01)), 1)
+            time.sleep(0.02)
+
+        self.assertEqual(self.queue.lease(), [])
+        self.assertEqual(self.queue.stats()[SmsQueue.FAILED], 1)
+
+    def test_fail(self):
+        self.queue.enqueue("+38641928491", u"test")
+
+        self.queue.fail(self.queue.lease()[0], SendException())
+        message = self.queue.lease()[0]
+        self.queue.fail(message, SendException())
+
+        self.assertEqual(self.queue.lease(), [])
+        self.assertEqual(self.queue.stats()[SmsQueue.FAILED], 1)
+
+    def test_group_commit(self):
+        # Slow commits, so writers pile up behind each other
+        transaction = self.queue._transaction
+        def slow_transaction(writes):
+            time.sleep(0.005)
+            transaction(writes)
+        self.queue._transaction = slow_transaction
+
+        def enqueue():
+            for x in range(50):
+                self.queue.enqueue("+38641928491", u"test")
+
+        threads = [threading.Thread(target = enqueue) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.queue.stats()[SmsQueue.PENDING], 400)
+        self.assertTrue(self.queue.commits < 100)
+
+    def test_enqueue_many(self):
+        self.queue.batch_size = 100
+        count = self.queue.enqueue_many(("+38641928491", u"%d" %i)
+                                        for i in xrange(1050))
+
+        self.assertEqual(count, 1050)
+        self.assertEqual(self.queue.commits, 11)
+
+class worker_tests(queue_test_base):
+    def test_drain(self):
+        sms = RecordingSms(fail = [u"bad"])
+        self.queue.enqueue_many([("+38641928491", u"a"),
+                                 ("-1", u"invalid"),
+                                 ("+38641928491", u"bad"),
+                                 ("+38641928491", u"b")])
+
+        QueueWorker(self.queue, sms, batch_size = 2,
+                    retry_delay = 0).run(until_empty = True)
+
+        self.assertEqual([text for number, text in sms.sent], [u"a", u"b"])
+        self.assertEqual(self.queue.stats()[SmsQueue.SENT], 2)
+        self.assertEqual(self.queue.stats()[SmsQueue.FAILED], 2)
+
+    def test_resume(self):
+        self.queue.enqueue_many(("+38641928491", u"%d" %i) for i in range(10))
+
+        # Process crashes after sending half of leased messages
+        for message in self.queue.lease(5, timeout = 0.05)[:3]:
+            self.queue.ack(message.id)
+        self.queue.close()
+        time.sleep(0.1)
+
+        self.queue = SmsQueue(self.path)
+        sms = RecordingSms()
+        worker = QueueWorker(self.queue, sms, workers = 2, batch_size = 3,
+                             poll_interval = 0.01)
+        worker.start()
+        while self.queue.stats()[SmsQueue.SENT] < 10:
+            time.sleep(0.01)
+        worker.stop()
+
+        self.assertEqual(sorted(int(text) for number, text in sms.sent),
+                         range(3, 10))
+
+    def test_killed(self):
+        texts = [u"0", u"1", u"2", u"kill", u"3", u"4"]
+        self.queue.enqueue_many(("+38641928491", text) for text in texts)
+
+        # Worker process is killed in the middle of its batch
+        log = os.path.join(self.dir, "sent.log")
+        process = multiprocessing.Process(target = run_killed_worker,
+                                          args = (self.path, log))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, -signal.SIGKILL)
+        with open(log) as f:
+            self.assertEqual(f.read().split(), [u"0", u"1", u"2"])
+
+        time.sleep(0.2)
+        sms = RecordingSms()
+        QueueWorker(self.queue, sms, batch_size = 10).run(until_empty = True)
+
+        # Only messages without ack are sent again, once lease expires
+        self.assertEqual([text for number, text in sms.sent],
+                         [u"kill", u"3", u"4"])
+        self.assertEqual(self.queue.stats()[SmsQueue.SENT], 6)
+
+    def test_crash(self):
+        sms = RecordingSms()
+        self.queue.enqueue_many([("+38641928491", u"a"),
+                                 ("+38641928491", u"crash"),
+                                 ("+38641928491", u"b")])
+
+        worker = QueueWorker(self.queue, sms, batch_size = 2,
+                             retry_delay = 0, poll_interval = 0.01)
+        with self.assertRaises(ValueError):
+            worker.run_once()
+
+        # Message without result is released right away
+        self.assertEqual(self.queue.stats()[SmsQueue.LEASED], 0)
+
+        worker.run(until_empty = True)
+
+        self.assertEqual([text for number, text in sms.sent], [u"a", u"b"])
+        self.assertEqual(self.queue.stats()[SmsQueue.FAILED], 1)
@@ -0,0 +1,89 @@
+import time
+
+from unittest import TestCase
+
+from pysms import Sms, SendException, InputException
+from pysms.ratelimit import TokenBucket, RateLimiter, RateLimitedSms
+
+class RecordingSms(Sms):
+    def __init__(self, account = None):
+        self.account = account
+        self.sent = []
+
+    def send(self, number, text):
+        self.sent.append(time.time())
+        if text == "error":
+            raise SendException()
+        return 1
+
+class bucket_tests(TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(10, burst = 2)
+
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places = 2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places = 2)
+
+    def test_adapt(self):
+        bucket = TokenBucket(10, min_rate = 2, recovery = 0.1)
+
+        bucket.report(False)
+        self.assertEqual(bucket.rate, 5)
+        for x in range(5):
+            bucket.report(False)
+        self.assertEqual(bucket.rate, 2)
+
+        bucket.report(True)
+        self.assertEqual(bucket.rate, 3)
+        for x in range(20):
+            bucket.report(True)
+        self.assertEqual(bucket.rate, 10)
+
+class limiter_tests(TestCase):
+    def test_buckets(self):
+        limiter = RateLimiter({"RecordingSms": (100, 10),
+                               ("RecordingSms", "a"): (1, 1)},
+                              default = (5, 1))
+
+        a, b = RecordingSms("a"), RecordingSms("b")
+        self.assertEqual([x.max_rate for x in limiter.buckets(a)], [100, 1])
+        self.assertEqual([x.max_rate for x in limiter.buckets(b)], [100, 5])
+
+        # Instances of the same account share buckets
+        self.assertEqual(limiter.buckets(RecordingSms("a")),
+                         limiter.buckets(a))
+        self.assertIs(limiter.buckets(a)[0], limiter.buckets(b)[0])
+
+    def test_report(self):
+        limiter = RateLimiter(default = (10, 1))
+        sms = RecordingSms("a")
+
+        limiter.report(sms, InputException())
+        self.assertEqual(limiter.buckets(sms)[0].rate, 10)
+        limiter.report(sms, SendException())
+        self.assertEqual(limiter.buckets(sms)[0].rate, 5)
+
+class rate_limited_sms_tests(TestCase):
+    def test_send(self):
+        sms = RecordingSms("a")
+        limited = RateLimitedSms(sms, RateLimiter(default = (20, 1)))
+
+        for x in range(5):
+            limited.send("+38641928491", "test")
+
+        self.assertGreaterEqual(sms.sent[-1] - sms.sent[0], 0.19)
+
+    def test_send_many(self):
+        sms = RecordingSms("a")
+        limiter = RateLimiter(default = (50, 1))
+        limited = RateLimitedSms(sms, limiter)
+
+        results = list(limited.send_many([("+38641928491", "test")] * 5 +
+                                         [("+38641928491", "error")]))
+
+        self.assertEqual([r.ok for r in results], [True] * 5 + [False])
+        # Bucket refills while the first message is validated, so only the
+        # sends after it are sure to wait
+        self.assertGreaterEqual(sms.sent[-1] - sms.sent[1], 0.07)
+        self.assertEqual(limiter.buckets(sms)[0].rate, 25)
@@ -0,0 +1,112 @@
+import time
+
+from unittest import TestCase
+
+from pysms import Sms, CommunicationException, InputException, SendException
+from pysms import RetryPolicy
+from pysms.router import Router
+from pysms.providers import MemorySms, NajdiSiSms
+
+class FakeSms(Sms):
+    def __init__(self, latency = 0, error = None):
+        self.latency = latency
+        self.error = error
+        self.sent = 0
+
+    def send(self, number, text, key = None):
+        time.sleep(self.latency)
+        if self.error:
+            raise self.error
+        self.sent += 1
+        return self.sent
+
+class router_tests(TestCase):
+    def test_latency(self):
+        fast, slow = FakeSms(0.001), FakeSms(0.02)
+        router = Router([slow, fast])
+
+        for x in range(20):
+            router.send("+38641928491", "test")
+
+        # Both are tried once, then fast one takes everything
+        self.assertEqual(slow.sent, 1)
+        self.assertEqual(fast.sent, 19)
+
+    def test_failover(self):
+        broken, ok = FakeSms(error = CommunicationException()), FakeSms(0.01)
+        router = Router([broken, ok], threshold = 2, reset_timeout = 0.1)
+
+        for x in range(5):
+            self.assertEqual(router.send("+38641928491", "test"), x + 1)
+
+        # Circuit opened after two failures
+        self.assertEqual(router.routes[0].state, "open")
+        self.assertEqual(router.routes[0].failures, 2)
+
+        # Probe fails and opens circuit again
+        time.sleep(0.15)
+        router.send("+38641928491", "test")
+        self.assertEqual(router.routes[0].state, "open")
+        self.assertEqual(router.routes[0].failures, 3)
+
+        # Successful probe closes circuit
+        time.sleep(0.15)
+        broken.error = None
+        router.send("+38641928491", "test")
+        self.assertEqual(router.routes[0].state, "closed")
+        self.assertEqual(broken.sent, 1)
+
+    def test_all_failed(self):
+        router = Router([FakeSms(error = SendException("a")),
+                         FakeSms(error = InputException("b"))])
+
+        with self.assertRaisesRegexp(InputException, "b"):
+            router.send("+38641928491", "test")
+
+        # Failures not caused by provider health keep circuit closed
+        self.assertEqual([r.state for r in router.routes],
+                         ["closed", "closed"])
+
+    def test_invalid_for_provider(self):
+        najdisi, memory = NajdiSiSms("test", "test"), MemorySms()
+        router = Router([najdisi, memory])
+
+        # Too long for najdi.si web form, but fine for the other provider
+        router.send("+38641928491", u"a" * 200)
+
+        self.assertEqual(memory.sent, 1)
+        self.assertEqual([r.state for r in router.routes],
+                         ["closed", "closed"])
+
+    def test_no_provider(self):
+        router = Router([FakeSms(error = CommunicationException())],
+                        threshold = 1)
+
+        with self.assertRaises(CommunicationException):
+            router.send("+38641928491", "test")
+        with self.assertRaisesRegexp(SendException, "No provider available"):
+            router.send("+38641928491", "test")
+
+    def test_send_many(self):
+        providers = [FakeSms(0.01), FakeSms(0.01)]
+        router = Router(providers)
+
+        results = list(router.send_many([("+38641928491", "test")] * 20,
+                                        concurrency = 4))
+
+        self.assertTrue(all(result.ok for result in results))
+        # Sends in flight spread load over both providers
+        self.assertTrue(all(sms.sent > 2 for sms in providers))
+
+    def test_key(self):
+        policy = RetryPolicy(retries = 0)
+        providers = [MemorySms(retry_policy = policy),
+                     MemorySms(retry_policy = policy)]
+        router = Router(providers)
+
+        for x in range(5):
+            router.send("+38641928491", u"test", key = "once")
+        router.send("+38641928491", u"test", key = "other")
+
+        # Providers sharing a policy share remembered keys
+        self.assertEqual(sum(sms.sent for sms in providers), 2)
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import mechanize
+
+from unittest import TestCase
+
+from pysms.session import SessionStore, dump_cookies, load_cookies
+
+class TestSessionStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = SessionStore(os.path.join(self.dir, "session.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_load(self):
+        self.assertEqual(self.store.load(), None)
+
+        self.store.save({"session": "1361468289330", "balance": 10})
+        self.assertEqual(self.store.load(),
+                         {"session": "1361468289330", "balance": 10})
+
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ["session.json", "session.json.lock"])
+
+        self.store.clear()
+        self.assertEqual(self.store.load(), None)
+
+    def test_corrupt(self):
+        with open(self.store.path, "w") as f:
+            f.write("{not json")
+
+        self.assertEqual(self.store.load(), None)
+
+    def test_cookies(self):
+        jar = mechanize.CookieJar()
+        jar.set_cookie(mechanize.Cookie(0, "JSESSIONID", "abc", None, False,
+                                        "www.najdi.si", False, False, "/",
+                                        True, False, None, True, None, None,
+                                        {"HttpOnly": None}))
+
+        self.store.save({"cookies": dump_cookies(jar)})
+
+        loaded = mechanize.CookieJar()
+        load_cookies(loaded, self.store.load()["cookies"], mechanize.Cookie)
+
+        cookies = list(loaded)
+        self.assertEqual(len(cookies), 1)
+        self.assertEqual((cookies[0].name, cookies[0].value, cookies[0].domain),
+                         ("JSESSIONID", "abc", "www.najdi.si"))
+        self.assertTrue(cookies[0].has_nonstandard_attr("HttpOnly"))
@@ -1,10 +1,14 @@
 import colander
+import threading
 
 from unittest import TestCase
 from mock import Mock, call
 
-from pysms import CommunicationException, AuthException, SendException, ResponseException
-from pysms import Sms
+from pysms import CommunicationException, AuthException, SendException, ResponseException, \
+                  InputException
+from pysms import Sms, RetryPolicy
+from pysms import split_text, segment_count, MAX_SEGMENTS, \
+                  ENCODING_GSM7, ENCODING_UCS2
 
 class TestSchema(TestCase):
     def test_send_schema_ok(self):
@@ -37,7 +41,159 @@ class TestSchema(TestCase):
 
         data = {
             'number': '113',
-            'text': 'a'*161
+            'text': 'a'*153*MAX_SEGMENTS + 'a'
         }
         with self.assertRaises(colander.Invalid):
           schema.deserialize(data)
+
+class TestSegments(TestCase):
+    def test_gsm7(self):
+        self.assertEqual(split_text(u"test"), (ENCODING_GSM7, ["test"]))
+        self.assertEqual(split_text(u"a{\u20ac"),
+                         (ENCODING_GSM7, ["a\x1b\x28\x1b\x65"]))
+
+        encoding, segments = split_text(u"a" * 161)
+        self.assertEqual([len(s) for s in segments], [153, 8])
+
+    def test_extension_not_split(self):
+        self.assertEqual(segment_count(u"{" * 80), 1)
+        self.assertEqual(segment_count(u"{" * 81), 2)
+
+        encoding, segments = split_text(u"a" * 152 + u"{" * 10)
+        self.assertEqual([len(s) for s in segments], [152, 20])
+
+    def test_ucs2(self):
+        encoding, segments = split_text(u"\u010d" * 70)
+        self.assertEqual((encoding, len(segments)), (ENCODING_UCS2, 1))
+
+        encoding, segments = split_text(u"\u010d" * 71)
+        self.assertEqual([len(s) for s in segments], [134, 8])
+
+    def test_surrogates_not_split(self):
+        text = u"\U0001F600" * 36
+        encoding, segments = split_text(text)
+
+        self.assertEqual([len(s) for s in segments], [132, 12])
+        self.assertEqual(u"".join(s.decode("utf-16-be") for s in segments), text)
+
+    def test_segment_count(self):
+        for text in [u"", u"a" * 160, u"a" * 161, u"a" * 307, u"[]" * 100,
+                     u"\u010d" * 135, u"\U0001F600" * 36]:
+            self.assertEqual(segment_count(text), len(split_text(text)[1]))
+
+class TestSendMany(TestCase):
+    class EchoSms(Sms):
+        def send(self, number, text):
+            return self._send(self.SendSchema().deserialize(locals()))
+
+        def _send(self, params):
+            if params["text"] == "fail":
+                raise SendException
+            return params["number"]
+
+    def test_send_many(self):
+        s = self.EchoSms()
+
+        results = list(s.send_many([('+38641323576', 'test'),
+                                    {'number': '-1', 'text': 'test'},
+                                    ('+38641323577', 'fail'),
+                                    ('+38641323578', 'test')]))
+
+        self.assertEqual([r.index for r in results], [0, 1, 2, 3])
+        self.assertEqual(results[0].value, '+38641323576')
+        self.assertIsInstance(results[1].exception, InputException)
+        self.assertIsInstance(results[2].exception, SendException)
+        self.assertTrue(results[3].ok)
+
+    def test_send_many_concurrent(self):
+        s = self.EchoSms()
+
+        messages = [('+3864132%04d' %x, 'test') for x in range(100)]
+        results = list(s.send_many(messages, concurrency = 8))
+
+        self.assertEqual(sorted(r.index for r in results), range(100))
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(set(r.value for r in results),
+                         set(number for number, text in messages))
+
+    def test_send_many_threads(self):
+        s = self.EchoSms()
+        s._send = Mock(side_effect = s._send)
+        threads = threading.active_count()
+
+        messages = [('+3864132%04d' %x, 'test') for x in range(100)]
+        list(s.send_many(messages, concurrency = 8))
+        self.assertEqual(threading.active_count(), threads)
+
+        # Sends left when caller stops are dropped
+        results = s.send_many(messages, concurrency = 8)
+        next(results)
+        results.close()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertLessEqual(s._send.call_count, 100 + 9)
+
+class TestRetryPolicy(TestCase):
+    def test_classify(self):
+        policy = RetryPolicy()
+
+        self.assertTrue(policy.is_transient(CommunicationException()))
+        self.assertTrue(policy.is_transient(ResponseException()))
+        self.assertFalse(policy.is_transient(AuthException()))
+        self.assertFalse(policy.is_transient(SendException()))
+
+        # Error code decides, whatever the exception type
+        e = SendException()
+        e.code = 42
+        self.assertTrue(policy.is_transient(e))
+        e = CommunicationException()
+        e.code = 310
+        self.assertFalse(policy.is_transient(e))
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff = 1, max_backoff = 5, jitter = 0)
+        self.assertEqual([policy.delay(x) for x in range(5)], [1, 2, 4, 5, 5])
+
+        policy.jitter = 0.5
+        delays = [policy.delay(2) for x in range(100)]
+        self.assertTrue(all(2 <= delay <= 4 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_run(self):
+        policy = RetryPolicy(retries = 2, backoff = 0.001)
+
+        func = Mock(side_effect = [CommunicationException(), 1])
+        self.assertEqual(policy.run(func, (2,)), 1)
+        self.assertEqual(func.mock_calls, [call(2), call(2)])
+
+        func = Mock(side_effect = CommunicationException())
+        with self.assertRaises(CommunicationException):
+            policy.run(func)
+        self.assertEqual(func.call_count, 3)
+
+        # Permanent errors are not retried
+        func = Mock(side_effect = SendException())
+        with self.assertRaises(SendException):
+            policy.run(func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_deadline(self):
+        policy = RetryPolicy(retries = 10, backoff = 0.05, jitter = 0,
+                             deadline = 0.1)
+
+        func = Mock(side_effect = CommunicationException())
+        with self.assertRaises(CommunicationException):
+            policy.run(func)
+
+        # Retries after 0.05 and 0.1 would end after the deadline
+        self.assertEqual(func.call_count, 2)
+
+    def test_once(self):
+        policy = RetryPolicy()
+
+        func = Mock(side_effect = [SendException(), 1, 2])
+        with self.assertRaises(SendException):
+            policy.once("a", func)
+        self.assertEqual(policy.once("a", func), 1)
+        self.assertEqual(policy.once("a", func), 1)
+        self.assertEqual(policy.once(None, func), 2)
+        self.assertEqual(func.call_count, 3)
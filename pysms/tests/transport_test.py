@@ -0,0 +1,164 @@
+import os
+import ssl
+import time
+import socket
+import threading
+import BaseHTTPServer, SocketServer
+
+from unittest import TestCase
+
+from pysms import CommunicationException
+from pysms.transport import HttpTransport, AsyncHttpClient
+
+# Self-signed certificate and key of localhost
+certfile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "localhost.pem")
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.cookies.append(self.headers.get("cookie"))
+
+        if self.path == "/slow":
+            # Request is taken, but response comes after client gave up
+            time.sleep(0.5)
+
+        if self.path == "/missing":
+            body = "not found"
+            self.send_response(404)
+        else:
+            body = '{"msg_left": "10"}'
+            self.send_response(200)
+            self.send_header("Set-Cookie", "JSESSIONID=abc; Path=/")
+
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TlsHandler(KeepAliveHandler):
+    def finish(self):
+        KeepAliveHandler.finish(self)
+
+        # Https servers end connection with close notify, instead of eof
+        try:
+            self.request.unwrap()
+        except (ssl.SSLError, socket.error):
+            pass
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class transport_tests(TestCase):
+    def setUp(self):
+        self.server = KeepAliveServer(("localhost", 0), KeepAliveHandler)
+        self.server.connections = 0
+        self.server.cookies = []
+        self.url = "http://localhost:%d" %self.server.server_address[1]
+
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.transport = HttpTransport()
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for x in range(5):
+            resp = self.transport.open(self.url + "/send")
+            self.assertEqual(resp.body, '{"msg_left": "10"}')
+
+        self.assertEqual(self.server.connections, 1)
+
+    def test_cookies(self):
+        self.transport.open(self.url + "/send")
+        self.transport.open(self.url + "/send")
+
+        self.assertEqual(self.server.cookies, [None, "JSESSIONID=abc"])
+
+    def test_reconnect(self):
+        self.transport.open(self.url + "/close")
+        self.transport.open(self.url + "/send")
+
+        # Idle connection closed by server is replaced transparently
+        for idle in self.transport._pool.values():
+            for conn in idle:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        self.transport.open(self.url + "/send")
+
+        self.assertEqual(self.server.connections, 3)
+
+    def test_timeout(self):
+        self.transport.timeout = 0.2
+        self.transport.open(self.url + "/send")
+
+        # Request could have been handled, so it must not be sent again
+        with self.assertRaises(CommunicationException):
+            self.transport.open(self.url + "/slow")
+
+        self.assertEqual(len(self.server.cookies), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_error(self):
+        with self.assertRaisesRegexp(CommunicationException, "Http error 404"):
+            self.transport.open(self.url + "/missing")
+
+        with self.assertRaises(CommunicationException):
+            self.transport.open("http://localhost:1/send")
+
+class async_transport_tests(TestCase):
+    def setUp(self):
+        self.server = KeepAliveServer(("localhost", 0), TlsHandler)
+        self.server.socket = ssl.wrap_socket(self.server.socket,
+                                             certfile = certfile,
+                                             server_side = True)
+        self.server.connections = 0
+        self.server.cookies = []
+        self.port = self.server.server_address[1]
+
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, client, url):
+        result = client.request(url)
+        while not result.done:
+            client.poll()
+
+        return result
+
+    def test_certificate(self):
+        # Certificate is not signed by a trusted ca
+        result = self.request(AsyncHttpClient(timeout = 5),
+                              "https://localhost:%d/send" %self.port)
+        with self.assertRaisesRegexp(CommunicationException,
+                                     "CERTIFICATE_VERIFY_FAILED"):
+            result.get()
+
+        context = ssl.create_default_context(cafile = certfile)
+        client = AsyncHttpClient(timeout = 5, ssl_context = context)
+        result = self.request(client, "https://localhost:%d/send" %self.port)
+        self.assertEqual(result.get().body, '{"msg_left": "10"}')
+
+        # Certificate is trusted, but issued for another host
+        result = self.request(client, "https://127.0.0.1:%d/send" %self.port)
+        with self.assertRaisesRegexp(CommunicationException, "match"):
+            result.get()
@@ -0,0 +1,93 @@
+import time
+import threading
+import colander
+
+from unittest import TestCase
+
+from pysms import NumberCache, compile_schema, number_cache, prepare_number
+from pysms.providers import NajdiSiSms
+
+class TestNumberCache(TestCase):
+    def test_lru(self):
+        cache = NumberCache(maxsize = 2)
+        func = lambda key: key * 2
+
+        self.assertEqual(cache.get(1, func), 2)
+        self.assertEqual(cache.get(2, func), 4)
+        self.assertEqual(cache.get(1, func), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # 2 is least recently used, so it gets evicted
+        cache.get(3, func)
+        self.assertEqual(len(cache), 2)
+        cache.get(1, func)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache.get(2, func)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+    def test_concurrent(self):
+        cache = NumberCache()
+        calls = []
+        def func(key):
+            calls.append(key)
+            time.sleep(0.05)
+            if len(calls) == 1:
+                raise ValueError
+            return key
+
+        results = []
+        def get():
+            try:
+                results.append(cache.get("a", func))
+            except ValueError:
+                results.append(None)
+
+        threads = [threading.Thread(target = get) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Value is computed once more after first computation failed
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(results), [None] + ["a"] * 4)
+
+    def test_prepare_number(self):
+        number_cache.clear()
+
+        self.assertEqual(prepare_number('041928491', 'SI'), '+38641928491')
+        self.assertEqual(prepare_number('041928491', 'SI'), '+38641928491')
+        self.assertEqual(prepare_number('-1', 'SI'), '')
+        self.assertEqual((number_cache.hits, number_cache.misses), (1, 2))
+
+class TestCompiledSchema(TestCase):
+    def test_compile_schema(self):
+        schema = compile_schema(NajdiSiSms.SendSchema)
+
+        self.assertIs(schema, compile_schema(NajdiSiSms.SendSchema))
+        self.assertEqual(schema.deserialize({'number': '041928491',
+                                             'text': 'test'}),
+                         {'number': '+38641928491', 'text': 'test'})
+
+        with self.assertRaises(colander.Invalid) as e:
+            schema.deserialize({'number': '-1', 'text': 'test'})
+
+        with self.assertRaises(colander.Invalid) as f:
+            NajdiSiSms.SendSchema().deserialize({'number': '-1', 'text': 'test'})
+
+        self.assertEqual(e.exception.asdict(), f.exception.asdict())
+
+    def test_repeated_numbers(self):
+        data = [{'number': '0419284%02d' %(x % 50), 'text': 'test'}
+                for x in range(500)]
+
+        number_cache.clear()
+        schema = compile_schema(NajdiSiSms.SendSchema)
+        for d in data:
+            schema.deserialize(d)
+
+        # Every distinct number is parsed only once
+        self.assertEqual((number_cache.hits, number_cache.misses), (450, 50))
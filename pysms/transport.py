@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: transport.py
+   :platform: Unix, Windows
+   :synopsis: Http transports used by providers
+"""
+
+import sys, time, errno, logging
+import socket, ssl
+import asyncore
+import threading
+import mimetools
+import httplib, urllib2, urlparse, cookielib
+
+from cStringIO import StringIO
+
+from pysms.sms import AsyncResult, CommunicationException
+
+class HttpResponse(object):
+    """
+    Response of a http request
+    """
+
+    def __init__(self, url, status, headers, body):
+        """
+        Constructor
+
+        :param url: Final url of the response, after redirects
+        :type url: str
+        :param status: Http status code
+        :type status: int
+        :param headers: Response headers
+        :type headers: :py:class:`mimetools.Message`
+        :param body: Response body
+        :type body: str
+        """
+
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+class MechanizeTransport(object):
+    """
+    Transport opening urls with :py:class:`mechanize.Browser`
+
+    Every response is fully parsed and recorded in browser history, so this
+    is only useful when pages need to be inspected like in a browser.
+    """
+
+    def __init__(self, browser):
+        """
+        Constructor
+
+        :param browser: Browser to open urls with
+        :type browser: :py:class:`mechanize.Browser`
+        """
+
+        self.browser = browser
+
+    def open(self, url, data = None):
+        """
+        Opens url, GET or POST if `data` is provided
+
+        :returns: Response
+        :rtype: :py:class:`HttpResponse`
+        :raises: :py:exc:`pysms.sms.CommunicationException`
+        """
+
+        import mechanize
+
+        try:
+            resp = self.browser.open(url, data)
+        except (mechanize.URLError, httplib.HTTPException, socket.error) as e:
+            raise CommunicationException("Error requesting %s (%s)" %(url, e))
+
+        return HttpResponse(resp.geturl(), resp.code, resp.info(),
+                            resp.get_data())
+
+def _closed_idle(e):
+    """
+    Tells if error means that server closed connection before responding
+
+    :param e: Error raised while sending request or reading status line
+    """
+
+    if isinstance(e, httplib.BadStatusLine):
+        # Only empty status line, anything else is a response
+        return e.line in ("", "''") or e.line.startswith("No status line")
+
+    return (isinstance(e, socket.error) and not isinstance(e, socket.timeout)
+            and e.errno in (errno.ECONNRESET, errno.EPIPE))
+
+class HttpTransport(object):
+    """
+    Lean http transport with persistent pooled connections
+
+    Idle keep-alive connections are kept per host and reused, so requests
+    skip tcp and tls setup, and responses are returned as they are, without
+    any html parsing. Cookies are shared with other users of the cookie jar,
+    like the browser used to log in.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    user_agent = "pysms"
+
+    def __init__(self, cookiejar = None, timeout = 30, maxsize = 4):
+        """
+        Constructor
+
+        :param cookiejar: Cookie jar shared among requests
+        :type cookiejar: :py:class:`cookielib.CookieJar`
+        :param timeout: Socket timeout in seconds
+        :type timeout: float
+        :param maxsize: Maximal number of idle connections kept per host
+        :type maxsize: int
+        """
+
+        self.cookiejar = cookiejar if cookiejar is not None \
+                         else cookielib.CookieJar()
+        self.timeout = timeout
+        self.maxsize = maxsize
+
+        self._pool = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key):
+        with self._lock:
+            idle = self._pool.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, host = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout = self.timeout), False
+
+        return httplib.HTTPConnection(host, timeout = self.timeout), False
+
+    def _put_connection(self, key, conn):
+        with self._lock:
+            idle = self._pool.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """Closes all idle connections"""
+
+        with self._lock:
+            pool, self._pool = self._pool, {}
+
+        for idle in pool.values():
+            for conn in idle:
+                conn.close()
+
+    def open(self, url, data = None):
+        """
+        Opens url, GET or POST if `data` is provided
+
+        :returns: Response
+        :rtype: :py:class:`HttpResponse`
+        :raises: :py:exc:`pysms.sms.CommunicationException`
+        """
+
+        request = urllib2.Request(url, data)
+        self.cookiejar.add_cookie_header(request)
+
+        headers = dict(request.header_items())
+        headers["User-Agent"] = self.user_agent
+        if data is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        key = (request.get_type(), request.get_host())
+        while True:
+            conn, reused = self._get_connection(key)
+            try:
+                conn.request(request.get_method(), request.get_selector(),
+                             data, headers)
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+
+                # Server could have closed idle connection in the meantime,
+                # any other error may come after it got the request, so
+                # retrying could send sms twice
+                if reused and _closed_idle(e):
+                    self.logger.debug("Reused connection failed (%s)", e)
+                    continue
+
+                raise CommunicationException("Error requesting %s (%s)" %(url, e))
+
+            try:
+                body = resp.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                raise CommunicationException("Error requesting %s (%s)" %(url, e))
+
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_connection(key, conn)
+
+        response = HttpResponse(url, resp.status, resp.msg, body)
+        self.cookiejar.extract_cookies(response, request)
+
+        if response.status >= 400:
+            raise CommunicationException("Http error %d from %s"
+                                         %(response.status, url))
+
+        return response
+
+class _AsyncHttpConnection(asyncore.dispatcher, object):
+    """
+    Single http/1.0 request over its own non-blocking connection
+    """
+
+    def __init__(self, client, request, result, redirects):
+        asyncore.dispatcher.__init__(self, map = client.socket_map)
+
+        self.client = client
+        self.request = request
+        self.result = result
+        self.redirects = redirects
+        self.deadline = time.time() + client.timeout
+
+        self.ssl = request.get_type() == "https"
+        self.handshaking = False
+        self.out = self._serialize(request)
+        self.data = []
+
+        host, port = urllib2.splitport(request.get_host())
+        port = int(port) if port else (443 if self.ssl else 80)
+        self.host = host
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((host, port))
+        except socket.error:
+            self.close()
+            raise
+
+    def _serialize(self, request):
+        request.add_unredirected_header("Host", request.get_host())
+        request.add_unredirected_header("Connection", "close")
+        request.add_unredirected_header("User-Agent", self.client.user_agent)
+        if request.has_data():
+            request.add_unredirected_header(
+                "Content-Type", "application/x-www-form-urlencoded")
+            request.add_unredirected_header(
+                "Content-Length", str(len(request.get_data())))
+
+        lines = ["%s %s HTTP/1.0" %(request.get_method(), request.get_selector())]
+        lines.extend("%s: %s" %header for header in request.header_items())
+
+        return "\r\n".join(lines) + "\r\n\r\n" + (request.get_data() or "")
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+
+        self.handshaking = False
+
+    def handle_connect(self):
+        if self.ssl:
+            # Certificate and host name are verified during handshake
+            sock = self.client._ssl_context().wrap_socket(
+                self.socket, server_hostname = self.host,
+                do_handshake_on_connect = False)
+            self.del_channel()
+            self.set_socket(sock)
+            self.handshaking = True
+
+    def writable(self):
+        return not self.connected or self.handshaking or bool(self.out)
+
+    def handle_write(self):
+        if self.handshaking:
+            return self._handshake()
+
+        try:
+            sent = self.send(self.out)
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                return
+            raise
+
+        self.out = self.out[sent:]
+
+    def handle_read(self):
+        if self.handshaking:
+            return self._handshake()
+
+        try:
+            data = self.recv(65536)
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                return
+            raise
+
+        if data:
+            self.data.append(data)
+
+    def handle_close(self):
+        self.close()
+
+        data = "".join(self.data)
+        head, sep, body = data.partition("\r\n\r\n")
+        if not sep:
+            return self.fail(CommunicationException(
+                "Incomplete response from %s" %self.request.get_full_url()))
+
+        status_line, sep, head = head.partition("\r\n")
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            return self.fail(CommunicationException(
+                "Invalid status line %r" %status_line[0:100]))
+
+        headers = mimetools.Message(StringIO(head))
+        if headers.get("content-length", "").isdigit():
+            body = body[:int(headers["content-length"])]
+
+        self.client._finish(self, HttpResponse(self.request.get_full_url(),
+                                               status, headers, body))
+
+    def handle_error(self):
+        e = sys.exc_info()[1]
+        self.fail(CommunicationException(
+            "Error in communication with %s (%s)"
+            %(self.request.get_full_url(), e)))
+
+    def fail(self, exception):
+        self.close()
+        self.client._fail(self, exception)
+
+class AsyncHttpClient(object):
+    """
+    Non-blocking http client running on :py:mod:`asyncore` event loop
+
+    Every request uses its own connection, so any number of requests can be
+    in flight at the same time, while cookies are shared among all of them.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    user_agent = "pysms"
+    max_redirects = 10
+
+    def __init__(self, socket_map = None, timeout = 30, cookiejar = None,
+                 ssl_context = None):
+        """
+        Constructor
+
+        :param socket_map: :py:mod:`asyncore` socket map to run on
+        :type socket_map: dict
+        :param timeout: Request timeout in seconds
+        :type timeout: float
+        :param cookiejar: Cookie jar shared among requests
+        :type cookiejar: :py:class:`cookielib.CookieJar`
+        :param ssl_context: Context of https connections, verifying
+                            certificates against system ca certificates by
+                            default
+        :type ssl_context: :py:class:`ssl.SSLContext`
+        """
+
+        self.socket_map = {} if socket_map is None else socket_map
+        self.timeout = timeout
+        self.cookiejar = cookiejar if cookiejar is not None \
+                         else cookielib.CookieJar()
+
+        self._connections = set()
+        self._context = ssl_context
+
+    def _ssl_context(self):
+        # Loading ca certificates takes time, so it is done on first https
+        # request
+        if self._context is None:
+            self._context = ssl.create_default_context()
+
+        return self._context
+
+    def request(self, url, data = None):
+        """
+        Starts http request, GET or POST if `data` is provided
+
+        :param url: Url to request
+        :type url: str
+        :param data: Urlencoded form data
+        :type data: str
+
+        :returns: Result with :py:class:`HttpResponse` as value
+        :rtype: :py:class:`pysms.sms.AsyncResult`
+        """
+
+        result = AsyncResult()
+        self._open(urllib2.Request(url, data), result, self.max_redirects)
+
+        return result
+
+    def _open(self, request, result, redirects):
+        self.cookiejar.add_cookie_header(request)
+
+        try:
+            self._connections.add(
+                _AsyncHttpConnection(self, request, result, redirects))
+        except socket.error as e:
+            result.set_exception(CommunicationException(
+                "Error connecting to %s (%s)" %(request.get_full_url(), e)))
+
+    def _finish(self, conn, response):
+        self._connections.discard(conn)
+        self.cookiejar.extract_cookies(response, conn.request)
+
+        if response.status in (301, 302, 303, 307) \
+           and response.headers.get("location"):
+            if not conn.redirects:
+                return conn.result.set_exception(CommunicationException(
+                    "Too many redirects from %s" %response.url))
+
+            url = urlparse.urljoin(response.url, response.headers["location"])
+            data = conn.request.get_data() if response.status == 307 else None
+            return self._open(urllib2.Request(url, data), conn.result,
+                              conn.redirects - 1)
+
+        if response.status >= 400:
+            return conn.result.set_exception(CommunicationException(
+                "Http error %d from %s" %(response.status, response.url)))
+
+        conn.result.set_result(response)
+
+    def _fail(self, conn, exception):
+        if conn in self._connections:
+            self._connections.discard(conn)
+            conn.result.set_exception(exception)
+        else:
+            self.logger.error("Error handling response %s", exception)
+
+    def poll(self, timeout = 0.05):
+        """
+        Runs single iteration of event loop and expires timed out requests
+
+        :param timeout: Maximal time to wait for events
+        :type timeout: float
+        """
+
+        asyncore.loop(timeout, True, self.socket_map, 1)
+
+        now = time.time()
+        for conn in list(self._connections):
+            if conn.deadline < now:
+                conn.fail(CommunicationException(
+                    "Timeout requesting %s" %conn.request.get_full_url()))
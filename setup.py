@@ -65,4 +65,7 @@ setup(
 ### Installation speciffic ###
     test_suite="pysms.tests",
     packages = find_packages(),
+    entry_points = {
+        "console_scripts": ["pysms-send = pysms.cli:main"]
+    },
 )